@@ -1,7 +1,6 @@
 ''' This defines a bunch of functions that are useful for using AWS Lambda '''
 
 import os
-import boto3
 import logging
 
 from botocore.exceptions import ClientError
@@ -9,6 +8,7 @@ from botocore.exceptions import ClientError
 from pylibs.cloud.aws.config import aws_settings
 from pylibs.cloud.aws.config import aws_exceptions
 from pylibs.cloud.aws.common import aws_common_utils
+from pylibs.cloud.aws.common import aws_client_utils
 
 # Constants
 
@@ -29,7 +29,7 @@ def list_functions(aws_region=aws_settings.AWS_DEFAULT_REGION):
     '''
     func_name_list = []
     func_full_list = []
-    lambda_client = boto3.client('lambda')
+    lambda_client = aws_client_utils.get_client('lambda')
 
     # pagination is used in case there are > 1000 functions
     paginator = lambda_client.get_paginator('list_functions')
@@ -61,7 +61,7 @@ def get_function(func_name):
                      I beleive this is valid for 10 min
              - Tags: Tags for the function
     '''
-    lambda_client = boto3.client('lambda')
+    lambda_client = aws_client_utils.get_client('lambda')
     resp = lambda_client.get_function(FunctionName=func_name)
     # Check for the response
     sbool, scode = aws_common_utils.check_response_status(resp)
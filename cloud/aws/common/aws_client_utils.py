@@ -0,0 +1,103 @@
+''' This file hosts a process wide registry of boto3 clients
+
+    Creating a boto3 client is expensive: the endpoint and service models
+    are loaded and a new HTTP connection pool is set up each time. So rather
+    than calling boto3.client() on every call, all cloud.aws utils get their
+    clients from get_client() below. Clients are created once per
+    (service, region, profile, connection settings) and then reused.
+
+    boto3 clients are thread safe, so the same client is handed out to all
+    threads. boto3 sessions are not, so sessions are only ever used while
+    holding the registry lock.
+'''
+
+import os
+import threading
+import boto3
+
+from botocore.config import Config
+
+from pylibs.cloud.aws.config import aws_settings
+
+# Registry state. Keyed as described in get_client
+_registry_lock = threading.Lock()
+_sessions = {}
+_clients = {}
+_registry_pid = os.getpid()
+
+
+def get_client(service_name, region_name=None, profile_name=None,
+               max_pool_connections=
+                        aws_settings.AWS_CLIENT_MAX_POOL_CONNECTIONS,
+               tcp_keepalive=aws_settings.AWS_CLIENT_TCP_KEEPALIVE):
+    ''' Return a (cached) boto3 client
+
+        Arguments:
+            - service_name: Name of the AWS service. E.g. 's3', 'dynamodb'
+            - region_name: Region of the client. If None, the region is
+                           picked by boto3 (env variables, ~/.aws/config)
+            - profile_name: Credentials profile. If None, the default
+                            credentials chain is used
+            - max_pool_connections: Max number of HTTP connections the
+                                    client keeps open
+            - tcp_keepalive: Turn on TCP keep-alive on those connections
+
+        Returns:
+            - A boto3 client for service_name
+    '''
+    key = (service_name, region_name, profile_name, max_pool_connections,
+           tcp_keepalive)
+    # Fast path. Dict lookups are atomic, so no lock is needed here
+    client = _clients.get(key)
+    if client is not None and _registry_pid == os.getpid():
+        return client
+
+    with _registry_lock:
+        _reset_after_fork()
+        client = _clients.get(key)
+        if client is None:
+            session = _get_session(profile_name)
+            config = Config(max_pool_connections=max_pool_connections,
+                            tcp_keepalive=tcp_keepalive)
+            client = session.client(service_name, region_name=region_name,
+                                    config=config)
+            _clients[key] = client
+    return client
+
+
+def get_session(profile_name=None):
+    ''' Return the (cached) boto3 session for profile_name
+
+        Note: boto3 sessions are not thread safe. Do not share the returned
+              session between threads. Use get_client for that
+    '''
+    with _registry_lock:
+        _reset_after_fork()
+        return _get_session(profile_name)
+
+
+def clear_clients():
+    ''' Drop all cached clients and sessions. Useful after credentials
+        have changed (e.g. a profile was refreshed) '''
+    with _registry_lock:
+        _sessions.clear()
+        _clients.clear()
+
+
+def _get_session(profile_name):
+    ''' Return the session for profile_name. Must hold the registry lock '''
+    session = _sessions.get(profile_name)
+    if session is None:
+        session = boto3.session.Session(profile_name=profile_name)
+        _sessions[profile_name] = session
+    return session
+
+
+def _reset_after_fork():
+    ''' Connection pools must not be shared with a parent process. So a
+        forked child starts with an empty registry. Must hold the lock '''
+    global _registry_pid
+    if _registry_pid != os.getpid():
+        _sessions.clear()
+        _clients.clear()
+        _registry_pid = os.getpid()
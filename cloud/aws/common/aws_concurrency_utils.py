@@ -0,0 +1,228 @@
+''' This file hosts an adaptive concurrency limiter for bulk AWS calls
+    and iter_parallel, to merge the output of concurrent generators
+
+    The limiter works like TCP congestion control (AIMD):
+        - Every successful call raises the concurrency limit by
+          1 / limit. So the limit grows by about one per "round" of calls
+        - A throttling error (SlowDown, ProvisionedThroughputExceeded,
+          any 503 etc.) cuts the limit by decrease_factor and the call
+          is retried after a jittered exponential backoff
+    So bulk helpers keep pushing up to the rate the service accepts
+    without hand tuned thread counts.
+
+    Usage:
+        limiter = AdaptiveConcurrencyLimiter()
+        # From any number of threads
+        resp = limiter.call(dyndb_client.batch_write_item,
+                            RequestItems=items)
+        print(limiter.stats())
+
+    Note: botocore retries throttled calls itself before raising. Clients
+          with fewer botocore retries let the limiter react sooner.
+'''
+
+import time
+import queue
+import random
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+from pylibs.cloud.aws.config import aws_settings
+
+
+class AdaptiveConcurrencyLimiter():
+    ''' A thread safe AIMD concurrency limiter with jittered backoff for
+        throttled AWS calls. See the module docstring '''
+    def __init__(self,
+                 initial_limit=aws_settings.AWS_LIMITER_INITIAL_CONCURRENCY,
+                 min_limit=aws_settings.AWS_LIMITER_MIN_CONCURRENCY,
+                 max_limit=aws_settings.AWS_LIMITER_MAX_CONCURRENCY,
+                 decrease_factor=aws_settings.AWS_LIMITER_DECREASE_FACTOR,
+                 max_retries=aws_settings.AWS_LIMITER_MAX_RETRIES,
+                 base_delay=aws_settings.AWS_LIMITER_BASE_DELAY,
+                 max_delay=aws_settings.AWS_LIMITER_MAX_DELAY,
+                 throttling_error_codes=
+                         aws_settings.AWS_THROTTLING_ERROR_CODES,
+                 throttling_status_codes=
+                         aws_settings.AWS_THROTTLING_HTTP_STATUS_CODES):
+        ''' Arguments:
+                - initial_limit: Concurrency to start with
+                - min_limit, max_limit: Bounds of the concurrency
+                - decrease_factor: Multiply the limit by this on throttling
+                - max_retries: Times a throttled call is retried
+                - base_delay, max_delay: Backoff before retry n is a random
+                                         time in [0, base_delay * 2**n],
+                                         capped at max_delay (in seconds)
+                - throttling_error_codes: Error codes that mean throttling
+                - throttling_status_codes: HTTP statuses that mean
+                                           throttling
+        '''
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.throttling_error_codes = set(throttling_error_codes)
+        self.throttling_status_codes = set(throttling_status_codes)
+
+        self._cond = threading.Condition()
+        self._limit = float(max(min_limit, min(initial_limit, max_limit)))
+        self._in_flight = 0
+        # Calls started before the last decrease do not decrease again.
+        # Otherwise a burst of throttles from one round of calls would
+        # collapse the limit to the minimum
+        self._epoch = 0
+        self._counters = {'calls': 0, 'successes': 0, 'throttles': 0,
+                          'retries': 0, 'failures': 0}
+
+    # Public methods
+    @property
+    def limit(self):
+        ''' The current concurrency limit '''
+        return int(self._limit)
+
+    def call(self, func, *args, **kwargs):
+        ''' Call func(*args, **kwargs) within the concurrency limit,
+            retrying it if it is throttled
+
+            Returns: Whatever func returns
+            Raises: Whatever func raises, once retries are exhausted or
+                    for errors other than throttling
+        '''
+        with self._cond:
+            self._counters['calls'] += 1
+        for attempt in range(self.max_retries + 1):
+            epoch = self._acquire()
+            try:
+                result = func(*args, **kwargs)
+            except ClientError as e:
+                self._release()
+                if not self.is_throttling_error(e):
+                    self._count('failures')
+                    raise
+                self.on_throttle(epoch)
+                if attempt == self.max_retries:
+                    self._count('failures')
+                    raise
+                self._count('retries')
+                self.backoff(attempt)
+                continue
+            except BaseException:
+                self._release()
+                self._count('failures')
+                raise
+            self._release()
+            self.on_success()
+            return result
+
+    def is_throttling_error(self, e):
+        ''' Check if a ClientError is a throttling error '''
+        return (e.response.get('Error', {}).get('Code') in
+                self.throttling_error_codes or
+                e.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+                in self.throttling_status_codes)
+
+    def on_success(self):
+        ''' Additive increase. Also for callers that manage retries
+            themselves (e.g. of UnprocessedItems) '''
+        with self._cond:
+            self._counters['successes'] += 1
+            self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            self._cond.notify_all()
+
+    def on_throttle(self, epoch=None):
+        ''' Multiplicative decrease. epoch is what _acquire returned for
+            the throttled call. If None, always decrease '''
+        with self._cond:
+            self._counters['throttles'] += 1
+            if epoch is None or epoch == self._epoch:
+                self._limit = max(self.min_limit,
+                                  self._limit * self.decrease_factor)
+                self._epoch += 1
+                logging.info(f'Throttled. Concurrency limit down to '
+                             f'{self.limit}')
+
+    def backoff(self, attempt):
+        ''' Sleep a jittered exponential backoff time before retry attempt '''
+        delay = min(self.max_delay, self.base_delay * 2**attempt)
+        time.sleep(random.uniform(0, delay))
+
+    def stats(self):
+        ''' Return a dict with the current limit, calls in flight and the
+            call, success, throttle, retry and failure counts '''
+        with self._cond:
+            stats = dict(self._counters)
+            stats['limit'] = self.limit
+            stats['in_flight'] = self._in_flight
+        return stats
+
+    # Private methods
+    def _acquire(self):
+        ''' Wait for a free slot. Returns the current epoch '''
+        with self._cond:
+            while self._in_flight >= int(self._limit):
+                self._cond.wait()
+            self._in_flight += 1
+            return self._epoch
+
+    def _release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def _count(self, counter):
+        with self._cond:
+            self._counters[counter] += 1
+
+
+def iter_parallel(gen_funcs, max_workers):
+    ''' Run the generator functions in gen_funcs from a pool of max_workers
+        threads and yield everything they produce, in arrival order.
+
+        The queue between the workers and the consumer is bounded, so the
+        workers never get far ahead of a slow consumer. If the consumer
+        stops early (or an error is raised) the workers are stopped too. '''
+    results = queue.Queue(maxsize=2 * max_workers)
+    stop = threading.Event()
+    done = object()
+
+    def _put(item):
+        # Do not block forever if the consumer has gone away
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(gen_func):
+        try:
+            for item in gen_func():
+                if not _put((None, item)):
+                    return
+        except BaseException as e:
+            _put((e, None))
+        finally:
+            _put((None, done))
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        for gen_func in gen_funcs:
+            executor.submit(_run, gen_func)
+        remaining = len(gen_funcs)
+        while remaining:
+            err, item = results.get()
+            if err is not None:
+                raise err
+            if item is done:
+                remaining -= 1
+            else:
+                yield item
+    finally:
+        stop.set()
+        executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,32 @@
+''' Run various tests on aws_client_utils '''
+
+import pytest
+from pylibs.cloud.aws.common import aws_client_utils
+
+
+@pytest.fixture(autouse=True)
+def empty_registry():
+    ''' Start and end every test with an empty registry '''
+    aws_client_utils.clear_clients()
+    yield
+    aws_client_utils.clear_clients()
+
+
+def test_get_client_is_cached():
+    ''' Test that the same client is handed out for the same settings '''
+    client1 = aws_client_utils.get_client('s3', region_name='us-west-2')
+    client2 = aws_client_utils.get_client('s3', region_name='us-west-2')
+    assert client1 is client2
+
+
+def test_get_client_keys():
+    ''' Test that different services/regions/settings get different
+        clients configured as requested '''
+    s3_west = aws_client_utils.get_client('s3', region_name='us-west-2')
+    s3_east = aws_client_utils.get_client('s3', region_name='us-east-1')
+    dyndb = aws_client_utils.get_client('dynamodb', region_name='us-west-2')
+    s3_big = aws_client_utils.get_client('s3', region_name='us-west-2',
+                                         max_pool_connections=200)
+    assert len({id(s3_west), id(s3_east), id(dyndb), id(s3_big)}) == 4
+    assert s3_east.meta.region_name == 'us-east-1'
+    assert s3_big.meta.config.max_pool_connections == 200
@@ -0,0 +1,96 @@
+''' Run various tests on aws_concurrency_utils '''
+
+import pytest
+import threading
+
+from botocore.exceptions import ClientError
+
+from pylibs.cloud.aws.common import aws_concurrency_utils
+
+
+def _throttling_error():
+    return ClientError({'Error': {'Code': 'SlowDown'}}, 'PutObject')
+
+
+def test_limiter_increase_and_decrease():
+    ''' Test additive increase on success and multiplicative decrease on
+        throttling (once per round) '''
+    limiter = aws_concurrency_utils.AdaptiveConcurrencyLimiter(
+                        initial_limit=4, max_limit=8, base_delay=0)
+    for _ in range(8):
+        limiter.call(lambda: None)
+    assert limiter.limit == 5
+
+    calls = []
+
+    def _throttled_once():
+        calls.append(1)
+        if len(calls) == 1:
+            raise _throttling_error()
+        return 'ok'
+
+    assert limiter.call(_throttled_once) == 'ok'
+    stats = limiter.stats()
+    assert stats['limit'] == 3
+    assert stats['throttles'] == 1
+    assert stats['retries'] == 1
+    assert stats['in_flight'] == 0
+
+
+def test_limiter_503_is_throttling():
+    ''' Test that any 503 counts as throttling, whatever its error code '''
+    limiter = aws_concurrency_utils.AdaptiveConcurrencyLimiter()
+    unavailable = ClientError({'Error': {'Code': 'ServiceUnavailable'},
+                               'ResponseMetadata': {'HTTPStatusCode': 503}},
+                              'GetObject')
+    assert limiter.is_throttling_error(unavailable)
+    assert limiter.is_throttling_error(_throttling_error())
+    assert not limiter.is_throttling_error(
+                ClientError({'Error': {'Code': 'NoSuchKey'},
+                             'ResponseMetadata': {'HTTPStatusCode': 404}},
+                            'GetObject'))
+
+
+def test_limiter_gives_up():
+    ''' Test that other errors are not retried and throttling errors only
+        up to max_retries times '''
+    limiter = aws_concurrency_utils.AdaptiveConcurrencyLimiter(
+                        max_retries=2, base_delay=0)
+
+    def _always_throttled():
+        raise _throttling_error()
+
+    with pytest.raises(ClientError):
+        limiter.call(_always_throttled)
+    assert limiter.stats()['retries'] == 2
+
+    def _not_found():
+        raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+
+    with pytest.raises(ClientError):
+        limiter.call(_not_found)
+    assert limiter.stats()['failures'] == 2
+
+
+def test_limiter_bounds_concurrency():
+    ''' Test that no more calls than the limit run at once '''
+    limiter = aws_concurrency_utils.AdaptiveConcurrencyLimiter(
+                        initial_limit=2, max_limit=2)
+    lock = threading.Lock()
+    running = [0, 0]      # Now, max
+
+    def _work():
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        threading.Event().wait(0.01)
+        with lock:
+            running[0] -= 1
+
+    threads = [threading.Thread(target=limiter.call, args=(_work,))
+               for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert running[1] == 2
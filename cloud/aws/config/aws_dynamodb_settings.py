@@ -0,0 +1,38 @@
+''' This file contains various settings for use with DynamoDB '''
+
+# Batch API limits (set by AWS)
+DYNAMODB_BATCH_WRITE_MAX_ITEMS = 25
+DYNAMODB_BATCH_GET_MAX_KEYS = 100
+
+# Settings common to all concurrent data plane helpers
+DYNAMODB_MAX_WORKERS = 8
+# Times UnprocessedItems/UnprocessedKeys are retried before giving up
+DYNAMODB_UNPROCESSED_MAX_RETRIES = 10
+
+# Parallel scans (see dynamodb_utils.scan_table)
+DYNAMODB_SCAN_BATCH_SIZE = 10000    # Items per columnar batch
+
+# Time series tables (see dynamodb_utils.DynamoDBTimeSeriesTable)
+DYNAMODB_TS_NUM_SHARDS = 10         # Partitions written per time bucket
+DYNAMODB_TS_BUCKET_SECONDS = 86400  # Time span of one partition
+DYNAMODB_TS_PARTITION_KEY = 'pk'
+DYNAMODB_TS_SORT_KEY = 'ts'
+
+# In-process item cache (see dynamodb_utils.DynamoDBItemCache)
+DYNAMODB_CACHE_MAX_ITEMS = 100000
+DYNAMODB_CACHE_TTL = 60             # In seconds
+DYNAMODB_CACHE_NEGATIVE_TTL = 10    # In seconds, for items not found
+
+# Table metadata cache (see dynamodb_utils.get_table_metadata)
+DYNAMODB_METADATA_TTL = 300         # In seconds
+
+# Table exports (see dynamodb_utils.export_table)
+DYNAMODB_EXPORT_ROW_GROUP_SIZE = 50000  # Items held in memory per partition
+DYNAMODB_EXPORT_ROWS_PER_FILE = 1000000
+DYNAMODB_EXPORT_MAX_OPEN_FILES = 64     # Open files in partitioned exports
+DYNAMODB_EXPORT_MAX_BUFFERED_ROWS = 500000  # Items held across partitions
+
+# Consumed capacity rate limiting (see dynamodb_utils.DynamoDBCapacityLimiter)
+DYNAMODB_CAPACITY_BURST_SECONDS = 1.0   # Unused capacity that can be saved
+DYNAMODB_CAPACITY_WINDOW = 10.0         # Seconds averaged for the rate
+DYNAMODB_CAPACITY_PUBLISH_INTERVAL = 60.0
@@ -22,3 +22,9 @@ class AWS_NotImplementedError(Exception):
     ''' This exception will be raised if an AWS specific function is not
         implemented '''
     pass
+
+
+class AWS_S3_IncompleteRead(Exception):
+    ''' This exception will be raised if fewer bytes than requested were
+        read from an S3 object (e.g. the connection dropped mid-stream) '''
+    pass
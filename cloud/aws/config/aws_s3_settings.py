@@ -1,5 +1,7 @@
 ''' This file contains various settings for use with S3 '''
 
+import os
+
 S3_CREATE_BUCKET_FAILED = 0
 S3_CREATE_BUCKET_SUCCESS = 1
 S3_BUCKET_ALREADY_EXISTS = 2
@@ -7,3 +9,91 @@ S3_BUCKET_DELETE_SUCCESS = 3
 S3_BUCKET_DELETE_FAILED = 4
 S3_PUT_OBJECT_SUCCESS = 5
 S3_PUT_OBJECT_FAIL = 6
+S3_GET_OBJECT_SUCCESS = 7
+S3_GET_OBJECT_FAIL = 8
+S3_PUT_OBJECT_SKIPPED = 9
+
+# Multipart upload settings
+# Objects larger than the threshold are uploaded in parts from a thread pool
+# Note: S3 requires every part but the last to be at least 5 MB and allows
+#       at most 10000 parts per upload
+S3_MULTIPART_THRESHOLD = 64 * 1024 * 1024
+S3_MULTIPART_PART_SIZE = 16 * 1024 * 1024
+S3_MULTIPART_MIN_PART_SIZE = 5 * 1024 * 1024
+S3_MULTIPART_MAX_PARTS = 10000
+
+# Ranged download settings
+# Objects are fetched as concurrent ranged GETs of S3_DOWNLOAD_PART_SIZE
+# bytes. Each range is streamed into the destination in chunks of
+# S3_DOWNLOAD_CHUNK_SIZE bytes
+S3_DOWNLOAD_PART_SIZE = 8 * 1024 * 1024
+S3_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Bulk delete settings
+# delete_objects accepts at most 1000 keys per call
+S3_DELETE_BATCH_SIZE = 1000
+
+# Local object cache settings (see s3_utils.S3ObjectCache)
+# Cached objects younger than S3_CACHE_TTL seconds are used without asking
+# S3. Older ones are revalidated with a conditional (If-None-Match) request
+S3_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'pylibs', 's3')
+S3_CACHE_MAX_SIZE = 10 * 1024 * 1024 * 1024
+S3_CACHE_TTL = 0
+
+# Read-ahead of s3_utils.S3File. Grows from min to max for sequential reads
+S3_FILE_MIN_READAHEAD = 64 * 1024
+S3_FILE_MAX_READAHEAD = 16 * 1024 * 1024
+
+# Directory sync settings (see s3_utils.sync_dir_to_s3)
+# The manifest records the size, mtime and ETag of every synced file so
+# unchanged files do not need to be hashed again on the next sync
+S3_SYNC_MANIFEST_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                                    'pylibs', 's3sync')
+S3_HASH_CHUNK_SIZE = 1024 * 1024
+
+# Dedup upload settings (see s3_utils.put_object and put_objects)
+# Objects uploaded with dedup carry the SHA256 of their data in this user
+# metadata key. That still matches when the ETag does not (SSE-KMS, or a
+# different part size). In bulk uploads, every top level "directory" with
+# at least S3_DEDUP_LISTING_MIN_KEYS objects gets the remote ETags from one
+# listing instead of a HEAD per key
+S3_CHECKSUM_METADATA_KEY = 'sha256'
+S3_DEDUP_LISTING_MIN_KEYS = 100
+
+# Local inventory index of bucket listings (see s3_utils.S3InventoryIndex)
+S3_INVENTORY_DB_FILE = os.path.join(os.path.expanduser('~'), '.cache',
+                                    'pylibs', 's3inventory.sqlite')
+S3_INVENTORY_BATCH_SIZE = 1000      # Objects written per transaction
+
+# Compression settings (see s3_utils.put_object_compressed)
+# Compressed objects get a Content-Encoding of gzip or zstd and carry their
+# uncompressed size in this user metadata key
+S3_COMPRESSION_DEFAULT_LEVELS = {'gzip': 6, 'zstd': 3}
+S3_COMPRESSION_CHUNK_SIZE = 1024 * 1024
+S3_UNCOMPRESSED_SIZE_METADATA_KEY = 'uncompressed-size'
+
+# Small-file packing (see s3_utils.pack_dir_to_s3 and S3PackReader)
+S3_PACK_SHARD_SIZE = 256 * 1024 * 1024
+S3_PACK_SHARD_SUFFIX = '.pack'
+S3_PACK_INDEX_SUFFIX = '.index.json'
+S3_PACK_MAX_SHARDS_IN_FLIGHT = 2    # Each shard is held in memory
+
+# Background uploads (see s3_utils.S3BackgroundUploader)
+S3_BACKGROUND_UPLOAD_WORKERS = 2    # Files uploaded at a time
+S3_BACKGROUND_UPLOAD_MAX_QUEUED = 8 # submit() blocks beyond this
+
+# Settings common to all concurrent transfers
+S3_TRANSFER_MAX_WORKERS = 8
+S3_TRANSFER_MAX_RETRIES = 3
+S3_TRANSFER_RETRY_BASE_DELAY = 0.5      # In seconds. Doubled on each retry
+# 4xx errors that are still worth retrying. All other 4xx errors (like
+# NoSuchKey or AccessDenied) fail right away
+S3_RETRYABLE_CLIENT_ERRORS = ('RequestTimeout', 'RequestTimeTooSkewed',
+                              'SlowDown', 'Throttling', 'ThrottlingException',
+                              'TooManyRequestsException')
+# Per key errors returned by delete_objects that are worth retrying
+S3_RETRYABLE_SERVER_ERRORS = ('InternalError', 'ServiceUnavailable',
+                              'SlowDown')
+
+# Max number of requests in flight for s3_async_utils.S3AsyncClient
+S3_ASYNC_MAX_CONCURRENCY = 256
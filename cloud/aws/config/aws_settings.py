@@ -32,3 +32,38 @@ AWS_REGIONS = {
     "us-gov-west-1": "US Gov West 1",
     "us-gov-east-1": "US Gov East 1",
 }
+
+# Settings for the boto3 clients handed out by aws_client_utils.get_client
+# The connection pool should be at least as large as the number of threads
+# that share a client (see S3_TRANSFER_MAX_WORKERS and the like)
+AWS_CLIENT_MAX_POOL_CONNECTIONS = 50
+AWS_CLIENT_TCP_KEEPALIVE = True
+
+# Error codes AWS services use to say "slow down". These make the
+# aws_concurrency_utils.AdaptiveConcurrencyLimiter back off
+AWS_THROTTLING_ERROR_CODES = (
+    'BandwidthLimitExceeded',
+    'EC2ThrottledException',
+    'PriorRequestNotComplete',
+    'ProvisionedThroughputExceededException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'SlowDown',
+    'ThrottledException',
+    'Throttling',
+    'ThrottlingException',
+    'TooManyRequestsException',
+)
+# HTTP statuses that mean "slow down" whatever the error code (S3 sends
+# 503 Slow Down, other services 503 Service Unavailable)
+AWS_THROTTLING_HTTP_STATUS_CODES = (503,)
+
+# AdaptiveConcurrencyLimiter defaults
+AWS_LIMITER_INITIAL_CONCURRENCY = 8
+AWS_LIMITER_MIN_CONCURRENCY = 1
+AWS_LIMITER_MAX_CONCURRENCY = 256
+AWS_LIMITER_DECREASE_FACTOR = 0.5
+AWS_LIMITER_MAX_RETRIES = 10
+AWS_LIMITER_BASE_DELAY = 0.05         # In seconds
+AWS_LIMITER_MAX_DELAY = 20.0          # In seconds
@@ -1,17 +1,51 @@
 ''' This defines a bunch of functions that are useful for using AWS DynamoDB '''
 
 import os
-import boto3
+import json
+import base64
+import math
+import time
+import heapq
+import random
+import decimal
 import logging
+import threading
+import shutil
+import tempfile
+import collections
+import urllib.parse
 
-from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, wait
+from botocore.exceptions import ClientError, BotoCoreError
+from boto3.dynamodb.types import TypeSerializer, TypeDeserializer, Binary
+from boto3.dynamodb.types import DYNAMODB_CONTEXT
 
 from pylibs.cloud.aws.config import aws_settings
+from pylibs.cloud.aws.config import aws_dynamodb_settings
 from pylibs.cloud.aws.config import aws_exceptions
 from pylibs.cloud.aws.common import aws_common_utils
+from pylibs.cloud.aws.common import aws_client_utils
+from pylibs.cloud.aws.common import aws_concurrency_utils
+from pylibs.cloud.aws.s3 import s3_utils
+
+# numpy and Arrow output of scan_table and export_table are optional
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 # Constants
 
+# Table name -> (time fetched, table description). See get_table_metadata
+_table_metadata = {}
+_table_metadata_lock = threading.Lock()
+
 # Set logging level
 # logging.basicConfig(level=logging.INFO)
 
@@ -39,7 +73,7 @@ def create_table(table_name, table_schema, primary_key, secondary_key=None,
             - table_description: The full JSON response from AWS 
                                  (minus the response metadata)
     '''
-    dyndb_client = boto3.client('dynamodb')
+    dyndb_client = aws_client_utils.get_client('dynamodb')
 
     # Define the attributes definition dict outside the create_table call.
     # This is because primary and secondary key types have to be specified
@@ -81,6 +115,7 @@ def create_table(table_name, table_schema, primary_key, secondary_key=None,
         f'table {table_name} failed with code: {scode}')
         raise aws_exceptions.AWS_API_CallFailed
 
+    invalidate_table_metadata(table_name)
     # Return the table ARN, table ID and the entire response
     table_arn = table['TableDescription']['TableArn']
     table_id = table['TableDescription']['TableId']
@@ -101,7 +136,7 @@ def delete_table(table_name, aws_region=aws_settings.AWS_DEFAULT_REGION):
                              (minus the response metadata)
                              This appears to be the table description
     '''
-    dyndb_client = boto3.client('dynamodb')
+    dyndb_client = aws_client_utils.get_client('dynamodb')
 
     resp = dyndb_client.delete_table(TableName = table_name)
     sbool, scode = aws_common_utils.check_response_status(resp)
@@ -111,16 +146,13 @@ def delete_table(table_name, aws_region=aws_settings.AWS_DEFAULT_REGION):
         raise aws_exceptions.AWS_API_CallFailed
 
     deleted_table_name = resp['TableDescription']['TableName']
+    invalidate_table_metadata(table_name)
 
     return deleted_table_name, resp['TableDescription']
 
 
 def list_tables(aws_region=aws_settings.AWS_DEFAULT_REGION):
-    ''' List all DynamoDB in current AWS region
-        ###### Mega Note: ######
-            This code does not use pagination. As such, the first 100
-            tables *ONLY* are returned. If there are more than 100 tables,
-            code needs to be extended like the list lambda functions
+    ''' List all DynamoDB tables in current AWS region
 
         Arguments:
             - aws_region: AWS region from which to list tables
@@ -128,16 +160,32 @@ def list_tables(aws_region=aws_settings.AWS_DEFAULT_REGION):
         Returns:
             - table_names: A list of table names
     '''
-    dyndb_client = boto3.client('dynamodb')
+    return list(iter_tables(aws_region=aws_region))
 
-    resp = dyndb_client.list_tables()
-    sbool, scode = aws_common_utils.check_response_status(resp)
-    if not sbool:
-        logging.info(f'AWS API call to list DynamoDB table failed '
-                     f'with code: {scode}')
-        raise aws_exceptions.AWS_API_CallFailed
 
-    return resp['TableNames'] 
+def iter_tables(aws_region=aws_settings.AWS_DEFAULT_REGION):
+    ''' Yield the names of all DynamoDB tables in current AWS region,
+        following the pages of list_tables (100 tables each)
+
+        Arguments:
+            - aws_region: AWS region from which to list tables
+                          Currently unused
+    '''
+    dyndb_client = aws_client_utils.get_client('dynamodb')
+
+    params = {}
+    while True:
+        resp = dyndb_client.list_tables(**params)
+        sbool, scode = aws_common_utils.check_response_status(resp)
+        if not sbool:
+            logging.info(f'AWS API call to list DynamoDB table failed '
+                         f'with code: {scode}')
+            raise aws_exceptions.AWS_API_CallFailed
+        yield from resp['TableNames']
+        if 'LastEvaluatedTableName' not in resp:
+            return
+        params['ExclusiveStartTableName'] = resp['LastEvaluatedTableName']
+
 
 def describe_table(table_name, aws_region=aws_settings.AWS_DEFAULT_REGION):
     ''' Describe a table in AWS DynamoDB
@@ -151,7 +199,7 @@ def describe_table(table_name, aws_region=aws_settings.AWS_DEFAULT_REGION):
             - table_description: JSON describing the table. Pretty much the
                                  JSON returned by the AWS boto3 call
     '''
-    dyndb_client = boto3.client('dynamodb')
+    dyndb_client = aws_client_utils.get_client('dynamodb')
 
     resp = dyndb_client.describe_table(TableName = table_name)
     sbool, scode = aws_common_utils.check_response_status(resp)
@@ -162,6 +210,1767 @@ def describe_table(table_name, aws_region=aws_settings.AWS_DEFAULT_REGION):
 
     return resp['Table']
 
+
+def get_table_metadata(table_name,
+                       ttl=aws_dynamodb_settings.DYNAMODB_METADATA_TTL,
+                       aws_region=aws_settings.AWS_DEFAULT_REGION):
+    ''' describe_table, served from an in-process cache
+
+        Key schemas, indexes and the like rarely change, so hot code can
+        call this instead of describe_table on every request. Note that
+        DynamoDB only updates ItemCount and TableSizeBytes about every six
+        hours anyway.
+        create_table and delete_table invalidate the cached entry.
+
+        Arguments:
+            - table_name: Name of table to describe
+            - ttl: Seconds a cached description is used. 0 to refresh
+        Returns:
+            - table_description: As returned by describe_table. Do not
+                                 modify it, it is shared
+    '''
+    now = time.monotonic()
+    with _table_metadata_lock:
+        entry = _table_metadata.get(table_name)
+    if entry is not None and now - entry[0] < ttl:
+        return entry[1]
+    description = describe_table(table_name, aws_region=aws_region)
+    with _table_metadata_lock:
+        _table_metadata[table_name] = (now, description)
+    return description
+
+
+def invalidate_table_metadata(table_name=None):
+    ''' Drop the cached metadata of table_name, or of all tables '''
+    with _table_metadata_lock:
+        if table_name is None:
+            _table_metadata.clear()
+        else:
+            _table_metadata.pop(table_name, None)
+
+
+def get_key_names(table_name, aws_region=aws_settings.AWS_DEFAULT_REGION):
+    ''' Return the key attribute names of a table, partition key first.
+        Uses the cached table metadata '''
+    key_schema = get_table_metadata(table_name,
+                                    aws_region=aws_region)['KeySchema']
+    return [k['AttributeName'] for k in
+            sorted(key_schema, key=lambda k: k['KeyType'] != 'HASH')]
+
+
+def describe_all_tables(max_workers=aws_dynamodb_settings.DYNAMODB_MAX_WORKERS,
+                        aws_region=aws_settings.AWS_DEFAULT_REGION):
+    ''' Describe all tables in current AWS region concurrently
+
+        The descriptions also refresh the metadata cache.
+
+        Arguments:
+            - max_workers: Number of describe_table calls at a time
+        Returns:
+            - A dict of table name -> table description
+    '''
+    def _describe(table_name):
+        return get_table_metadata(table_name, ttl=0, aws_region=aws_region)
+
+    table_names = list(iter_tables(aws_region=aws_region))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(table_names, executor.map(_describe, table_names)))
+
+
+################ Marshalling ######################
+class DynamoDBMarshaller():
+    ''' Convert items between python values and DynamoDB attribute values
+        ({'S': ...}, {'N': ...} etc.) faster than boto3's TypeSerializer
+
+        TypeSerializer works out the type of every value on every call and
+        routes numbers through a Decimal context. With a declared schema
+        (the table_schema list given to create_table) a converter is
+        picked once per attribute, so converting an attribute is a dict
+        lookup and a function call. Attributes not in the schema, and
+        values that do not match their declared type, fall back to
+        TypeSerializer/TypeDeserializer.
+
+        Differences from TypeSerializer/TypeDeserializer:
+            - Numbers may be int, float or Decimal. Floats are sent as
+              their shortest repr. NaN and infinity are rejected
+            - Declared B attributes come back as bytes, not Binary
+            - number_type='native' returns numbers as int or float instead
+              of Decimal
+
+        Usage:
+            marshaller = DynamoDBMarshaller(table_schema)
+            av_item = marshaller.serialize({'pri': 'x', 'sec': 3})
+            item = marshaller.deserialize(av_item)
+    '''
+    def __init__(self, table_schema=(), number_type='decimal'):
+        ''' Arguments:
+                - table_schema: List of {'AttributeName': ...,
+                                'AttributeType': ...} dicts. Types are
+                                S, N, B, BOOL, SS, NS, BS, L or M
+                - number_type: 'decimal' or 'native'. See above
+        '''
+        if number_type not in ('decimal', 'native'):
+            raise ValueError(f'Unknown number_type {number_type}')
+        number_from = (decimal.Decimal if number_type == 'decimal' else
+                       _native_number)
+        # A converter returns None for a value that is not of its type.
+        # That value then goes through TypeSerializer, which either picks
+        # the right type or raises
+        serializers = {
+            'S': lambda v: {'S': v} if type(v) is str else None,
+            'N': lambda v: {'N': _number_to_str(v)},
+            'B': lambda v: ({'B': bytes(v)} if
+                            isinstance(v, (bytes, bytearray)) else None),
+            'BOOL': lambda v: {'BOOL': v} if type(v) is bool else None,
+            'SS': lambda v: ({'SS': list(v)} if
+                             _is_set_of(v, (str,)) else None),
+            'NS': lambda v: ({'NS': [_number_to_str(n) for n in v]} if
+                             _is_set_of(v, (int, float, decimal.Decimal))
+                             else None),
+            'BS': lambda v: ({'BS': [bytes(b) for b in v]} if
+                             _is_set_of(v, (bytes, bytearray)) else None),
+        }
+        deserializers = {
+            'S': lambda av: av['S'],
+            'N': lambda av: number_from(av['N']),
+            'B': lambda av: av['B'],
+            'BOOL': lambda av: av['BOOL'],
+            'SS': lambda av: set(av['SS']),
+            'NS': lambda av: {number_from(n) for n in av['NS']},
+            'BS': lambda av: set(av['BS']),
+        }
+        self._fallback_serializer = TypeSerializer()
+        self._fallback_deserializer = TypeDeserializer()
+        self._serializers = {}
+        self._deserializers = {}
+        for attr in table_schema:
+            name, attr_type = attr['AttributeName'], attr['AttributeType']
+            # L and M hold values of any type. Nothing to precompile
+            if attr_type in serializers:
+                self._serializers[name] = serializers[attr_type]
+                self._deserializers[name] = deserializers[attr_type]
+
+    def serialize(self, item):
+        ''' Convert a dict of python values to a dict of attribute values '''
+        serializers = self._serializers
+        fallback = self._fallback_serializer.serialize
+        av_item = {}
+        for name, value in item.items():
+            converter = serializers.get(name)
+            av_value = None
+            if converter is not None and value is not None:
+                try:
+                    av_value = converter(value)
+                except (TypeError, ValueError, decimal.InvalidOperation):
+                    av_value = None
+            av_item[name] = av_value if av_value is not None else \
+                            fallback(value)
+        return av_item
+
+    def deserialize(self, av_item):
+        ''' Convert a dict of attribute values to a dict of python values '''
+        deserializers = self._deserializers
+        fallback = self._fallback_deserializer.deserialize
+        item = {}
+        for name, av_value in av_item.items():
+            converter = deserializers.get(name)
+            if converter is not None:
+                try:
+                    item[name] = converter(av_value)
+                    continue
+                except KeyError:
+                    # Not of the declared type (e.g. NULL)
+                    pass
+            item[name] = fallback(av_value)
+        return item
+
+
+def _is_set_of(value, types):
+    ''' Check that value is a non-empty set with only members of types.
+        DynamoDB has no empty sets '''
+    return (isinstance(value, (set, frozenset)) and len(value) > 0 and
+            all(isinstance(v, types) and not isinstance(v, bool)
+                for v in value))
+
+
+def _number_to_str(value):
+    ''' Format an int, float or Decimal for an N attribute value. Numbers
+        DynamoDB cannot store (more than 38 significant digits, or a
+        magnitude outside 1E-130..9.99E+125) raise the decimal exception
+        TypeSerializer raises for them '''
+    value_type = type(value)
+    if value_type is int:
+        # Only very long ints need the full check
+        if -_MAX_EXACT_INT < value < _MAX_EXACT_INT:
+            return str(value)
+        return _checked_number_str(value)
+    if value_type is float:
+        if not math.isfinite(value):
+            raise ValueError(f'{value} cannot be stored in DynamoDB')
+        # A float repr has at most 17 digits. Only the range can be off
+        if value == 0 or 1e-128 < abs(value) < 1e125:
+            return repr(value)
+        return _checked_number_str(decimal.Decimal(repr(value)))
+    if value_type is decimal.Decimal:
+        if not value.is_finite():
+            raise ValueError(f'{value} cannot be stored in DynamoDB')
+        return _checked_number_str(value)
+    raise TypeError(f'{value_type} is not a number')
+
+
+# Ints below this have at most 38 digits. See _number_to_str
+_MAX_EXACT_INT = 10**38
+_MIN_NUMBER_MAGNITUDE = decimal.Decimal('1E-130')
+_MAX_NUMBER_MAGNITUDE = decimal.Decimal('1E+126')
+
+
+def _checked_number_str(value):
+    ''' str(value) after checking it against the DynamoDB number limits '''
+    # Raises Rounded/Inexact for too many digits and Overflow for numbers
+    # that are far too large, like TypeSerializer
+    number = DYNAMODB_CONTEXT.create_decimal(value)
+    # copy_abs, as abs() rounds to the default 28 digit context
+    if number.copy_abs() >= _MAX_NUMBER_MAGNITUDE:
+        raise decimal.Overflow(f'{value} is too large for DynamoDB')
+    if number and number.copy_abs() < _MIN_NUMBER_MAGNITUDE:
+        raise decimal.Underflow(f'{value} is too small for DynamoDB')
+    return str(value)
+
+
+def _floats_to_decimal(value):
+    ''' Replace the floats in value (and in the lists, sets and dicts in
+        it) with Decimals '''
+    if isinstance(value, float):
+        return decimal.Decimal(_number_to_str(value))
+    if isinstance(value, dict):
+        return {k: _floats_to_decimal(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_floats_to_decimal(v) for v in value]
+    if isinstance(value, (set, frozenset)):
+        return {_floats_to_decimal(v) for v in value}
+    return value
+
+
+def _native_number(number_str):
+    ''' Parse an N attribute value as an int if possible, else a float '''
+    try:
+        return int(number_str)
+    except ValueError:
+        return float(number_str)
+
+
+################ Capacity ######################
+class DynamoDBCapacityLimiter():
+    ''' Keep bulk jobs under a target read and write capacity
+
+        A token bucket for reads and one for writes, filled at
+        read_capacity and write_capacity units per second. The cost of a
+        call is not known up front, so a call waits until its bucket is
+        not in debt, takes the average cost of recent calls, and settles
+        the difference with the ConsumedCapacity DynamoDB returns. Calls
+        go ahead at full speed while there is capacity and slow down as
+        soon as the jobs sharing the limiter use more than their share.
+
+        Share one limiter between the writers, readers and scanners of a
+        table, e.g. to leave the rest of a provisioned table to production
+        traffic:
+            capacity = DynamoDBCapacityLimiter(read_capacity=200,
+                                               write_capacity=100)
+            with DynamoDBBulkWriter('t', capacity_limiter=capacity) as w:
+                ...
+            for item in scan_table('t', capacity_limiter=capacity):
+                ...
+            print(capacity.stats())
+
+        The achieved capacity per second is in stats(), and is published
+        every publish_interval seconds to on_publish (logged by default).
+    '''
+    def __init__(self, read_capacity=None, write_capacity=None,
+                 burst_seconds=
+                        aws_dynamodb_settings.DYNAMODB_CAPACITY_BURST_SECONDS,
+                 window=aws_dynamodb_settings.DYNAMODB_CAPACITY_WINDOW,
+                 publish_interval=
+                    aws_dynamodb_settings.DYNAMODB_CAPACITY_PUBLISH_INTERVAL,
+                 on_publish=None):
+        ''' Arguments:
+                - read_capacity, write_capacity: Target units per second.
+                          None to only measure
+                - burst_seconds: Seconds of unused capacity that can be
+                                 saved up for a burst
+                - window: Seconds over which the achieved rate is averaged
+                - publish_interval: Seconds between calls to on_publish.
+                                    0 to never publish
+                - on_publish: Called with stats(). Logs them if None
+        '''
+        self.burst_seconds = burst_seconds
+        self.window = window
+        self.publish_interval = publish_interval
+        self.on_publish = on_publish
+        self._cond = threading.Condition()
+        now = time.monotonic()
+        self._last_publish = now
+        self._buckets = {}
+        for kind, rate in (('read', read_capacity),
+                           ('write', write_capacity)):
+            self._buckets[kind] = {
+                'rate': rate, 'tokens': (rate or 0) * burst_seconds,
+                'updated': now, 'estimate': 1.0, 'consumed': 0.0,
+                'calls': 0, 'history': collections.deque()}
+
+    def call(self, kind, func, *args, **kwargs):
+        ''' Call func(*args, **kwargs) once there is kind ('read' or
+            'write') capacity, asking DynamoDB for the consumed capacity.
+            Returns what func returns '''
+        estimate = self.acquire(kind)
+        kwargs['ReturnConsumedCapacity'] = 'TOTAL'
+        consumed = 0.0
+        try:
+            resp = func(*args, **kwargs)
+            consumed = _consumed_units(resp.get('ConsumedCapacity'))
+        finally:
+            self.settle(kind, estimate, consumed)
+        return resp
+
+    def acquire(self, kind):
+        ''' Wait until the kind bucket is not in debt and take the
+            estimated cost of a call from it. Returns the estimate '''
+        bucket = self._buckets[kind]
+        with self._cond:
+            while True:
+                self._refill(bucket)
+                if bucket['rate'] is None or bucket['tokens'] > 0:
+                    estimate = bucket['estimate']
+                    bucket['tokens'] -= estimate
+                    return estimate
+                self._cond.wait(-bucket['tokens'] / bucket['rate'])
+
+    def settle(self, kind, estimate, consumed):
+        ''' Correct the bucket once the consumed capacity of a call that
+            was estimated to cost estimate is known '''
+        bucket = self._buckets[kind]
+        with self._cond:
+            now = time.monotonic()
+            bucket['tokens'] += estimate - consumed
+            if consumed:
+                bucket['estimate'] = 0.8 * bucket['estimate'] + 0.2 * consumed
+                bucket['consumed'] += consumed
+                bucket['history'].append((now, consumed))
+            # Only the last window seconds are kept, whether or not stats
+            # is ever called
+            self._trim_history(bucket, now)
+            bucket['calls'] += 1
+            self._cond.notify_all()
+            publish = (self.publish_interval and
+                       now - self._last_publish >= self.publish_interval)
+            if publish:
+                self._last_publish = now
+        if publish:
+            self._publish()
+
+    def stats(self):
+        ''' Return a dict with, for 'read' and 'write', the target
+            capacity, the achieved units per second over the last window
+            seconds, the total units consumed and the number of calls '''
+        now = time.monotonic()
+        stats = {}
+        with self._cond:
+            for kind, bucket in self._buckets.items():
+                self._trim_history(bucket, now)
+                stats[kind] = {
+                    'target': bucket['rate'],
+                    'per_second': sum(c for _, c in bucket['history']) /
+                                  self.window,
+                    'consumed': bucket['consumed'],
+                    'calls': bucket['calls']}
+        return stats
+
+    # Private methods
+    def _refill(self, bucket):
+        now = time.monotonic()
+        if bucket['rate'] is not None:
+            bucket['tokens'] = min(bucket['rate'] * self.burst_seconds,
+                                   bucket['tokens'] + bucket['rate'] *
+                                   (now - bucket['updated']))
+        bucket['updated'] = now
+
+    def _trim_history(self, bucket, now):
+        history = bucket['history']
+        while history and history[0][0] < now - self.window:
+            history.popleft()
+
+    def _publish(self):
+        stats = self.stats()
+        if self.on_publish is not None:
+            self.on_publish(stats)
+            return
+        logging.info(f'DynamoDB capacity per second: '
+                     f'read {stats["read"]["per_second"]:.1f} '
+                     f'(target {stats["read"]["target"]}), '
+                     f'write {stats["write"]["per_second"]:.1f} '
+                     f'(target {stats["write"]["target"]})')
+
+
+def _consumed_units(consumed_capacity):
+    ''' Total CapacityUnits of a ConsumedCapacity dict, or of the list of
+        them that batch calls return '''
+    if not consumed_capacity:
+        return 0.0
+    if isinstance(consumed_capacity, dict):
+        consumed_capacity = [consumed_capacity]
+    return float(sum(c.get('CapacityUnits', 0) for c in consumed_capacity))
+
+
+def _limited_call(limiter, capacity_limiter, kind, func, **kwargs):
+    ''' Call func through the concurrency limiter and, if there is one,
+        the capacity limiter '''
+    if capacity_limiter is None:
+        return limiter.call(func, **kwargs)
+    return capacity_limiter.call(kind, limiter.call, func, **kwargs)
+
+
+################ Data Plane ######################
+class DynamoDBBulkWriter():
+    ''' Write (put or delete) many items to a DynamoDB table quickly
+
+        Items are buffered and sent as batch_write_item requests of 25
+        items (the AWS maximum), several batches at a time on a thread
+        pool. Items that DynamoDB returns as UnprocessedItems are retried
+        with backoff. Concurrency adapts to throttling through an
+        AdaptiveConcurrencyLimiter.
+        A batch must not hold two writes for the same key, so a later
+        put or delete of a key replaces an earlier one still in the
+        buffer (last write wins, as it would with put_item). Writes of a
+        key that has already been sent are applied in order too: a batch
+        holding a key that an earlier batch is still writing (including
+        retries of its unprocessed items) waits for that batch to finish.
+
+        Use it as a context manager so the last items are always flushed:
+            with DynamoDBBulkWriter('my_table') as writer:
+                for item in items:
+                    writer.put(item)
+            print(writer.stats())
+    '''
+    def __init__(self, table_name, key_names=None,
+                 max_workers=aws_dynamodb_settings.DYNAMODB_MAX_WORKERS,
+                 max_retries=
+                        aws_dynamodb_settings.DYNAMODB_UNPROCESSED_MAX_RETRIES,
+                 limiter=None, marshaller=None, cache=None,
+                 capacity_limiter=None,
+                 aws_region=aws_settings.AWS_DEFAULT_REGION):
+        ''' Arguments:
+                - table_name: Table to write to
+                - key_names: Names of the key attributes (partition key and
+                             optional sort key). Looked up with
+                             describe_table if not given
+                - max_workers: Number of batches written at a time
+                - max_retries: Times unprocessed items are retried
+                - limiter: An AdaptiveConcurrencyLimiter. Pass one to share
+                           it with other writers of the same table
+                - marshaller: A DynamoDBMarshaller for the table. Items
+                              are converted with TypeSerializer otherwise
+                - cache: A DynamoDBItemCache. Written keys are invalidated
+                         in it when queued and again once written
+                - capacity_limiter: An optional DynamoDBCapacityLimiter
+                - aws_region: Note: Only AWS_DEFAULT_REGION is implemented
+        '''
+        # If a region other than default region is specified, raise an error
+        if aws_region != aws_settings.AWS_DEFAULT_REGION:
+            raise aws_exceptions.AWS_RegionNotImplemented
+        if key_names is None:
+            key_names = get_key_names(table_name)
+        self.table_name = table_name
+        self.cache = cache
+        self.capacity_limiter = capacity_limiter
+        self.key_names = tuple(key_names)
+        self.max_retries = max_retries
+        self.limiter = (limiter if limiter is not None else
+                        aws_concurrency_utils.AdaptiveConcurrencyLimiter(
+                                initial_limit=max_workers))
+        self.failed = []
+        self._dyndb_client = aws_client_utils.get_client('dynamodb')
+        self._marshaller = (marshaller if marshaller is not None else
+                            DynamoDBMarshaller())
+        self._lock = threading.Lock()
+        # Key -> write request. A dict, so a key is in a batch only once
+        self._buffer = {}
+        self._futures = set()
+        # Keys of the batches being written
+        self._in_flight = set()
+        self._batch_finished = threading.Condition(self._lock)
+        self._slots = threading.BoundedSemaphore(2 * max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._counters = {'written': 0, 'deduplicated': 0, 'batches': 0,
+                          'unprocessed_retries': 0}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def put(self, item):
+        ''' Queue a put of item (a dict of python values) '''
+        request = {'PutRequest': {'Item': self._marshaller.serialize(item)}}
+        self._add(self._key_of(item), request)
+
+    def delete(self, key):
+        ''' Queue a delete of the item with key (a dict of the key
+            attributes) '''
+        key = {k: key[k] for k in self.key_names}
+        request = {'DeleteRequest': {'Key': self._marshaller.serialize(key)}}
+        self._add(self._key_of(key), request)
+
+    def flush(self):
+        ''' Send everything buffered and wait for all batches to finish '''
+        with self._lock:
+            batch = dict(self._buffer)
+            self._buffer.clear()
+        if batch:
+            self._submit(batch)
+        wait(list(self._futures))
+
+    def close(self):
+        ''' Flush and shut down. Returns stats() '''
+        self.flush()
+        self._executor.shutdown(wait=True)
+        stats = self.stats()
+        logging.info(f'Bulk write to {self.table_name}: {stats["written"]} '
+                     f'written, {stats["failed"]} failed')
+        return stats
+
+    def stats(self):
+        ''' Return a dict with the number of items written and failed,
+            duplicates dropped, batches sent and unprocessed item retries '''
+        with self._lock:
+            stats = dict(self._counters)
+            stats['failed'] = len(self.failed)
+        return stats
+
+    # Private methods
+    def _key_of(self, item):
+        try:
+            return tuple(item[k] for k in self.key_names)
+        except KeyError as e:
+            raise ValueError(f'Item is missing key attribute {e}') from None
+
+    def _add(self, key, request):
+        if self.cache is not None:
+            self.cache.invalidate(self.table_name, key)
+        with self._lock:
+            if key in self._buffer:
+                self._counters['deduplicated'] += 1
+            self._buffer[key] = request
+            if (len(self._buffer) <
+                    aws_dynamodb_settings.DYNAMODB_BATCH_WRITE_MAX_ITEMS):
+                return
+            batch = dict(self._buffer)
+            self._buffer.clear()
+        self._submit(batch)
+
+    def _submit(self, batch):
+        ''' Hand a batch (a dict of key -> write request) to the pool.
+            Blocks while too many are queued, and while an earlier batch
+            is still writing one of its keys '''
+        with self._batch_finished:
+            while not self._in_flight.isdisjoint(batch):
+                self._batch_finished.wait()
+            self._in_flight.update(batch)
+        self._slots.acquire()
+        future = self._executor.submit(self._write_batch, batch)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(lambda f: self._batch_done(f, batch))
+
+    def _batch_done(self, future, batch):
+        with self._batch_finished:
+            self._futures.discard(future)
+            self._in_flight.difference_update(batch)
+            self._batch_finished.notify_all()
+        self._slots.release()
+
+    def _write_batch(self, batch):
+        ''' Write one batch, retrying unprocessed items '''
+        try:
+            self._write_requests(list(batch.values()))
+        finally:
+            # A read since the key was queued may have cached the old item
+            if self.cache is not None:
+                for key in batch:
+                    self.cache.invalidate(self.table_name, key)
+
+    def _write_requests(self, requests):
+        for attempt in range(self.max_retries + 1):
+            try:
+                resp = _limited_call(
+                                self.limiter, self.capacity_limiter, 'write',
+                                self._dyndb_client.batch_write_item,
+                                RequestItems={self.table_name: requests})
+            except (ClientError, BotoCoreError) as e:
+                logging.error(f'batch_write_item to {self.table_name} '
+                              f'failed: {e}')
+                break
+            unprocessed = resp.get('UnprocessedItems', {}).get(
+                                                        self.table_name, [])
+            with self._lock:
+                self._counters['batches'] += 1
+                self._counters['written'] += len(requests) - len(unprocessed)
+            if not unprocessed:
+                return
+            requests = unprocessed
+            if attempt < self.max_retries:
+                # Unprocessed items are DynamoDB's way of throttling
+                with self._lock:
+                    self._counters['unprocessed_retries'] += 1
+                self.limiter.on_throttle()
+                self.limiter.backoff(attempt)
+        logging.error(f'Giving up on {len(requests)} items for '
+                      f'{self.table_name}')
+        with self._lock:
+            self.failed.extend(requests)
+
+
+def batch_get_items(table_name, keys, projection=None, consistent_read=False,
+                    as_dict=False, key_names=None,
+                    max_workers=aws_dynamodb_settings.DYNAMODB_MAX_WORKERS,
+                    max_retries=
+                        aws_dynamodb_settings.DYNAMODB_UNPROCESSED_MAX_RETRIES,
+                    limiter=None, marshaller=None, capacity_limiter=None,
+                    aws_region=aws_settings.AWS_DEFAULT_REGION):
+    ''' Get many items from a DynamoDB table by key
+
+        The keys are split into batch_get_item requests of 100 keys (the
+        AWS maximum) that are issued concurrently. UnprocessedKeys are
+        retried with backoff. Duplicate keys are fetched only once.
+        Keys are converted by the marshaller the way items are, so a
+        float key value finds the item with that number (0.1 and
+        Decimal('0.1') are the same key).
+
+        Arguments:
+            - table_name: Table to read from
+            - keys: Iterable of keys, each a dict of the key attributes
+            - projection: Optional list of attribute names to return. The
+                          key attributes are always returned
+            - consistent_read: Use strongly consistent reads
+            - as_dict: Return a dict instead of a list. See Returns
+            - key_names: Names of the key attributes. Looked up with
+                         describe_table if not given
+            - max_workers: Number of batch_get_item calls at a time
+            - max_retries: Times unprocessed keys are retried
+            - limiter: An optional shared AdaptiveConcurrencyLimiter
+            - marshaller: An optional DynamoDBMarshaller for the table
+            - capacity_limiter: An optional DynamoDBCapacityLimiter
+            - aws_region: Note: Only AWS_DEFAULT_REGION is implemented
+        Returns:
+            - A list with the item (a dict of python values) for each key,
+              in the order of keys. None for keys without an item
+            - If as_dict, a dict of key -> item with only the items found.
+              The key is the partition key value, or a (partition key,
+              sort key) tuple for tables with a sort key
+        Raises:
+            - aws_exceptions.AWS_API_CallFailed if keys are still
+              unprocessed after max_retries
+    '''
+    # If a region other than default region is specified, raise an error
+    if aws_region != aws_settings.AWS_DEFAULT_REGION:
+        raise aws_exceptions.AWS_RegionNotImplemented
+    if key_names is None:
+        key_names = get_key_names(table_name)
+    if limiter is None:
+        limiter = aws_concurrency_utils.AdaptiveConcurrencyLimiter(
+                                initial_limit=max_workers)
+    if marshaller is None:
+        marshaller = DynamoDBMarshaller()
+    dyndb_client = aws_client_utils.get_client('dynamodb')
+
+    def _key_of(item):
+        key = tuple(item[k] for k in key_names)
+        return key if len(key) > 1 else key[0]
+
+    def _normalized_key_of(key):
+        # Round trip through the marshaller, so the key matches the one
+        # of the returned item
+        key = _floats_to_decimal({k: key[k] for k in key_names})
+        return _key_of(marshaller.deserialize(marshaller.serialize(key)))
+
+    # A key may only appear once in a batch_get_item call
+    requested = [_normalized_key_of(key) for key in keys]
+    unique_keys = list(dict.fromkeys(requested))
+
+    request_params = {'ConsistentRead': consistent_read}
+    if projection:
+        request_params.update(_projection_params(list(key_names) +
+                                                 list(projection)))
+
+    def _get_batch(batch_keys):
+        request = dict(request_params)
+        request['Keys'] = [
+                marshaller.serialize(dict(zip(
+                        key_names, key if len(key_names) > 1 else (key,))))
+                for key in batch_keys]
+        items = []
+        for attempt in range(max_retries + 1):
+            resp = _limited_call(limiter, capacity_limiter, 'read',
+                                 dyndb_client.batch_get_item,
+                                 RequestItems={table_name: request})
+            items.extend(resp.get('Responses', {}).get(table_name, []))
+            unprocessed = resp.get('UnprocessedKeys', {}).get(table_name)
+            if not unprocessed or not unprocessed.get('Keys'):
+                return items
+            request = unprocessed
+            if attempt < max_retries:
+                limiter.on_throttle()
+                limiter.backoff(attempt)
+        logging.error(f'{len(request["Keys"])} keys of {table_name} still '
+                      f'unprocessed after {max_retries} retries')
+        raise aws_exceptions.AWS_API_CallFailed
+
+    batch_size = aws_dynamodb_settings.DYNAMODB_BATCH_GET_MAX_KEYS
+    batches = [unique_keys[i:i + batch_size]
+               for i in range(0, len(unique_keys), batch_size)]
+    found = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for items in executor.map(_get_batch, batches):
+            for item in items:
+                item = marshaller.deserialize(item)
+                found[_key_of(item)] = item
+
+    if as_dict:
+        return found
+    return [found.get(key) for key in requested]
+
+
+def scan_table(table_name, projection=None, columnar=None,
+               total_segments=None,
+               batch_size=aws_dynamodb_settings.DYNAMODB_SCAN_BATCH_SIZE,
+               max_workers=aws_dynamodb_settings.DYNAMODB_MAX_WORKERS,
+               limiter=None, marshaller=None, capacity_limiter=None,
+               aws_region=aws_settings.AWS_DEFAULT_REGION, **scan_kwargs):
+    ''' Scan a whole DynamoDB table with a parallel (segmented) scan
+
+        The table is split in total_segments segments (Segment and
+        TotalSegments of the scan API) that are scanned concurrently by
+        max_workers threads. Results are streamed: only a few pages per
+        worker are held in memory at any time.
+
+        Arguments:
+            - table_name: Table to scan
+            - projection: Optional list of attribute names to return
+            - columnar: None to yield items one by one (dicts of python
+                        values). 'numpy' to yield batches as dicts of
+                        attribute name -> numpy array (needs numpy),
+                        'arrow' to yield batches as pyarrow Tables (needs
+                        pyarrow). Numbers are int64 columns if they are
+                        all integral and fit, float64 otherwise. Binary
+                        values are bytes. Columns with mixed types are
+                        object arrays (numpy) or strings (arrow)
+            - total_segments: Number of segments. Defaults to max_workers
+            - batch_size: Items per columnar batch
+            - max_workers: Number of segments scanned at a time
+            - limiter: An optional shared AdaptiveConcurrencyLimiter
+            - marshaller: An optional DynamoDBMarshaller for the table
+            - capacity_limiter: An optional DynamoDBCapacityLimiter
+            - aws_region: Note: Only AWS_DEFAULT_REGION is implemented
+            - scan_kwargs: Passed on to scan (e.g. FilterExpression and
+                           ExpressionAttributeValues)
+        Yields:
+            - Items or columnar batches, in no particular order. Columns
+              are the projection, or all attributes seen in the batch.
+              Missing values are None (NaN in float columns)
+    '''
+    # If a region other than default region is specified, raise an error
+    if aws_region != aws_settings.AWS_DEFAULT_REGION:
+        raise aws_exceptions.AWS_RegionNotImplemented
+    if columnar not in (None, 'numpy', 'arrow'):
+        raise aws_exceptions.AWS_NotImplementedError(
+                    f'Columnar format {columnar} is not supported')
+    if columnar == 'arrow' and pyarrow is None:
+        raise aws_exceptions.AWS_NotImplementedError(
+                    'Arrow batches need the pyarrow package')
+    if columnar == 'numpy' and np is None:
+        raise aws_exceptions.AWS_NotImplementedError(
+                    'numpy batches need the numpy package')
+    if total_segments is None:
+        total_segments = max_workers
+    if limiter is None:
+        limiter = aws_concurrency_utils.AdaptiveConcurrencyLimiter(
+                                initial_limit=max_workers)
+    if marshaller is None:
+        marshaller = DynamoDBMarshaller()
+    dyndb_client = aws_client_utils.get_client('dynamodb')
+
+    scan_params = dict(scan_kwargs, TableName=table_name,
+                       TotalSegments=total_segments)
+    if projection:
+        proj_params = _projection_params(projection)
+        scan_params['ProjectionExpression'] = \
+                                proj_params['ProjectionExpression']
+        attr_names = dict(scan_kwargs.get('ExpressionAttributeNames', {}))
+        attr_names.update(proj_params['ExpressionAttributeNames'])
+        scan_params['ExpressionAttributeNames'] = attr_names
+
+    def _scan_segment(segment):
+        params = dict(scan_params, Segment=segment)
+        while True:
+            resp = _limited_call(limiter, capacity_limiter, 'read',
+                                 dyndb_client.scan, **params)
+            yield [marshaller.deserialize(item)
+                   for item in resp.get('Items', [])]
+            if 'LastEvaluatedKey' not in resp:
+                return
+            params['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+    pages = aws_concurrency_utils.iter_parallel(
+                    [lambda segment=segment: _scan_segment(segment)
+                     for segment in range(total_segments)], max_workers)
+    if columnar is None:
+        for page in pages:
+            yield from page
+        return
+
+    batch = []
+    for page in pages:
+        batch.extend(page)
+        while len(batch) >= batch_size:
+            yield _to_columns(batch[:batch_size], projection, columnar)
+            del batch[:batch_size]
+    if batch:
+        yield _to_columns(batch, projection, columnar)
+
+
+class DynamoDBItemCache():
+    ''' An in-process, read-through LRU cache of DynamoDB items
+
+        Works like a small local DAX for items that are read far more
+        often than they change (device and config items and the like):
+            - get_item/get_items return cached items while they are
+              fresh and read the misses from DynamoDB
+            - Items that do not exist are cached too (negative caching),
+              for a shorter negative_ttl
+            - Each table can have its own TTL
+            - Writes made through a DynamoDBBulkWriter created with
+              cache=<this cache> invalidate the written keys. Writes made
+              any other way are only seen once the TTL runs out
+        It is thread safe. Returned items are shallow copies.
+
+        Usage:
+            cache = DynamoDBItemCache(table_ttls={'devices': 300})
+            device = cache.get_item('devices', {'device_id': 'cam1'})
+            print(cache.stats())
+    '''
+    def __init__(self,
+                 max_items=aws_dynamodb_settings.DYNAMODB_CACHE_MAX_ITEMS,
+                 ttl=aws_dynamodb_settings.DYNAMODB_CACHE_TTL,
+                 negative_ttl=
+                        aws_dynamodb_settings.DYNAMODB_CACHE_NEGATIVE_TTL,
+                 table_ttls=None, table_key_names=None, marshaller=None,
+                 aws_region=aws_settings.AWS_DEFAULT_REGION):
+        ''' Arguments:
+                - max_items: Items kept before the least recently used are
+                             evicted. Negative entries count too
+                - ttl: Seconds an item is served from the cache
+                - negative_ttl: Seconds a missing item is remembered
+                - table_ttls: Optional dict of table name -> ttl
+                - table_key_names: Optional dict of table name -> key
+                                   attribute names. Looked up with
+                                   describe_table for other tables
+                - marshaller: An optional DynamoDBMarshaller
+                - aws_region: Note: Only AWS_DEFAULT_REGION is implemented
+        '''
+        # If a region other than default region is specified, raise an error
+        if aws_region != aws_settings.AWS_DEFAULT_REGION:
+            raise aws_exceptions.AWS_RegionNotImplemented
+        self.max_items = max_items
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.table_ttls = dict(table_ttls or {})
+        self.aws_region = aws_region
+        self._key_names = {k: tuple(v) for k, v in
+                           (table_key_names or {}).items()}
+        self._marshaller = (marshaller if marshaller is not None else
+                            DynamoDBMarshaller())
+        self._lock = threading.Lock()
+        # (table name, key) -> (expiry time, item or None)
+        self._entries = collections.OrderedDict()
+        self._counters = {'hits': 0, 'negative_hits': 0, 'misses': 0,
+                          'evictions': 0, 'invalidations': 0}
+
+    def get_item(self, table_name, key, consistent_read=False):
+        ''' Return the item with key (a dict of the key attributes) or None
+            if there is no such item '''
+        cache_key = (table_name, self._key_of(table_name, key))
+        found, item = self._lookup(cache_key)
+        if found:
+            return item
+        key_names = self._get_key_names(table_name)
+        dyndb_client = aws_client_utils.get_client('dynamodb')
+        # Floats are sent as Decimals, like batch_get_items does
+        resp = dyndb_client.get_item(
+                    TableName=table_name, ConsistentRead=consistent_read,
+                    Key=self._marshaller.serialize(
+                        _floats_to_decimal({k: key[k] for k in key_names})))
+        item = resp.get('Item')
+        if item is not None:
+            item = self._marshaller.deserialize(item)
+        self._store(cache_key, item)
+        return dict(item) if item is not None else None
+
+    def get_items(self, table_name, keys, **batch_get_kwargs):
+        ''' Like get_item for many keys. Misses are read with
+            batch_get_items (batch_get_kwargs are passed on, except
+            as_dict, which is not supported, and key_names, which must
+            be the key names of the table).
+            Returns a list of items (None if missing) in the order of keys '''
+        if batch_get_kwargs.pop('as_dict', False):
+            raise ValueError('get_items does not support as_dict. It '
+                             'always returns a list in the order of keys')
+        key_names = self._get_key_names(table_name)
+        if tuple(batch_get_kwargs.pop('key_names', key_names)) != key_names:
+            raise ValueError(f'key_names do not match the key names '
+                             f'{key_names} of {table_name}')
+        keys = list(keys)
+        cache_keys = [(table_name, self._key_of(table_name, key))
+                      for key in keys]
+        results = {}
+        missing = {}
+        for key, cache_key in zip(keys, cache_keys):
+            found, item = self._lookup(cache_key)
+            if found:
+                results[cache_key] = item
+            else:
+                missing[cache_key] = key
+        if missing:
+            items = batch_get_items(table_name, list(missing.values()),
+                                    key_names=key_names,
+                                    marshaller=self._marshaller,
+                                    aws_region=self.aws_region,
+                                    **batch_get_kwargs)
+            for cache_key, item in zip(missing, items):
+                self._store(cache_key, item)
+                results[cache_key] = dict(item) if item is not None else None
+        return [results[cache_key] for cache_key in cache_keys]
+
+    def invalidate(self, table_name, key=None):
+        ''' Drop the item with key from the cache. key is a dict of the
+            key attributes or a tuple of their values (partition key
+            first). Without a key, drop all items of the table '''
+        with self._lock:
+            self._counters['invalidations'] += 1
+            if key is None:
+                for cache_key in [k for k in self._entries
+                                  if k[0] == table_name]:
+                    del self._entries[cache_key]
+                return
+        cache_key = (table_name, self._key_of(table_name, key))
+        with self._lock:
+            self._entries.pop(cache_key, None)
+
+    def clear(self):
+        ''' Drop everything '''
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        ''' Return a dict with hit, negative hit, miss, eviction and
+            invalidation counts, the hit ratio and the number of entries '''
+        with self._lock:
+            stats = dict(self._counters)
+            stats['size'] = len(self._entries)
+        lookups = stats['hits'] + stats['negative_hits'] + stats['misses']
+        stats['hit_ratio'] = ((stats['hits'] + stats['negative_hits']) /
+                              lookups if lookups else 0.0)
+        return stats
+
+    # Private methods
+    def _get_key_names(self, table_name):
+        key_names = self._key_names.get(table_name)
+        if key_names is None:
+            key_names = tuple(get_key_names(table_name))
+            self._key_names[table_name] = key_names
+        return key_names
+
+    def _key_of(self, table_name, key):
+        ''' Make a hashable key out of a key dict (or tuple). Floats become
+            Decimals, so 0.1 and Decimal('0.1') are the same key '''
+        if not isinstance(key, tuple):
+            key = tuple(key[k] for k in self._get_key_names(table_name))
+        return tuple(_floats_to_decimal(v) for v in key)
+
+    def _lookup(self, cache_key):
+        ''' Return (True, item) on a hit. (False, None) on a miss '''
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None:
+                expires_at, item = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(cache_key)
+                    if item is None:
+                        self._counters['negative_hits'] += 1
+                        return True, None
+                    self._counters['hits'] += 1
+                    return True, dict(item)
+                del self._entries[cache_key]
+            self._counters['misses'] += 1
+            return False, None
+
+    def _store(self, cache_key, item):
+        if item is None:
+            ttl = self.negative_ttl
+        else:
+            ttl = self.table_ttls.get(cache_key[0], self.ttl)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[cache_key] = (time.monotonic() + ttl, item)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+                self._counters['evictions'] += 1
+
+
+class DynamoDBTimeSeriesTable():
+    ''' A table layout for high rate time series (e.g. device telemetry)
+
+        Keying a table by series (say, camera id) and timestamp puts all
+        writes for a series in one partition, which throttles long before
+        the table does. This layout spreads the writes:
+            - The time is cut into buckets of bucket_seconds
+            - Each bucket of a series is written to num_shards partitions,
+              picked at random for each item
+        The partition key is "<series>#<bucket start>#<shard>" (string)
+        and the sort key is the timestamp (number, seconds since epoch).
+        That is the key schema create_table makes, so create() uses it.
+
+        A query fans out over all buckets and shards in the time range
+        concurrently and merges the results back into time order.
+
+        Note: Two items of a series with the same timestamp that land on
+              the same shard overwrite each other. Use timestamps with
+              enough resolution
+
+        Usage:
+            ts_table = DynamoDBTimeSeriesTable('telemetry')
+            ts_table.create()
+            ts_table.write((cam_id, time.time(), {'temp': 41.5})
+                           for cam_id in cam_ids)
+            for item in ts_table.query(cam_id, start, end):
+                ...
+    '''
+    def __init__(self, table_name,
+                 num_shards=aws_dynamodb_settings.DYNAMODB_TS_NUM_SHARDS,
+                 bucket_seconds=
+                            aws_dynamodb_settings.DYNAMODB_TS_BUCKET_SECONDS,
+                 max_workers=aws_dynamodb_settings.DYNAMODB_MAX_WORKERS,
+                 limiter=None, marshaller=None, capacity_limiter=None,
+                 aws_region=aws_settings.AWS_DEFAULT_REGION):
+        ''' Arguments:
+                - table_name: Name of the table
+                - num_shards: Partitions per series and time bucket. Must
+                              not change once the table holds data
+                - bucket_seconds: Time span of a bucket. Must not change
+                                  once the table holds data
+                - max_workers: Number of concurrent writes/queries
+                - limiter: An optional shared AdaptiveConcurrencyLimiter
+                - marshaller: An optional DynamoDBMarshaller
+                - capacity_limiter: An optional DynamoDBCapacityLimiter
+                - aws_region: Note: Only AWS_DEFAULT_REGION is implemented
+        '''
+        # If a region other than default region is specified, raise an error
+        if aws_region != aws_settings.AWS_DEFAULT_REGION:
+            raise aws_exceptions.AWS_RegionNotImplemented
+        self.table_name = table_name
+        self.num_shards = num_shards
+        self.bucket_seconds = bucket_seconds
+        self.max_workers = max_workers
+        self.aws_region = aws_region
+        self.partition_key = aws_dynamodb_settings.DYNAMODB_TS_PARTITION_KEY
+        self.sort_key = aws_dynamodb_settings.DYNAMODB_TS_SORT_KEY
+        self.table_schema = [
+            {'AttributeName': self.partition_key, 'AttributeType': 'S'},
+            {'AttributeName': self.sort_key, 'AttributeType': 'N'},
+        ]
+        self.limiter = (limiter if limiter is not None else
+                        aws_concurrency_utils.AdaptiveConcurrencyLimiter(
+                                initial_limit=max_workers))
+        self.marshaller = (marshaller if marshaller is not None else
+                           DynamoDBMarshaller(self.table_schema))
+        self.capacity_limiter = capacity_limiter
+
+    def create(self, billing_mode='PAY_PER_REQUEST'):
+        ''' Create the table. Returns what create_table returns '''
+        return create_table(self.table_name, self.table_schema,
+                            self.partition_key, self.sort_key,
+                            billing_mode=billing_mode,
+                            aws_region=self.aws_region)
+
+    def make_item(self, series, timestamp, attributes=None):
+        ''' Return the item to store for a data point of series at
+            timestamp (seconds since epoch), on a random shard.
+            Float attribute values (also nested ones) are converted to
+            Decimal, as boto3 does not accept floats '''
+        shard = random.randrange(self.num_shards)
+        item = _floats_to_decimal(dict(attributes or {}))
+        item[self.partition_key] = self._partition(series, timestamp, shard)
+        item[self.sort_key] = timestamp
+        return item
+
+    def write(self, points):
+        ''' Write many data points with a DynamoDBBulkWriter
+
+            Arguments:
+                - points: Iterable of (series, timestamp, attributes)
+            Returns:
+                - The writer's stats()
+        '''
+        with self.writer() as writer:
+            for series, timestamp, attributes in points:
+                writer.put(self.make_item(series, timestamp, attributes))
+        return writer.stats()
+
+    def writer(self):
+        ''' Return a DynamoDBBulkWriter for items from make_item '''
+        return DynamoDBBulkWriter(self.table_name,
+                                  key_names=(self.partition_key,
+                                             self.sort_key),
+                                  max_workers=self.max_workers,
+                                  limiter=self.limiter,
+                                  marshaller=self.marshaller,
+                                  capacity_limiter=self.capacity_limiter,
+                                  aws_region=self.aws_region)
+
+    def query(self, series, start, end, projection=None, descending=False):
+        ''' Return the items of series with start <= timestamp <= end
+
+            All (bucket, shard) partitions in the range are queried
+            concurrently and the results are merged into time order.
+
+            Arguments:
+                - series: The series to query
+                - start, end: Time range in seconds since epoch (inclusive)
+                - projection: Optional list of attribute names to return.
+                              The timestamp is always returned
+                - descending: Newest first
+            Returns:
+                - A list of items (dicts of python values)
+        '''
+        first_bucket = self._bucket(start)
+        partitions = [self._partition(series, bucket, shard)
+                      for bucket in range(first_bucket, self._bucket(end) + 1,
+                                          self.bucket_seconds)
+                      for shard in range(self.num_shards)]
+        query_params = {
+            'TableName': self.table_name,
+            'KeyConditionExpression': '#pk = :pk AND #ts BETWEEN :s AND :e',
+            'ScanIndexForward': not descending,
+        }
+        attr_names = {'#pk': self.partition_key, '#ts': self.sort_key}
+        if projection:
+            proj_params = _projection_params([self.sort_key] +
+                                             list(projection))
+            query_params['ProjectionExpression'] = \
+                                    proj_params['ProjectionExpression']
+            attr_names.update(proj_params['ExpressionAttributeNames'])
+        query_params['ExpressionAttributeNames'] = attr_names
+        dyndb_client = aws_client_utils.get_client('dynamodb')
+
+        def _query_partition(partition):
+            params = dict(query_params, ExpressionAttributeValues={
+                          ':pk': {'S': partition},
+                          ':s': {'N': _number_to_str(start)},
+                          ':e': {'N': _number_to_str(end)}})
+            items = []
+            while True:
+                resp = _limited_call(self.limiter, self.capacity_limiter,
+                                     'read', dyndb_client.query, **params)
+                items.extend(self.marshaller.deserialize(item)
+                             for item in resp.get('Items', []))
+                if 'LastEvaluatedKey' not in resp:
+                    return items
+                params['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(_query_partition, partitions))
+        # Each partition is already sorted. Merge them
+        return list(heapq.merge(*results, key=lambda x: x[self.sort_key],
+                                reverse=descending))
+
+    # Private methods
+    def _bucket(self, timestamp):
+        ''' Start of the time bucket timestamp is in '''
+        return int(timestamp // self.bucket_seconds * self.bucket_seconds)
+
+    def _partition(self, series, timestamp, shard):
+        return f'{series}#{self._bucket(timestamp)}#{shard}'
+
+
+def query_items(table_name, key_condition, expression_values=None,
+                expression_names=None, filter_expression=None,
+                projection=None, index_name=None, descending=False,
+                consistent_read=False, page_size=None, prefetch=True,
+                limiter=None, marshaller=None, capacity_limiter=None,
+                aws_region=aws_settings.AWS_DEFAULT_REGION):
+    ''' Query a DynamoDB table (or index) and yield the items lazily
+
+        Pages are followed through LastEvaluatedKey. With prefetch, the
+        next page is fetched by a background thread while the caller works
+        on the current one. Closing the generator early stops that thread.
+
+        Arguments:
+            - table_name: Table to query
+            - key_condition: KeyConditionExpression. E.g.
+                             '#pk = :pk AND #sk BETWEEN :lo AND :hi'
+            - expression_values: Dict of placeholder -> python value for
+                                 the key condition and filter. E.g.
+                                 {':pk': 'cam1', ':lo': 0, ':hi': 100}
+            - expression_names: Dict of placeholder -> attribute name.
+                                E.g. {'#pk': 'device_id'}
+            - filter_expression: Optional FilterExpression. It is applied
+                                 by DynamoDB after the key condition
+            - projection: Optional list of attribute names to return
+            - index_name: Query this GSI or LSI instead of the table
+            - descending: Yield items in descending sort key order
+            - consistent_read: Use strongly consistent reads
+            - page_size: Items evaluated per page (Limit of the API)
+            - prefetch: Fetch the next page in the background
+            - limiter: An optional shared AdaptiveConcurrencyLimiter
+            - marshaller: An optional DynamoDBMarshaller for the table
+            - capacity_limiter: An optional DynamoDBCapacityLimiter
+            - aws_region: Note: Only AWS_DEFAULT_REGION is implemented
+        Yields:
+            - Items (dicts of python values)
+    '''
+    # If a region other than default region is specified, raise an error
+    if aws_region != aws_settings.AWS_DEFAULT_REGION:
+        raise aws_exceptions.AWS_RegionNotImplemented
+    pages = _iter_query_pages(table_name, key_condition, expression_values,
+                              expression_names, filter_expression,
+                              projection, index_name, descending,
+                              consistent_read, page_size, limiter,
+                              marshaller, capacity_limiter)
+    # A single background worker keeps a page or two ahead of the caller
+    if prefetch:
+        pages = aws_concurrency_utils.iter_parallel(
+                                    [lambda pages=pages: pages], 1)
+    for page in pages:
+        yield from page
+
+
+def _iter_query_pages(table_name, key_condition, expression_values=None,
+                      expression_names=None, filter_expression=None,
+                      projection=None, index_name=None, descending=False,
+                      consistent_read=False, page_size=None, limiter=None,
+                      marshaller=None, capacity_limiter=None):
+    ''' Yield the pages of a query as lists of items. See query_items '''
+    if limiter is None:
+        limiter = aws_concurrency_utils.AdaptiveConcurrencyLimiter()
+    if marshaller is None:
+        marshaller = DynamoDBMarshaller()
+    dyndb_client = aws_client_utils.get_client('dynamodb')
+
+    params = {'TableName': table_name,
+              'KeyConditionExpression': key_condition,
+              'ScanIndexForward': not descending,
+              'ConsistentRead': consistent_read}
+    attr_names = dict(expression_names or {})
+    if projection:
+        proj_params = _projection_params(projection)
+        params['ProjectionExpression'] = proj_params['ProjectionExpression']
+        attr_names.update(proj_params['ExpressionAttributeNames'])
+    if attr_names:
+        params['ExpressionAttributeNames'] = attr_names
+    if expression_values:
+        params['ExpressionAttributeValues'] = marshaller.serialize(
+                                                        expression_values)
+    if filter_expression:
+        params['FilterExpression'] = filter_expression
+    if index_name:
+        params['IndexName'] = index_name
+    if page_size:
+        params['Limit'] = page_size
+
+    while True:
+        resp = _limited_call(limiter, capacity_limiter, 'read',
+                             dyndb_client.query, **params)
+        yield [marshaller.deserialize(item)
+               for item in resp.get('Items', [])]
+        if 'LastEvaluatedKey' not in resp:
+            return
+        params['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+
+def query_partitions(table_name, partition_key, partition_values,
+                     sort_key_condition=None, expression_values=None,
+                     expression_names=None, merge_key=None,
+                     max_workers=aws_dynamodb_settings.DYNAMODB_MAX_WORKERS,
+                     limiter=None, **query_kwargs):
+    ''' Run the same query on many partitions concurrently
+
+        Arguments:
+            - table_name: Table to query
+            - partition_key: Name of the partition key attribute
+            - partition_values: Partition key values to query
+            - sort_key_condition: Optional condition on the sort key,
+                                  e.g. '#sk > :since'
+            - expression_values, expression_names: For sort_key_condition
+                                  and any filter_expression
+            - merge_key: If given, every partition must come back sorted on
+                         this attribute (normally the sort key) and the
+                         results are merged in that order. The first
+                         pages of all partitions are fetched on a pool of
+                         max_workers threads, and each partition keeps
+                         its next page fetching while the current one is
+                         merged. Without it items are yielded as they
+                         arrive, with max_workers partitions queried at
+                         a time
+            - max_workers: Number of partitions queried at a time
+            - limiter: An optional shared AdaptiveConcurrencyLimiter
+            - query_kwargs: Passed on to query_items (filter_expression,
+                            projection, index_name, descending etc.)
+        Yields:
+            - Items (dicts of python values)
+    '''
+    if limiter is None:
+        limiter = aws_concurrency_utils.AdaptiveConcurrencyLimiter(
+                                initial_limit=max_workers)
+    key_condition = '#pk = :pk'
+    if sort_key_condition:
+        key_condition += ' AND ' + sort_key_condition
+    names = dict(expression_names or {}, **{'#pk': partition_key})
+
+    def _query(value):
+        values = dict(expression_values or {}, **{':pk': value})
+        return query_items(table_name, key_condition, values, names,
+                           limiter=limiter, **query_kwargs)
+
+    if merge_key is not None:
+        query_kwargs.pop('prefetch', None)
+        if (query_kwargs.pop('aws_region', aws_settings.AWS_DEFAULT_REGION)
+                != aws_settings.AWS_DEFAULT_REGION):
+            raise aws_exceptions.AWS_RegionNotImplemented
+        reverse = query_kwargs.get('descending', False)
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        # Partition -> (page generator, future of its next page)
+        partitions = []
+
+        def _fetch(pages):
+            return executor.submit(next, pages, None)
+
+        def _items(index):
+            pages, future = partitions[index]
+            while True:
+                page = future.result()
+                if page is None:
+                    return
+                # Fetch the next page while this one is merged
+                future = _fetch(pages)
+                partitions[index] = pages, future
+                yield from page
+
+        try:
+            for value in partition_values:
+                values = dict(expression_values or {}, **{':pk': value})
+                pages = _iter_query_pages(table_name, key_condition, values,
+                                          names, limiter=limiter,
+                                          **query_kwargs)
+                partitions.append((pages, _fetch(pages)))
+            yield from heapq.merge(*[_items(i)
+                                     for i in range(len(partitions))],
+                                   key=lambda x: x[merge_key],
+                                   reverse=reverse)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+        return
+    # iter_parallel already runs each query in a thread of its own and
+    # keeps it ahead of the caller. A prefetch thread would add nothing
+    query_kwargs['prefetch'] = False
+    yield from aws_concurrency_utils.iter_parallel(
+                    [lambda value=value: _query(value)
+                     for value in partition_values], max_workers)
+
+
+def export_table(table_name, dest, file_format='parquet', partition_by=None,
+                 projection=None,
+                 row_group_size=
+                        aws_dynamodb_settings.DYNAMODB_EXPORT_ROW_GROUP_SIZE,
+                 rows_per_file=
+                        aws_dynamodb_settings.DYNAMODB_EXPORT_ROWS_PER_FILE,
+                 max_open_files=
+                        aws_dynamodb_settings.DYNAMODB_EXPORT_MAX_OPEN_FILES,
+                 max_buffered_rows=
+                    aws_dynamodb_settings.DYNAMODB_EXPORT_MAX_BUFFERED_ROWS,
+                 total_segments=None,
+                 max_workers=aws_dynamodb_settings.DYNAMODB_MAX_WORKERS,
+                 aws_region=aws_settings.AWS_DEFAULT_REGION):
+    ''' Export a whole table to Parquet or Arrow IPC files
+
+        Items are streamed from a parallel scan_table and written out in
+        row groups of row_group_size items. At most max_buffered_rows
+        items are held in memory over all partitions: when there are
+        more, the partition with the most items is written out early.
+        Files are named part-00000.parquet (or .arrow), part-00001...
+        and a new file is started every rows_per_file items. With
+        partition_by the files go into Hive style directories
+        <partition_by>=<value>/, which pandas, pyarrow and Spark read as
+        one partitioned dataset. The partition column is only in the
+        directory names, not in the files. At most max_open_files files
+        are open at a time: when a new partition needs a file, the least
+        recently written one is closed and that partition continues in a
+        new file.
+
+        The schema comes from describe_table for the key attributes and
+        from the items read before the first row group is written for
+        the others:
+            - S is string, B is binary, BOOL is bool
+            - Numbers (N) are int64 if every value seen is integral and
+              fits in 64 bits, float64 otherwise. Later values that do
+              not fit their column (e.g. 1.5 in an int64 column) are
+              exported as null and counted in 'nulled_values'
+            - Sets, lists and maps are stored as JSON strings
+            - Attributes first seen after the first row group are dropped
+              (and reported). Use projection to fix the columns up front
+
+        Arguments:
+            - table_name: Table to export
+            - dest: Local directory, or s3://bucket/prefix. S3 files are
+                    written locally and uploaded in the background
+            - file_format: 'parquet' or 'arrow' (Arrow IPC file)
+            - partition_by: Optional attribute to partition the files by
+            - projection: Optional list of attribute names to export
+            - row_group_size: Items per row group (per record batch for
+                              arrow)
+            - rows_per_file: Items per file (per partition)
+            - max_open_files: Files kept open at a time (partitioned
+                              exports)
+            - max_buffered_rows: Items held in memory over all partitions
+            - total_segments, max_workers: See scan_table
+            - aws_region: Note: Only AWS_DEFAULT_REGION is implemented
+        Returns:
+            - A dict with the 'files' written (paths or S3 keys), the
+              number of 'rows', the 'dropped_columns' and 'nulled_values'
+              (a dict of column name -> number of values exported as
+              null because they did not fit the column type)
+    '''
+    # If a region other than default region is specified, raise an error
+    if aws_region != aws_settings.AWS_DEFAULT_REGION:
+        raise aws_exceptions.AWS_RegionNotImplemented
+    if pyarrow is None:
+        raise aws_exceptions.AWS_NotImplementedError(
+                    'Table exports need the pyarrow package')
+    if file_format not in ('parquet', 'arrow'):
+        raise aws_exceptions.AWS_NotImplementedError(
+                    f'Export format {file_format} is not supported')
+
+    uploader = None
+    if dest.startswith('s3://'):
+        bucket_name, _, prefix = dest[len('s3://'):].partition('/')
+        uploader = s3_utils.S3BackgroundUploader(bucket_name, prefix,
+                                                 delete_local=True,
+                                                 aws_region=aws_region)
+        out_dir = tempfile.mkdtemp(prefix=f'{table_name}-export-')
+    else:
+        out_dir = dest
+        os.makedirs(out_dir, exist_ok=True)
+
+    key_types = {attr['AttributeName']: attr['AttributeType'] for attr in
+                 get_table_metadata(table_name,
+                                    aws_region=aws_region)[
+                                                'AttributeDefinitions']}
+    summary = {'files': [], 'rows': 0, 'dropped_columns': set(),
+               'nulled_values': collections.Counter()}
+    schema = file_schema = None
+    # Partition value -> [writer, file name, rows in the file], least
+    # recently written first
+    writers = collections.OrderedDict()
+    file_number = 0
+
+    def _set_schema(items):
+        nonlocal schema, file_schema
+        schema = file_schema = _infer_arrow_schema(items, key_types,
+                                                   projection)
+        # The partition value is in the directory name
+        if partition_by is not None and partition_by in schema.names:
+            file_schema = schema.remove(schema.get_field_index(partition_by))
+
+    def _close_writer(partition):
+        writer, file_name, _ = writers.pop(partition)
+        writer.close()
+        if uploader is not None:
+            rel_name = os.path.relpath(file_name, out_dir)
+            uploader.submit(file_name, uploader.dest_prefix +
+                            rel_name.replace(os.sep, '/'))
+        else:
+            summary['files'].append(file_name)
+
+    def _write(partition, items):
+        nonlocal file_number
+        entry = writers.get(partition)
+        if entry is None:
+            while len(writers) >= max(max_open_files, 1):
+                _close_writer(next(iter(writers)))
+            part_dir = out_dir
+            if partition_by is not None:
+                part_dir = os.path.join(out_dir, _partition_dir(partition_by,
+                                                                partition))
+                os.makedirs(part_dir, exist_ok=True)
+            file_name = os.path.join(part_dir, f'part-{file_number:05d}.'
+                                               f'{file_format}')
+            file_number += 1
+            if file_format == 'parquet':
+                writer = pyarrow.parquet.ParquetWriter(file_name,
+                                                       file_schema)
+            else:
+                writer = pyarrow.ipc.new_file(file_name, file_schema)
+            entry = writers[partition] = [writer, file_name, 0]
+        else:
+            writers.move_to_end(partition)
+        entry[0].write_table(_to_arrow_table(items, file_schema, schema,
+                                             summary['dropped_columns'],
+                                             summary['nulled_values']))
+        entry[2] += len(items)
+        summary['rows'] += len(items)
+        if entry[2] >= rows_per_file:
+            _close_writer(partition)
+
+    # Partition value -> items not written yet
+    pending = collections.defaultdict(list)
+    num_pending = 0
+
+    def _flush(partition):
+        nonlocal num_pending
+        if schema is None:
+            _set_schema([i for items in pending.values() for i in items])
+        rows = pending.pop(partition)
+        num_pending -= len(rows)
+        _write(partition, rows)
+
+    try:
+        for item in scan_table(table_name, projection=projection,
+                               total_segments=total_segments,
+                               max_workers=max_workers,
+                               aws_region=aws_region):
+            partition = item.get(partition_by) if partition_by else None
+            pending[partition].append(item)
+            num_pending += 1
+            if len(pending[partition]) >= row_group_size:
+                _flush(partition)
+            elif num_pending >= max_buffered_rows:
+                _flush(max(pending, key=lambda p: len(pending[p])))
+        for partition in list(pending):
+            _flush(partition)
+        for partition in list(writers):
+            _close_writer(partition)
+    finally:
+        for writer, _, _ in writers.values():
+            writer.close()
+        if uploader is not None:
+            upload_summary = uploader.close()
+            summary['files'] = sorted(upload_summary['uploaded'])
+            if upload_summary['failed']:
+                logging.error(f'{len(upload_summary["failed"])} export '
+                              f'files failed to upload. They are kept in '
+                              f'{out_dir}')
+            else:
+                shutil.rmtree(out_dir, ignore_errors=True)
+
+    summary['dropped_columns'] = sorted(summary['dropped_columns'])
+    if summary['dropped_columns']:
+        logging.warning(f'Columns not in the export schema were dropped: '
+                        f'{summary["dropped_columns"]}')
+    summary['nulled_values'] = dict(summary['nulled_values'])
+    if summary['nulled_values']:
+        logging.warning(f'Values that did not fit the export schema were '
+                        f'exported as null: {summary["nulled_values"]}')
+    logging.info(f'Exported {summary["rows"]} items of {table_name} to '
+                 f'{len(summary["files"])} files in {dest}')
+    return summary
+
+
+def _partition_dir(partition_by, value):
+    ''' Hive style directory name for a partition value '''
+    if value is None:
+        value = '__HIVE_DEFAULT_PARTITION__'
+    return f'{partition_by}={urllib.parse.quote(str(value), safe="")}'
+
+
+def _infer_arrow_schema(items, key_types, projection=None):
+    ''' Make the export schema. Key attribute types come from the table
+        definition, the others from the first value seen in items.
+        Numbers are int64 if all of their values in items are integral '''
+    attr_types = {'S': pyarrow.string(), 'B': pyarrow.binary()}
+    if projection:
+        names = list(dict.fromkeys(projection))
+    else:
+        names = list(key_types)
+        names.extend(dict.fromkeys(k for item in items for k in item
+                                   if k not in key_types))
+    fields = []
+    for name in names:
+        if name in key_types and key_types[name] != 'N':
+            arrow_type = attr_types[key_types[name]]
+        elif name in key_types:
+            arrow_type = _number_arrow_type(
+                            [item.get(name) for item in items])
+        else:
+            value = next((item[name] for item in items
+                          if item.get(name) is not None), None)
+            if isinstance(value, bool):
+                arrow_type = pyarrow.bool_()
+            elif isinstance(value, (int, float, decimal.Decimal)):
+                arrow_type = _number_arrow_type(
+                                [item.get(name) for item in items])
+            elif isinstance(value, (bytes, bytearray)):
+                arrow_type = pyarrow.binary()
+            else:
+                # Strings, and sets, lists and maps as JSON
+                arrow_type = pyarrow.string()
+        fields.append(pyarrow.field(name, arrow_type))
+    return pyarrow.schema(fields)
+
+
+def _number_arrow_type(values):
+    ''' int64 if all the numbers in values are integral and in the int64
+        range, float64 otherwise '''
+    numbers = [v for v in values if isinstance(v, (int, float,
+               decimal.Decimal)) and not isinstance(v, bool)]
+    if all(_as_int64(v) is not None for v in numbers):
+        return pyarrow.int64()
+    return pyarrow.float64()
+
+
+def _as_int64(value):
+    ''' value as an int if it is integral and fits in an int64, or None '''
+    try:
+        if value != int(value):
+            return None
+    except (ValueError, OverflowError, decimal.InvalidOperation):
+        # NaN and infinity
+        return None
+    value = int(value)
+    return value if -2 ** 63 <= value < 2 ** 63 else None
+
+
+def _to_arrow_table(items, file_schema, schema, dropped_columns,
+                    nulled_values):
+    ''' Convert items to an Arrow table with the columns of file_schema.
+        Names of attributes not in the export schema are added to
+        dropped_columns. Values that do not fit their column are counted
+        per column in nulled_values (a Counter) '''
+    columns = []
+    for field in file_schema:
+        raw_values = [item.get(field.name) for item in items]
+        values = [_to_export_value(v, field.type) for v in raw_values]
+        num_nulled = sum(1 for raw, value in zip(raw_values, values)
+                         if value is None and raw is not None)
+        if num_nulled:
+            nulled_values[field.name] += num_nulled
+        columns.append(pyarrow.array(values, type=field.type))
+    names = set(schema.names)
+    for item in items:
+        dropped_columns.update(k for k in item if k not in names)
+    return pyarrow.Table.from_arrays(columns, schema=file_schema)
+
+
+def _to_export_value(value, arrow_type):
+    ''' Convert a python value for a column of arrow_type. Values that
+        do not fit the column become null '''
+    if value is None:
+        return None
+    if arrow_type == pyarrow.string():
+        if isinstance(value, str):
+            return value
+        return json.dumps(_to_json_value(value), default=str)
+    if arrow_type == pyarrow.int64():
+        if isinstance(value, (int, float, decimal.Decimal)) and \
+                not isinstance(value, bool):
+            return _as_int64(value)
+        return None
+    if arrow_type == pyarrow.float64():
+        if isinstance(value, (int, float, decimal.Decimal)) and \
+                not isinstance(value, bool):
+            return float(value)
+        return None
+    if arrow_type == pyarrow.bool_():
+        return value if isinstance(value, bool) else None
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value)
+    return getattr(value, 'value', None)
+
+
+def _projection_params(attr_names):
+    ''' Make ProjectionExpression and ExpressionAttributeNames for a list
+        of attribute names. Placeholders avoid clashes with reserved words '''
+    attr_names = list(dict.fromkeys(attr_names))
+    return {'ProjectionExpression': ', '.join(
+                                f'#p{i}' for i in range(len(attr_names))),
+            'ExpressionAttributeNames': {f'#p{i}': name for i, name in
+                                         enumerate(attr_names)}}
+
+
+def _to_columns(items, columns, columnar):
+    ''' Turn a list of items into a dict of numpy arrays or an Arrow table '''
+    if not columns:
+        columns = list(dict.fromkeys(k for item in items for k in item))
+    data = {}
+    for name in columns:
+        values = [item.get(name) for item in items]
+        # B attributes not declared in the schema come back as Binary
+        values = [v.value if isinstance(v, Binary) else v for v in values]
+        present = [v for v in values if v is not None]
+        # Numbers come back as Decimal. Use int64 or float64 columns
+        # rather than arrays of Decimal objects
+        if present and all(isinstance(v, decimal.Decimal) for v in present):
+            integral = all(_as_int64(v) is not None for v in present)
+            if columnar == 'arrow':
+                values = pyarrow.array(
+                    [None if v is None else int(v) if integral else float(v)
+                     for v in values],
+                    type=pyarrow.int64() if integral else pyarrow.float64())
+            elif integral and len(present) == len(values):
+                values = np.array([int(v) for v in values], dtype=np.int64)
+            else:
+                values = np.array([np.nan if v is None else float(v)
+                                   for v in values], dtype=np.float64)
+        elif columnar == 'numpy':
+            array = np.empty(len(values), dtype=object)
+            array[:] = values
+            values = array
+        else:
+            try:
+                values = pyarrow.array(values)
+            except (pyarrow.ArrowException, TypeError, ValueError):
+                # Mixed types. Fall back to a string column
+                values = pyarrow.array(
+                    [v if v is None or isinstance(v, str) else
+                     json.dumps(_to_json_value(v), default=str)
+                     for v in values], type=pyarrow.string())
+        data[name] = values
+    if columnar == 'arrow':
+        return pyarrow.table(data)
+    return data
+
+
+def _to_json_value(value):
+    ''' Make a python value JSON serializable: sets become sorted lists,
+        numbers ints or floats and binary values base64 strings '''
+    if isinstance(value, Binary):
+        value = value.value
+    if isinstance(value, (bytes, bytearray)):
+        return base64.b64encode(value).decode('ascii')
+    if isinstance(value, (set, frozenset)):
+        values = [_to_json_value(v) for v in value]
+        try:
+            # DynamoDB sets hold one type. Numbers sort as numbers
+            return sorted(values)
+        except TypeError:
+            return sorted(values, key=str)
+    if isinstance(value, (list, tuple)):
+        return [_to_json_value(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _to_json_value(v) for k, v in value.items()}
+    if isinstance(value, decimal.Decimal):
+        return int(value) if _as_int64(value) is not None else float(value)
+    return value
+
+
  
 if __name__ == '__main__':
 
@@ -200,6 +2009,50 @@ if __name__ == '__main__':
     elif cmd == 's':
         resp = describe_table(table_name)
         print(resp)
+    elif cmd == 'S':
+        resp = describe_all_tables()
+        print(resp)
+    elif cmd == 'b':
+        # Benchmark DynamoDBMarshaller against boto3's TypeSerializer.
+        # Does not need AWS access
+        bench_schema = gg_test1_table_schema + [
+            {'AttributeName': 'name', 'AttributeType': 'S'},
+            {'AttributeName': 'score', 'AttributeType': 'N'},
+            {'AttributeName': 'count', 'AttributeType': 'N'},
+            {'AttributeName': 'active', 'AttributeType': 'BOOL'},
+            {'AttributeName': 'tags', 'AttributeType': 'SS'},
+        ]
+        items = [{'gg_test1_pri': f'pri-{i}', 'gg_test1_sec': i,
+                  'name': f'name-{i}',
+                  'score': decimal.Decimal(f'{i}.25'), 'count': i * 7,
+                  'active': bool(i % 2), 'tags': {'a', 'b'}}
+                 for i in range(100000)]
+        serializer = TypeSerializer()
+        deserializer = TypeDeserializer()
+        marshaller = DynamoDBMarshaller(bench_schema)
+
+        start = time.perf_counter()
+        boto_items = [{k: serializer.serialize(v) for k, v in item.items()}
+                      for item in items]
+        boto_ser = time.perf_counter() - start
+        start = time.perf_counter()
+        fast_items = [marshaller.serialize(item) for item in items]
+        fast_ser = time.perf_counter() - start
+        assert fast_items == boto_items
+
+        start = time.perf_counter()
+        [{k: deserializer.deserialize(v) for k, v in item.items()}
+         for item in boto_items]
+        boto_deser = time.perf_counter() - start
+        start = time.perf_counter()
+        [marshaller.deserialize(item) for item in fast_items]
+        fast_deser = time.perf_counter() - start
+
+        print(f'{len(items)} items. TypeSerializer vs DynamoDBMarshaller')
+        print(f'  serialize:   {boto_ser:.3f}s vs {fast_ser:.3f}s '
+              f'({boto_ser / fast_ser:.1f}x)')
+        print(f'  deserialize: {boto_deser:.3f}s vs {fast_deser:.3f}s '
+              f'({boto_deser / fast_deser:.1f}x)')
     else:
         resp = list_tables()
         print(resp)
@@ -0,0 +1,649 @@
+''' Run various tests on dynamodb_utils '''
+
+import os
+import json
+import decimal
+import time
+import threading
+import pytest
+import numpy as np
+import boto3
+
+from decimal import Decimal
+from botocore.stub import Stubber
+from boto3.dynamodb.types import TypeSerializer
+
+from pylibs.cloud.aws.dynamodb import dynamodb_utils
+
+TEST_TABLE = 'pytest_table'
+OK_METADATA = {'HTTPStatusCode': 200}
+
+
+@pytest.fixture
+def dyndb_stub(monkeypatch):
+    ''' Make dynamodb_utils use a stubbed client and return the stubber '''
+    dyndb_client = boto3.client('dynamodb', region_name='us-west-2',
+                                aws_access_key_id='pytest',
+                                aws_secret_access_key='pytest')
+    monkeypatch.setattr(dynamodb_utils.aws_client_utils, 'get_client',
+                        lambda *args, **kwargs: dyndb_client)
+    with Stubber(dyndb_client) as stubber:
+        yield stubber
+        stubber.assert_no_pending_responses()
+
+
+def _put_request(pk, value):
+    return {'PutRequest': {'Item': {'pk': {'S': pk},
+                                    'value': {'N': str(value)}}}}
+
+
+def test_bulk_writer(dyndb_stub):
+    ''' Test batching, dedup within a batch and unprocessed item retry '''
+    first_batch = [_put_request(f'k{i}', i) for i in range(25)]
+    first_batch[0] = _put_request('k0', 99)
+    dyndb_stub.add_response('batch_write_item',
+                            {'UnprocessedItems':
+                                {TEST_TABLE: first_batch[:2]}},
+                            {'RequestItems': {TEST_TABLE: first_batch}})
+    dyndb_stub.add_response('batch_write_item', {'UnprocessedItems': {}},
+                            {'RequestItems': {TEST_TABLE: first_batch[:2]}})
+    dyndb_stub.add_response('batch_write_item', {'UnprocessedItems': {}},
+                            {'RequestItems':
+                                {TEST_TABLE: [_put_request('k25', 25)]}})
+
+    limiter = dynamodb_utils.aws_concurrency_utils.AdaptiveConcurrencyLimiter(
+                        initial_limit=1, max_limit=1, base_delay=0)
+    with dynamodb_utils.DynamoDBBulkWriter(TEST_TABLE, key_names=['pk'],
+                                           max_workers=1,
+                                           limiter=limiter) as writer:
+        for i in range(24):
+            writer.put({'pk': f'k{i}', 'value': i})
+        # Replaces k0 in the (still unsent) first batch
+        writer.put({'pk': 'k0', 'value': 99})
+        writer.put({'pk': 'k24', 'value': 24})
+        writer.put({'pk': 'k25', 'value': 25})
+    stats = writer.stats()
+    assert stats['written'] == 26
+    assert stats['deduplicated'] == 1
+    assert stats['unprocessed_retries'] == 1
+    assert stats['failed'] == 0
+
+
+
+def test_bulk_writer_orders_writes_of_a_key(dyndb_stub):
+    ''' Test that a batch waits for an earlier batch (and its retries)
+        writing one of its keys '''
+    first_batch = [_put_request(f'k{i}', i) for i in range(25)]
+    dyndb_stub.add_response('batch_write_item',
+                            {'UnprocessedItems':
+                                {TEST_TABLE: first_batch[:1]}},
+                            {'RequestItems': {TEST_TABLE: first_batch}})
+    dyndb_stub.add_response('batch_write_item', {'UnprocessedItems': {}},
+                            {'RequestItems': {TEST_TABLE: first_batch[:1]}})
+    dyndb_stub.add_response('batch_write_item', {'UnprocessedItems': {}},
+                            {'RequestItems':
+                                {TEST_TABLE: [_put_request('k0', 99)]}})
+
+    limiter = dynamodb_utils.aws_concurrency_utils.AdaptiveConcurrencyLimiter(
+                        initial_limit=2, max_limit=2, base_delay=0.05)
+    with dynamodb_utils.DynamoDBBulkWriter(TEST_TABLE, key_names=['pk'],
+                                           max_workers=2,
+                                           limiter=limiter) as writer:
+        for i in range(25):
+            writer.put({'pk': f'k{i}', 'value': i})
+        # k0 is being retried by the first batch
+        writer.put({'pk': 'k0', 'value': 99})
+    stats = writer.stats()
+    assert stats['written'] == 26
+    assert stats['failed'] == 0
+
+
+def test_batch_get_items(dyndb_stub):
+    ''' Test request order, duplicates, projection and unprocessed keys '''
+    projection = {'ProjectionExpression': '#p0, #p1',
+                  'ExpressionAttributeNames': {'#p0': 'pk', '#p1': 'value'},
+                  'ConsistentRead': False}
+    dyndb_stub.add_response('batch_get_item',
+            {'Responses': {TEST_TABLE: [{'pk': {'S': 'b'},
+                                         'value': {'N': '2'}}]},
+             'UnprocessedKeys': {TEST_TABLE: dict(projection,
+                                       Keys=[{'pk': {'S': 'a'}}])}},
+            {'RequestItems': {TEST_TABLE: dict(projection,
+                                Keys=[{'pk': {'S': k}} for k in 'abc'])}})
+    dyndb_stub.add_response('batch_get_item',
+            {'Responses': {TEST_TABLE: [{'pk': {'S': 'a'},
+                                         'value': {'N': '1'}}]}},
+            {'RequestItems': {TEST_TABLE: dict(projection,
+                                Keys=[{'pk': {'S': 'a'}}])}})
+
+    limiter = dynamodb_utils.aws_concurrency_utils.AdaptiveConcurrencyLimiter(
+                        base_delay=0)
+    keys = [{'pk': k} for k in 'abca']
+    items = dynamodb_utils.batch_get_items(TEST_TABLE, keys,
+                                           projection=['value'],
+                                           key_names=['pk'], limiter=limiter)
+    assert items == [{'pk': 'a', 'value': 1}, {'pk': 'b', 'value': 2},
+                     None, {'pk': 'a', 'value': 1}]
+
+
+
+def test_batch_get_items_float_keys(dyndb_stub):
+    ''' Test that float key values match the items returned '''
+    dyndb_stub.add_response('batch_get_item',
+            {'Responses': {TEST_TABLE: [{'pk': {'N': '0.1'},
+                                         'value': {'N': '2'}}]}},
+            {'RequestItems': {TEST_TABLE: {'Keys': [{'pk': {'N': '0.1'}}],
+                                           'ConsistentRead': False}}})
+
+    items = dynamodb_utils.batch_get_items(TEST_TABLE,
+                                           [{'pk': 0.1},
+                                            {'pk': Decimal('0.1')}],
+                                           key_names=['pk'])
+    assert items == [{'pk': Decimal('0.1'), 'value': 2}] * 2
+
+
+def test_scan_table_numpy(dyndb_stub):
+    ''' Test that segments are paginated and merged into numpy columns '''
+    projection = {'ProjectionExpression': '#p0, #p1',
+                  'ExpressionAttributeNames': {'#p0': 'pk', '#p1': 'value'}}
+    page_key = {'pk': {'S': 'a'}}
+    dyndb_stub.add_response('scan',
+            {'Items': [{'pk': {'S': 'a'}, 'value': {'N': '1.5'}}],
+             'LastEvaluatedKey': page_key},
+            dict(projection, TableName=TEST_TABLE, Segment=0,
+                 TotalSegments=1))
+    dyndb_stub.add_response('scan',
+            {'Items': [{'pk': {'S': 'b'}}]},
+            dict(projection, TableName=TEST_TABLE, Segment=0,
+                 TotalSegments=1, ExclusiveStartKey=page_key))
+
+    batches = list(dynamodb_utils.scan_table(TEST_TABLE, ['pk', 'value'],
+                                             columnar='numpy',
+                                             total_segments=1,
+                                             max_workers=1))
+    assert len(batches) == 1
+    assert list(batches[0]['pk']) == ['a', 'b']
+    assert batches[0]['value'].dtype == np.float64
+    assert batches[0]['value'][0] == 1.5
+    assert np.isnan(batches[0]['value'][1])
+
+
+
+def test_scan_table_columns_types(dyndb_stub):
+    ''' Test Binary, mixed type and out of int64 range columns '''
+    pyarrow = pytest.importorskip('pyarrow')
+    items = [{'pk': {'S': 'a'}, 'blob': {'B': b'x'}, 'mixed': {'N': '1'},
+              'big': {'N': '1' + '0' * 20}, 'n': {'N': '2'}},
+             {'pk': {'S': 'b'}, 'blob': {'B': b'y'}, 'mixed': {'S': 'z'},
+              'big': {'N': '3'}}]
+    for _ in range(2):
+        dyndb_stub.add_response('scan', {'Items': items},
+                                {'TableName': TEST_TABLE, 'Segment': 0,
+                                 'TotalSegments': 1})
+
+    batch = next(dynamodb_utils.scan_table(TEST_TABLE, columnar='numpy',
+                                           total_segments=1, max_workers=1))
+    assert list(batch['blob']) == [b'x', b'y']
+    assert list(batch['mixed']) == [Decimal(1), 'z']
+    assert batch['big'].dtype == np.float64
+    assert batch['n'].dtype == np.float64
+
+    table = next(dynamodb_utils.scan_table(TEST_TABLE, columnar='arrow',
+                                           total_segments=1, max_workers=1))
+    assert table.column('blob').type == pyarrow.binary()
+    assert table.column('blob').to_pylist() == [b'x', b'y']
+    assert table.column('mixed').to_pylist() == ['1', 'z']
+    assert table.column('big').type == pyarrow.float64()
+    assert table.column('n').type == pyarrow.int64()
+    assert table.column('n').to_pylist() == [2, None]
+
+
+def test_marshaller_matches_type_serializer():
+    ''' Test that declared and undeclared attributes convert like boto3 '''
+    schema = [{'AttributeName': 'pk', 'AttributeType': 'S'},
+              {'AttributeName': 'n', 'AttributeType': 'N'},
+              {'AttributeName': 'ns', 'AttributeType': 'NS'}]
+    item = {'pk': 'a', 'n': Decimal('1.5'), 'ns': {Decimal(1)},
+            'other': {'x': [1, 'y']}, 'missing': None}
+    marshaller = dynamodb_utils.DynamoDBMarshaller(schema)
+    serializer = TypeSerializer()
+    av_item = marshaller.serialize(item)
+    assert av_item == {k: serializer.serialize(v) for k, v in item.items()}
+    assert marshaller.deserialize(av_item) == item
+
+    # Floats are accepted and 'native' numbers come back as int or float
+    native = dynamodb_utils.DynamoDBMarshaller(schema, number_type='native')
+    assert native.serialize({'n': 0.1}) == {'n': {'N': '0.1'}}
+    assert native.deserialize({'n': {'N': '7'}, 'pk': {'NULL': True}}) == \
+        {'n': 7, 'pk': None}
+
+
+def test_time_series_query_merges_shards(dyndb_stub):
+    ''' Test fan out over buckets and shards and the time ordered merge '''
+    ts_table = dynamodb_utils.DynamoDBTimeSeriesTable(
+                        TEST_TABLE, num_shards=2, bucket_seconds=100,
+                        max_workers=1)
+    item = ts_table.make_item('cam1', 123.5, {'temp': 40})
+    assert item['pk'] in ('cam1#100#0', 'cam1#100#1')
+
+    partition_items = {'cam1#100#0': ['160.5', '190'],
+                       'cam1#100#1': ['170.25'],
+                       'cam1#200#0': [], 'cam1#200#1': ['210', '240.75']}
+    for partition, timestamps in partition_items.items():
+        dyndb_stub.add_response('query',
+            {'Items': [{'pk': {'S': partition}, 'ts': {'N': t}}
+                       for t in timestamps]},
+            {'TableName': TEST_TABLE,
+             'KeyConditionExpression': '#pk = :pk AND #ts BETWEEN :s AND :e',
+             'ScanIndexForward': True,
+             'ExpressionAttributeNames': {'#pk': 'pk', '#ts': 'ts'},
+             'ExpressionAttributeValues': {':pk': {'S': partition},
+                                           ':s': {'N': '150.5'},
+                                           ':e': {'N': '250.25'}}})
+    items = ts_table.query('cam1', 150.5, 250.25)
+    assert [float(item['ts']) for item in items] == \
+        [160.5, 170.25, 190, 210, 240.75]
+
+
+def test_time_series_write_floats(dyndb_stub):
+    ''' Test that float timestamps and attributes can be written '''
+    ts_table = dynamodb_utils.DynamoDBTimeSeriesTable(
+                        TEST_TABLE, num_shards=1, bucket_seconds=100,
+                        max_workers=1)
+    dyndb_stub.add_response('batch_write_item', {'UnprocessedItems': {}},
+            {'RequestItems': {TEST_TABLE: [{'PutRequest': {'Item': {
+                'temp': {'N': '41.5'},
+                'readings': {'L': [{'N': '0.1'}]},
+                'pk': {'S': 'cam1#100#0'}, 'ts': {'N': '123.25'}}}}]}})
+    stats = ts_table.write([('cam1', 123.25, {'temp': 41.5,
+                                              'readings': [0.1]})])
+    assert stats['written'] == 1
+
+
+def test_item_cache(dyndb_stub):
+    ''' Test hits, negative caching and invalidation by the bulk writer '''
+    cache = dynamodb_utils.DynamoDBItemCache(
+                        table_key_names={TEST_TABLE: ['pk']})
+    dyndb_stub.add_response('get_item',
+            {'Item': {'pk': {'S': 'a'}, 'value': {'N': '1'}}},
+            {'TableName': TEST_TABLE, 'Key': {'pk': {'S': 'a'}},
+             'ConsistentRead': False})
+    dyndb_stub.add_response('get_item', {},
+            {'TableName': TEST_TABLE, 'Key': {'pk': {'S': 'b'}},
+             'ConsistentRead': False})
+    for _ in range(2):
+        assert cache.get_item(TEST_TABLE, {'pk': 'a'}) == {'pk': 'a',
+                                                           'value': 1}
+        assert cache.get_item(TEST_TABLE, {'pk': 'b'}) is None
+    stats = cache.stats()
+    assert (stats['hits'], stats['negative_hits'], stats['misses']) == \
+        (1, 1, 2)
+
+    dyndb_stub.add_response('batch_write_item', {'UnprocessedItems': {}},
+            {'RequestItems': {TEST_TABLE: [_put_request('a', 2)]}})
+    with dynamodb_utils.DynamoDBBulkWriter(TEST_TABLE, key_names=['pk'],
+                                           cache=cache) as writer:
+        writer.put({'pk': 'a', 'value': 2})
+    dyndb_stub.add_response('get_item',
+            {'Item': {'pk': {'S': 'a'}, 'value': {'N': '2'}}},
+            {'TableName': TEST_TABLE, 'Key': {'pk': {'S': 'a'}},
+             'ConsistentRead': False})
+    assert cache.get_item(TEST_TABLE, {'pk': 'a'})['value'] == 2
+
+
+def test_item_cache_get_items(dyndb_stub):
+    ''' Test that get_items returns a list, and rejects arguments that
+        would break the matching of items to keys '''
+    cache = dynamodb_utils.DynamoDBItemCache(
+                        table_key_names={TEST_TABLE: ['pk']})
+    dyndb_stub.add_response('batch_get_item',
+            {'Responses': {TEST_TABLE: [{'pk': {'S': 'b'}}]}},
+            {'RequestItems': {TEST_TABLE: {'Keys': [{'pk': {'S': 'a'}},
+                                                    {'pk': {'S': 'b'}}],
+                                           'ConsistentRead': True}}})
+    items = cache.get_items(TEST_TABLE, [{'pk': 'a'}, {'pk': 'b'}],
+                            consistent_read=True, key_names=['pk'],
+                            as_dict=False)
+    assert items == [None, {'pk': 'b'}]
+
+    with pytest.raises(ValueError):
+        cache.get_items(TEST_TABLE, [{'pk': 'c'}], as_dict=True)
+    with pytest.raises(ValueError):
+        cache.get_items(TEST_TABLE, [{'pk': 'c'}], key_names=['other'])
+
+
+def test_item_cache_float_keys(dyndb_stub):
+    ''' Test that float keys are sent as numbers and share their cache
+        entry with the matching Decimal key '''
+    cache = dynamodb_utils.DynamoDBItemCache(
+                        table_key_names={TEST_TABLE: ['pk']})
+    dyndb_stub.add_response('get_item',
+            {'Item': {'pk': {'N': '0.1'}, 'value': {'N': '1'}}},
+            {'TableName': TEST_TABLE, 'Key': {'pk': {'N': '0.1'}},
+             'ConsistentRead': False})
+    assert cache.get_item(TEST_TABLE, {'pk': 0.1})['value'] == 1
+    assert cache.get_item(TEST_TABLE, {'pk': Decimal('0.1')})['value'] == 1
+    assert cache.get_items(TEST_TABLE, [{'pk': 0.1}])[0]['value'] == 1
+    assert cache.stats()['hits'] == 2
+
+
+def test_query_items_pages_and_pushdown(dyndb_stub):
+    ''' Test pagination with prefetch and the pushed down expressions '''
+    expected = {'TableName': TEST_TABLE,
+                'KeyConditionExpression': '#pk = :pk',
+                'FilterExpression': '#p1 > :min',
+                'ProjectionExpression': '#p0, #p1',
+                'ExpressionAttributeNames': {'#pk': 'pk', '#p0': 'pk',
+                                             '#p1': 'value'},
+                'ExpressionAttributeValues': {':pk': {'S': 'a'},
+                                              ':min': {'N': '1'}},
+                'ScanIndexForward': True, 'ConsistentRead': False}
+    page_key = {'pk': {'S': 'a'}, 'sk': {'N': '1'}}
+    dyndb_stub.add_response('query',
+            {'Items': [{'pk': {'S': 'a'}, 'value': {'N': '2'}}],
+             'LastEvaluatedKey': page_key}, expected)
+    dyndb_stub.add_response('query',
+            {'Items': [{'pk': {'S': 'a'}, 'value': {'N': '3'}}]},
+            dict(expected, ExclusiveStartKey=page_key))
+
+    items = dynamodb_utils.query_items(TEST_TABLE, '#pk = :pk',
+                                       {':pk': 'a', ':min': 1},
+                                       {'#pk': 'pk'},
+                                       filter_expression='#p1 > :min',
+                                       projection=['pk', 'value'])
+    assert [item['value'] for item in items] == [2, 3]
+
+
+def test_query_partitions(dyndb_stub):
+    ''' Test that every partition is queried and the results combined '''
+    for pk in ('a', 'b'):
+        dyndb_stub.add_response('query',
+                {'Items': [{'pk': {'S': pk}, 'sk': {'N': '1'}}]},
+                {'TableName': TEST_TABLE,
+                 'KeyConditionExpression': '#pk = :pk AND #sk > :since',
+                 'ExpressionAttributeNames': {'#pk': 'pk', '#sk': 'sk'},
+                 'ExpressionAttributeValues': {':pk': {'S': pk},
+                                               ':since': {'N': '0'}},
+                 'ScanIndexForward': True, 'ConsistentRead': False})
+    items = dynamodb_utils.query_partitions(TEST_TABLE, 'pk', ['a', 'b'],
+                                            '#sk > :since', {':since': 0},
+                                            {'#sk': 'sk'}, max_workers=1)
+    assert sorted(item['pk'] for item in items) == ['a', 'b']
+
+
+def test_query_partitions_merge_is_concurrent(monkeypatch):
+    ''' Test that merged partitions are fetched concurrently and the
+        items come back in merge_key order '''
+    lock = threading.Lock()
+    running = peak = 0
+
+    def _pages(table_name, key_condition, expression_values, *args,
+               **kwargs):
+        nonlocal running, peak
+        pk = expression_values[':pk']
+        for page in range(2):
+            with lock:
+                running += 1
+                peak = max(peak, running)
+            time.sleep(0.05)
+            with lock:
+                running -= 1
+            yield [{'pk': pk, 'sk': 10 * page + pk}]
+
+    monkeypatch.setattr(dynamodb_utils, '_iter_query_pages', _pages)
+    items = list(dynamodb_utils.query_partitions(TEST_TABLE, 'pk',
+                                                 range(4), merge_key='sk',
+                                                 max_workers=4))
+    assert [item['sk'] for item in items] == [0, 1, 2, 3, 10, 11, 12, 13]
+    assert peak > 1
+
+
+def test_list_tables_paginates_and_metadata_is_cached(dyndb_stub):
+    ''' Test that all pages are listed and describe_table is cached '''
+    dyndb_stub.add_response('list_tables',
+                            {'TableNames': ['tab1', 'tab2'],
+                             'LastEvaluatedTableName': 'tab2',
+                             'ResponseMetadata': OK_METADATA}, {})
+    dyndb_stub.add_response('list_tables', {'TableNames': ['tab3'],
+                                            'ResponseMetadata': OK_METADATA},
+                            {'ExclusiveStartTableName': 'tab2'})
+    assert dynamodb_utils.list_tables() == ['tab1', 'tab2', 'tab3']
+
+    dynamodb_utils.invalidate_table_metadata()
+    dyndb_stub.add_response('describe_table',
+            {'Table': {'TableName': TEST_TABLE,
+                       'KeySchema': [{'AttributeName': 'sk',
+                                      'KeyType': 'RANGE'},
+                                     {'AttributeName': 'pk',
+                                      'KeyType': 'HASH'}]},
+             'ResponseMetadata': OK_METADATA},
+            {'TableName': TEST_TABLE})
+    # Only one describe_table call for both
+    assert dynamodb_utils.get_key_names(TEST_TABLE) == ['pk', 'sk']
+    assert dynamodb_utils.get_table_metadata(TEST_TABLE)['TableName'] == \
+        TEST_TABLE
+    dynamodb_utils.invalidate_table_metadata()
+
+
+def test_export_table_partitioned_parquet(dyndb_stub, tmp_path):
+    ''' Test a partitioned Parquet export with the inferred schema '''
+    pq = pytest.importorskip('pyarrow.parquet')
+    dynamodb_utils.invalidate_table_metadata()
+    dyndb_stub.add_response('describe_table',
+            {'Table': {'TableName': TEST_TABLE,
+                       'AttributeDefinitions': [{'AttributeName': 'pk',
+                                                 'AttributeType': 'S'}]},
+             'ResponseMetadata': OK_METADATA},
+            {'TableName': TEST_TABLE})
+    dyndb_stub.add_response('scan',
+            {'Items': [{'pk': {'S': 'a'}, 'site': {'S': 'x'},
+                        'value': {'N': '1'}, 'count': {'N': '3'},
+                        'tags': {'SS': ['t']}},
+                       {'pk': {'S': 'b'}, 'site': {'S': 'y'},
+                        'value': {'N': '2.5'}, 'count': {'N': '4'}},
+                       {'pk': {'S': 'c'}, 'site': {'S': 'x'}}]},
+            {'TableName': TEST_TABLE, 'Segment': 0, 'TotalSegments': 1})
+
+    summary = dynamodb_utils.export_table(TEST_TABLE, str(tmp_path),
+                                          partition_by='site',
+                                          total_segments=1, max_workers=1)
+    dynamodb_utils.invalidate_table_metadata()
+    assert summary['rows'] == 3
+    assert sorted(os.path.relpath(f, tmp_path) for f in summary['files']) \
+        == [os.path.join('site=x', 'part-00000.parquet'),
+            os.path.join('site=y', 'part-00001.parquet')]
+    # The partition column is only in the directory names
+    part = pq.read_table(str(tmp_path / 'site=x' / 'part-00000.parquet'))
+    assert part.column_names == ['pk', 'value', 'count', 'tags']
+    assert str(part.schema.field('count').type) == 'int64'
+    assert str(part.schema.field('value').type) == 'double'
+
+    table = pq.read_table(str(tmp_path)).sort_by('pk')
+    assert table.column('pk').to_pylist() == ['a', 'b', 'c']
+    assert [str(s) for s in table.column('site').to_pylist()] \
+        == ['x', 'y', 'x']
+    assert table.column('value').to_pylist() == [1.0, 2.5, None]
+    assert table.column('count').to_pylist() == [3, 4, None]
+    assert table.column('tags').to_pylist() == ['["t"]', None, None]
+
+
+def test_export_table_nested_values(dyndb_stub, tmp_path):
+    ''' Test that maps, lists and sets are exported as JSON with numbers
+        as numbers and binary values base64 encoded '''
+    pq = pytest.importorskip('pyarrow.parquet')
+    dynamodb_utils.invalidate_table_metadata()
+    dyndb_stub.add_response('describe_table',
+            {'Table': {'TableName': TEST_TABLE,
+                       'AttributeDefinitions': [{'AttributeName': 'pk',
+                                                 'AttributeType': 'S'}]},
+             'ResponseMetadata': OK_METADATA},
+            {'TableName': TEST_TABLE})
+    dyndb_stub.add_response('scan',
+            {'Items': [{'pk': {'S': 'a'},
+                        'm': {'M': {'x': {'N': '1.5'},
+                                    'l': {'L': [{'N': '2'},
+                                                {'B': b'b'}]}}},
+                        'ns': {'NS': ['10', '3']},
+                        'bs': {'BS': [b'b', b'a']}}]},
+            {'TableName': TEST_TABLE, 'Segment': 0, 'TotalSegments': 1})
+
+    dynamodb_utils.export_table(TEST_TABLE, str(tmp_path), total_segments=1,
+                                max_workers=1)
+    dynamodb_utils.invalidate_table_metadata()
+    row = pq.read_table(str(tmp_path)).to_pylist()[0]
+    assert json.loads(row['m']) == {'x': 1.5, 'l': [2, 'Yg==']}
+    assert json.loads(row['ns']) == [3, 10]
+    assert json.loads(row['bs']) == ['YQ==', 'Yg==']
+
+
+def test_export_table_nulled_values_and_buffer_cap(dyndb_stub, tmp_path):
+    ''' Test that values that do not fit the inferred column are reported
+        and that the largest partition is written when the buffer is full '''
+    pq = pytest.importorskip('pyarrow.parquet')
+    dynamodb_utils.invalidate_table_metadata()
+    dyndb_stub.add_response('describe_table',
+            {'Table': {'TableName': TEST_TABLE,
+                       'AttributeDefinitions': [{'AttributeName': 'pk',
+                                                 'AttributeType': 'S'}]},
+             'ResponseMetadata': OK_METADATA},
+            {'TableName': TEST_TABLE})
+    dyndb_stub.add_response('scan',
+            {'Items': [{'pk': {'S': '1'}, 'site': {'S': 'x'},
+                        'n': {'N': '1'}},
+                       {'pk': {'S': '2'}, 'site': {'S': 'x'},
+                        'n': {'N': '2'}},
+                       {'pk': {'S': '3'}, 'site': {'S': 'y'},
+                        'n': {'N': '3.5'}}]},
+            {'TableName': TEST_TABLE, 'Segment': 0, 'TotalSegments': 1})
+
+    summary = dynamodb_utils.export_table(TEST_TABLE, str(tmp_path),
+                                          partition_by='site',
+                                          max_buffered_rows=2,
+                                          total_segments=1, max_workers=1)
+    dynamodb_utils.invalidate_table_metadata()
+    # The buffer filled up with the two x items, so the schema came from
+    # them and n is an int64 column
+    assert summary['nulled_values'] == {'n': 1}
+    assert sorted(os.path.relpath(f, tmp_path) for f in summary['files']) \
+        == [os.path.join('site=x', 'part-00000.parquet'),
+            os.path.join('site=y', 'part-00001.parquet')]
+    table = pq.read_table(str(tmp_path)).sort_by('pk')
+    assert table.column('n').to_pylist() == [1, 2, None]
+
+
+def test_export_table_max_open_files(dyndb_stub, tmp_path):
+    ''' Test that the least recently written file is closed when the
+        open file limit is reached '''
+    pq = pytest.importorskip('pyarrow.parquet')
+    dynamodb_utils.invalidate_table_metadata()
+    dyndb_stub.add_response('describe_table',
+            {'Table': {'TableName': TEST_TABLE,
+                       'AttributeDefinitions': [{'AttributeName': 'pk',
+                                                 'AttributeType': 'S'}]},
+             'ResponseMetadata': OK_METADATA},
+            {'TableName': TEST_TABLE})
+    dyndb_stub.add_response('scan',
+            {'Items': [{'pk': {'S': str(i)}, 'site': {'S': site}}
+                       for i, site in enumerate('xyxzx')]},
+            {'TableName': TEST_TABLE, 'Segment': 0, 'TotalSegments': 1})
+
+    summary = dynamodb_utils.export_table(TEST_TABLE, str(tmp_path),
+                                          partition_by='site',
+                                          row_group_size=1,
+                                          max_open_files=2,
+                                          total_segments=1, max_workers=1)
+    dynamodb_utils.invalidate_table_metadata()
+    # x, y, x, then z closes y (least recently written), then x again
+    assert sorted(os.path.relpath(f, tmp_path) for f in summary['files']) \
+        == [os.path.join('site=x', 'part-00000.parquet'),
+            os.path.join('site=y', 'part-00001.parquet'),
+            os.path.join('site=z', 'part-00002.parquet')]
+    assert pq.read_table(str(tmp_path)).num_rows == 5
+
+
+def test_capacity_limiter(dyndb_stub):
+    ''' Test that consumed capacity is charged and over use is waited out '''
+    published = []
+    capacity = dynamodb_utils.DynamoDBCapacityLimiter(
+                        write_capacity=100, burst_seconds=0.1,
+                        publish_interval=1e-9, on_publish=published.append)
+    dyndb_stub.add_response('batch_write_item',
+            {'UnprocessedItems': {},
+             'ConsumedCapacity': [{'TableName': TEST_TABLE,
+                                   'CapacityUnits': 12.0}]},
+            {'RequestItems': {TEST_TABLE: [_put_request('a', 1)]},
+             'ReturnConsumedCapacity': 'TOTAL'})
+    with dynamodb_utils.DynamoDBBulkWriter(TEST_TABLE, key_names=['pk'],
+                                           capacity_limiter=capacity) as w:
+        w.put({'pk': 'a', 'value': 1})
+
+    # 12 units used out of a 10 unit bucket. The next call has to wait
+    # for the 2 unit debt (plus its estimate) to be paid back at 100/s
+    start = time.monotonic()
+    capacity.call('write', lambda **kwargs: {})
+    assert time.monotonic() - start >= 0.015
+    stats = capacity.stats()
+    assert stats['write']['consumed'] == 12.0
+    assert stats['write']['calls'] == 2
+    assert stats['read']['calls'] == 0
+    assert published and published[-1]['write']['target'] == 100
+
+
+def test_capacity_limiter_history_is_trimmed():
+    ''' Test that settle keeps only the last window of history '''
+    capacity = dynamodb_utils.DynamoDBCapacityLimiter(window=0.01,
+                                                      publish_interval=0)
+    for _ in range(5):
+        capacity.settle('read', 1, 1)
+    time.sleep(0.02)
+    capacity.settle('read', 1, 1)
+    assert len(capacity._buckets['read']['history']) == 1
+
+
+@pytest.mark.parametrize('attr_type,value', [
+    ('B', 5), ('B', [1, 2]), ('B', 'text'),
+    ('SS', 'abc'), ('SS', {'a': 1}), ('SS', set()), ('SS', {1, 2}),
+    ('NS', {'a': 1}), ('NS', set()),
+    ('BS', {1, 2}), ('BS', set()), ('BS', [b'a']),
+])
+def test_marshaller_mismatched_types_fall_back(attr_type, value):
+    ''' Test that values not of the declared type are not mangled by the
+        fast path, but handled (or rejected) like TypeSerializer does '''
+    schema = [{'AttributeName': 'attr', 'AttributeType': attr_type}]
+    marshaller = dynamodb_utils.DynamoDBMarshaller(schema)
+    try:
+        expected = TypeSerializer().serialize(value)
+    except (TypeError, ValueError) as e:
+        with pytest.raises(type(e)):
+            marshaller.serialize({'attr': value})
+    else:
+        assert marshaller.serialize({'attr': value}) == {'attr': expected}
+
+
+@pytest.mark.parametrize('value', [
+    10**40, -10**38, 1e300, 1e-300, Decimal('1E+126'), Decimal('1E-131'),
+    Decimal('1.' + '1' * 38),
+])
+def test_marshaller_rejects_numbers_out_of_limits(value):
+    ''' Test that numbers DynamoDB cannot store are rejected locally '''
+    schema = [{'AttributeName': 'n', 'AttributeType': 'N'},
+              {'AttributeName': 'ns', 'AttributeType': 'NS'}]
+    marshaller = dynamodb_utils.DynamoDBMarshaller(schema)
+    with pytest.raises(decimal.DecimalException):
+        marshaller.serialize({'n': value})
+    with pytest.raises(decimal.DecimalException):
+        marshaller.serialize({'ns': {value}})
+
+
+@pytest.mark.parametrize('value,expected', [
+    (10**38 - 1, '9' * 38), (10**37, '1' + '0' * 37),
+    (1e124, '1e+124'), (1e125, '1E+125'),
+    (Decimal('9.9999999999999999999999999999999999999E+125'),
+     '9.9999999999999999999999999999999999999E+125'),
+    (Decimal('-1E-130'), '-1E-130'), (0.0, '0.0'),
+])
+def test_marshaller_numbers_at_the_limits(value, expected):
+    ''' Test that numbers at the DynamoDB limits are accepted '''
+    schema = [{'AttributeName': 'n', 'AttributeType': 'N'}]
+    marshaller = dynamodb_utils.DynamoDBMarshaller(schema)
+    assert marshaller.serialize({'n': value}) == {'n': {'N': expected}}
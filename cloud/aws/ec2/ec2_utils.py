@@ -1,6 +1,5 @@
 ''' This lib contains code for working on ec2 instances '''
 
-import boto3
 import pdb
 
 from collections import defaultdict
@@ -8,6 +7,7 @@ from collections import defaultdict
 # Local imports
 from pylibs.cloud.aws.config import aws_settings
 from pylibs.cloud.aws.config import aws_exceptions
+from pylibs.cloud.aws.common import aws_client_utils
 
 
 class ec2_SingleInstance():
@@ -38,8 +38,8 @@ class ec2_SingleInstance():
 
     def _start_session(self):
         ''' Start an ec2 session and store it in clss '''
-        self.ec2_session = boto3.client('ec2',
-                                        region_name=self.aws_default_region)
+        self.ec2_session = aws_client_utils.get_client(
+                                   'ec2', region_name=self.aws_default_region)
 
     # Public methods
     def ec2_launch_instance(self, launch_dict={}):
@@ -102,14 +102,14 @@ def get_all_instances_in_region(params_dict={},
         raise aws_exceptions.AWS_RegionNotImplemented
 
     # Else, query the AWS region and return all found instances
-    ec2_session = boto3.client('ec2',
-                               region_name=aws_settings.AWS_DEFAULT_REGION)
+    ec2_session = aws_client_utils.get_client(
+                          'ec2', region_name=aws_settings.AWS_DEFAULT_REGION)
     response = ec2_session.describe_instances()
     return response
 
 def terminate_instances(instance_id_list):
-    ec2_session = boto3.client('ec2',
-                               region_name=aws_settings.AWS_DEFAULT_REGION)
+    ec2_session = aws_client_utils.get_client(
+                          'ec2', region_name=aws_settings.AWS_DEFAULT_REGION)
     response = ec2_session.terminate_instances(InstanceIds=instance_id_list)
 
 # Create Instance API doc:
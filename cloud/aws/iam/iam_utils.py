@@ -1,7 +1,6 @@
 ''' This defines a bunch of functions that are useful for using AWS Lambda '''
 
 import os
-import boto3
 import logging
 
 # Local imports
@@ -9,6 +8,7 @@ from pylibs.cloud.aws.config import aws_settings
 from pylibs.cloud.aws.config import aws_error_codes
 from pylibs.cloud.aws.config import aws_exceptions
 from pylibs.cloud.aws.common import aws_common_utils
+from pylibs.cloud.aws.common import aws_client_utils
 
 # Constants
 
@@ -33,7 +33,7 @@ def create_role(role_name, trust_policy, path='/', description='',
            - full_response: The full response (minus the response meta data)
     ''' 
     # Connect to IAM
-    iam_client=boto3.client('iam')
+    iam_client=aws_client_utils.get_client('iam')
 
     # Create role
     try:
@@ -82,7 +82,7 @@ def list_roles(path_prefix='/'):
     '''
 
     # Connect to IAM
-    iam_client=boto3.client('iam')
+    iam_client=aws_client_utils.get_client('iam')
 
     resp = iam_client.list_roles(PathPrefix = path_prefix)
 
@@ -116,7 +116,7 @@ def delete_role(role_name):
     '''
 
     # Connect to IAM
-    iam_client=boto3.client('iam')
+    iam_client=aws_client_utils.get_client('iam')
 
     try:
         resp = iam_client.delete_role(RoleName = role_name)
@@ -149,7 +149,7 @@ def get_role_arn(role_name):
             - full_response: being the full response
     '''
     # Connect to IAM and query the role
-    iam_client=boto3.client('iam')
+    iam_client=aws_client_utils.get_client('iam')
     resp = iam_client.get_role(RoleName=role_name) 
 
     # Check if request worked
@@ -180,7 +180,7 @@ def create_policy(policy_name, policy_document, path='/', description=''):
     '''
 
     # Connect to IAM
-    iam_client=boto3.client('iam')
+    iam_client=aws_client_utils.get_client('iam')
 
     try:
         # Now create the policy
@@ -221,7 +221,7 @@ def delete_policy(policy_name):
         return False, resp
 
     # Connect to IAM
-    iam_client=boto3.client('iam')
+    iam_client=aws_client_utils.get_client('iam')
 
     try:
         logging.info(f'Deleting policy ARN: {policy_arn}')
@@ -266,7 +266,7 @@ def list_policies(policy_scope='Local', only_attached=True, path_prefix='/',
                call can handle only upto 100 policies
     '''
     # Connect to IAM
-    iam_client=boto3.client('iam')
+    iam_client=aws_client_utils.get_client('iam')
 
     # Call List policies API
     logging.info('Getting list of policies from AWS')
@@ -347,7 +347,7 @@ def attach_managed_policy_to_role(role_name, policy_name):
     managed_policy_arn = make_managed_policy_arn(policy_name)
 
     # Connect to IAM
-    iam_client=boto3.client('iam')
+    iam_client=aws_client_utils.get_client('iam')
 
     # Attach the policy to the role
     logging.info(f'Attaching policy: {policy_name} to role: {role_name}')
@@ -375,7 +375,7 @@ def detach_managed_policy_from_role(role_name, policy_name):
     managed_policy_arn = make_managed_policy_arn(policy_name)
 
     # Connect to IAM
-    iam_client=boto3.client('iam')
+    iam_client=aws_client_utils.get_client('iam')
 
     # Detach the policy from the role
     logging.info(f'Detaching policy: {policy_name} from role: {role_name}')
@@ -404,7 +404,7 @@ def attach_inline_policy_to_role(role_name, policy_name, policy_document):
     '''
 
     # Connect to IAM
-    iam_client=boto3.client('iam')
+    iam_client=aws_client_utils.get_client('iam')
 
     logging.info(f'Attaching inline policy: {policy_name} to role: {role_name}')
 
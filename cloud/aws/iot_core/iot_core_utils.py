@@ -12,11 +12,11 @@
 
 import sys
 import os
-import boto3
 import time
 import pickle
 
 from pylibs.cloud.aws.config import aws_iot_core_settings
+from pylibs.cloud.aws.common import aws_client_utils
 
 # Constant
 # this stuff needs to be made better. Store in a better location/name
@@ -31,7 +31,7 @@ class aws_iot_thing():
         AWS IoT thing '''
     def __init__(self):
         # Init connection to AWS
-        self.iot_client = boto3.client('iot')
+        self.iot_client = aws_client_utils.get_client('iot')
 
     def create_thing(self, thing_name, thing_type_name, 
                      attributes={}, billing_group_name=None):
@@ -136,7 +136,7 @@ class aws_iot_all_things():
               - The full API call response 
         '''
         # Create a connection
-        client = boto3.client('iot')
+        client = aws_client_utils.get_client('iot')
         # Get the full response to list things
         # Get the list of thing types
         response_full = client.list_things()
@@ -157,7 +157,7 @@ class aws_iot_thing_type():
         an AWS IoT thing type '''
     def __init__(self):
         # Init connection to AWS
-        self.iot_client = boto3.client('iot')
+        self.iot_client = aws_client_utils.get_client('iot')
 
     def create_thing_type(self, thing_type_name, properties={}, tags=[]):
         ''' Method for creating iot thing type 
@@ -0,0 +1,242 @@
+''' asyncio versions of the s3_utils put, get, list and delete operations
+
+    These use aiobotocore, so requests are made from the event loop itself
+    rather than from one thread per request. All requests made through
+    an S3AsyncClient share one semaphore, which bounds the number of
+    requests in flight no matter how many operations are started.
+
+    Usage:
+        async with S3AsyncClient(max_concurrency=512) as s3:
+            codes = await s3.put_objects('my-bucket', [('a.json', b'{}'),
+                                                       ('b.json', b'{}')])
+            async for obj in s3.iter_objects('my-bucket', prefix='a'):
+                print(obj['Key'])
+
+    Cancelling the task that awaits an operation cancels all of the
+    requests it has in flight. Bulk operations consume their input
+    lazily, so only a bounded number of requests (and their data) are
+    queued at any time.
+'''
+
+import asyncio
+import logging
+import itertools
+
+from aiobotocore.session import get_session
+from botocore.config import Config
+from botocore.exceptions import ClientError, BotoCoreError
+
+from pylibs.cloud.aws.config import aws_settings
+from pylibs.cloud.aws.config import aws_s3_settings
+from pylibs.cloud.aws.config import aws_exceptions
+from pylibs.cloud.aws.s3 import s3_utils
+
+
+class S3AsyncClient():
+    ''' An async context manager holding an aiobotocore S3 client and the
+        semaphore that bounds its requests in flight '''
+    def __init__(self,
+                 max_concurrency=aws_s3_settings.S3_ASYNC_MAX_CONCURRENCY,
+                 aws_region=aws_settings.AWS_DEFAULT_REGION):
+        ''' Arguments:
+                - max_concurrency: Max number of requests in flight
+                - aws_region: Note: Only AWS_DEFAULT_REGION is implemented
+        '''
+        # If a region other than default region is specified, raise an error
+        if aws_region != aws_settings.AWS_DEFAULT_REGION:
+            raise aws_exceptions.AWS_RegionNotImplemented
+        self.max_concurrency = max_concurrency
+        self._client_ctx = None
+        self._client = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        # The connection pool is sized to match the semaphore
+        config = Config(max_pool_connections=self.max_concurrency)
+        self._client_ctx = get_session().create_client('s3', config=config)
+        self._client = await self._client_ctx.__aenter__()
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self._client_ctx.__aexit__(exc_type, exc_value, traceback)
+        self._client = None
+
+    # Single object operations
+    async def put_object(self, dest_bucket_name, dest_object_name, src_data):
+        ''' Add an object (given as bytes) to a bucket
+
+            Returns: Success or Failure codes (see s3_utils.put_object)
+        '''
+        try:
+            async with self._semaphore:
+                await self._client.put_object(Bucket=dest_bucket_name,
+                                              Key=dest_object_name,
+                                              Body=src_data)
+        except (ClientError, BotoCoreError) as e:
+            logging.error(e)
+            return aws_s3_settings.S3_PUT_OBJECT_FAIL
+        return aws_s3_settings.S3_PUT_OBJECT_SUCCESS
+
+    async def get_object_bytes(self, src_bucket_name, src_object_name):
+        ''' Get an object into memory
+
+            Returns: The object data as bytes. None on failure
+        '''
+        try:
+            async with self._semaphore:
+                resp = await self._client.get_object(Bucket=src_bucket_name,
+                                                     Key=src_object_name)
+                async with resp['Body'] as stream:
+                    return await stream.read()
+        except (ClientError, BotoCoreError) as e:
+            logging.error(e)
+            return None
+
+    async def iter_objects(self, bucket_name, prefix='', start_after=None,
+                           fields=None):
+        ''' Lazily list the objects in a bucket. An async generator of
+            object dicts. See s3_utils.iter_s3_objects '''
+        paginator = self._client.get_paginator('list_objects_v2')
+        kwargs = {'Bucket': bucket_name, 'Prefix': prefix}
+        if start_after:
+            kwargs['StartAfter'] = start_after
+        pages = paginator.paginate(**kwargs).__aiter__()
+        while True:
+            # Only the page requests count against the semaphore
+            async with self._semaphore:
+                try:
+                    page = await pages.__anext__()
+                except StopAsyncIteration:
+                    return
+            for obj in page.get('Contents', []):
+                if fields is None:
+                    yield obj
+                else:
+                    yield {k: obj[k] for k in fields if k in obj}
+
+    # Bulk operations
+    async def put_objects(self, dest_bucket_name, objects):
+        ''' Add many objects to a bucket concurrently
+
+            Arguments:
+                - dest_bucket_name: obvious what it is
+                - objects: An iterable of (object_name, data) tuples. It
+                           is consumed lazily, so it can be a generator
+            Returns:
+                - A list of Success or Failure codes, in the same order
+        '''
+        return await _map_bounded(
+                        lambda obj: self.put_object(dest_bucket_name, *obj),
+                        objects, 2 * self.max_concurrency)
+
+    async def get_objects(self, src_bucket_name, object_names):
+        ''' Get many objects into memory concurrently
+
+            Returns:
+                - A list of bytes (None for failures), in the same order
+        '''
+        return await _map_bounded(
+                        lambda name: self.get_object_bytes(src_bucket_name,
+                                                           name),
+                        object_names, 2 * self.max_concurrency)
+
+    async def delete_objects(self, bucket_name, object_names,
+                             max_retries=
+                                    aws_s3_settings.S3_TRANSFER_MAX_RETRIES):
+        ''' Delete many objects, batched S3_DELETE_BATCH_SIZE keys at a time
+            into concurrent delete_objects calls. Keys (or whole calls)
+            that fail with a transient error are retried up to
+            max_retries times
+
+            Arguments:
+                - bucket_name: obvious what it is
+                - object_names: An iterable of keys (strings)
+                - max_retries: Number of times failed keys are retried
+            Returns:
+                - num_deleted: Number of keys deleted
+                - errors: A list of dicts (Key, Code, Message) for the keys
+                          that could not be deleted
+        '''
+        # The retry policy is the one of s3_utils.delete_s3_objects
+        async def _delete_batch(batch):
+            pending = [s3_utils._object_identifier(k) for k in batch]
+            failed = []
+            for attempt in range(max_retries + 1):
+                try:
+                    async with self._semaphore:
+                        resp = await self._client.delete_objects(
+                                    Bucket=bucket_name,
+                                    Delete={'Objects': pending,
+                                            'Quiet': True})
+                except (ClientError, BotoCoreError) as e:
+                    if (attempt == max_retries or
+                            not s3_utils._is_retryable(e)):
+                        logging.error(e)
+                        return failed + s3_utils._delete_call_errors(
+                                                            e, pending)
+                    retry = pending
+                else:
+                    retry = s3_utils._split_delete_errors(resp, failed)
+                    if not retry or attempt == max_retries:
+                        return failed + retry
+                    retry = [s3_utils._object_identifier(e) for e in retry]
+                # Retry only the keys that failed with a transient error
+                pending = retry
+                delay = (aws_s3_settings.S3_TRANSFER_RETRY_BASE_DELAY *
+                         2**attempt)
+                logging.warning(f'{len(pending)} keys failed to delete. '
+                                f'Retrying in {delay} seconds')
+                await asyncio.sleep(delay)
+
+        num_requested = 0
+
+        def _batches():
+            nonlocal num_requested
+            iterator = iter(object_names)
+            batch_size = aws_s3_settings.S3_DELETE_BATCH_SIZE
+            while True:
+                batch = list(itertools.islice(iterator, batch_size))
+                if not batch:
+                    return
+                num_requested += len(batch)
+                yield batch
+
+        errors = []
+        for batch_errors in await _map_bounded(_delete_batch, _batches(),
+                                               2 * self.max_concurrency):
+            errors.extend(batch_errors)
+        return num_requested - len(errors), errors
+
+
+async def _map_bounded(func, iterable, max_in_flight):
+    ''' Await func(item) for the items of iterable concurrently and return
+        the results in order. iterable is consumed lazily, so at most
+        max_in_flight tasks exist at any time. If one of them raises (or
+        the caller is cancelled) all others are cancelled before the
+        exception propagates '''
+    results = []
+    # Task -> index of its result
+    in_flight = {}
+
+    async def _wait_for_one():
+        done, _ = await asyncio.wait(in_flight,
+                                     return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            results[in_flight.pop(task)] = task.result()
+
+    try:
+        for item in iterable:
+            if len(in_flight) >= max_in_flight:
+                await _wait_for_one()
+            in_flight[asyncio.ensure_future(func(item))] = len(results)
+            results.append(None)
+        while in_flight:
+            await _wait_for_one()
+    except BaseException:
+        for task in in_flight:
+            task.cancel()
+        # Let the cancelled tasks finish unwinding
+        await asyncio.gather(*in_flight, return_exceptions=True)
+        raise
+    return results
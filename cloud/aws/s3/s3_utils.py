@@ -1,15 +1,36 @@
 ''' This defines a bunch of functions that are useful for using AWS S3 '''
 
+import io
 import os
-import boto3
+import json
+import math
+import fcntl
+import hashlib
+import mmap
+import time
+import itertools
+import threading
+import zlib
+import sqlite3
+import datetime
 import logging
 
-from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from botocore.exceptions import ClientError, BotoCoreError
 
 from pylibs.cloud.aws.config import aws_settings
 from pylibs.cloud.aws.config import aws_s3_settings
 from pylibs.cloud.aws.config import aws_exceptions
 from pylibs.cloud.aws.common import aws_common_utils
+from pylibs.cloud.aws.common import aws_client_utils
+from pylibs.cloud.aws.common import aws_concurrency_utils
+from pylibs.io import file_utils
+
+# zstd compression is optional
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # Constants
 # Below particular format needed by boto3 API
@@ -23,7 +44,12 @@ logging.basicConfig(level=logging.INFO)
  
 ################ Bucket Utils ######################
 def put_object(dest_bucket_name, dest_object_name, src_data, 
-               aws_region=aws_settings.AWS_DEFAULT_REGION):
+               aws_region=aws_settings.AWS_DEFAULT_REGION,
+               multipart_threshold=aws_s3_settings.S3_MULTIPART_THRESHOLD,
+               part_size=aws_s3_settings.S3_MULTIPART_PART_SIZE,
+               max_workers=aws_s3_settings.S3_TRANSFER_MAX_WORKERS,
+               max_retries=aws_s3_settings.S3_TRANSFER_MAX_RETRIES,
+               metadata=None, dedup=False, limiter=None):
     '''Add an object to an Amazon S3 bucket
 
        Arguments:
@@ -31,13 +57,47 @@ def put_object(dest_bucket_name, dest_object_name, src_data,
            - dest_object_name: obvious what it is
            - src_data: The src_data argument must be of type bytes or a 
                        string that references a file specification.
+           - multipart_threshold: Objects larger than this (in bytes) are
+                                  uploaded with put_object_multipart.
+                                  Set to None to always use a single PUT
+           - part_size, max_workers, max_retries: Passed on to
+                                  put_object_multipart. See there
+           - metadata: Optional dict of user metadata for the object
+           - dedup: If True, the upload is skipped when the object in S3
+                    already has the same content. That is checked with a
+                    HEAD against the ETag (single or multipart) and the
+                    SHA256 stored in the metadata by earlier dedup uploads
+           - limiter: An optional AdaptiveConcurrencyLimiter the PUT (or
+                      the parts of a multipart upload) go through
 
-       Returns: Success or Failure codes
+       Returns: Success or Failure codes. S3_PUT_OBJECT_SKIPPED if dedup
+                found the object unchanged
     '''
     # If a region other than default region is specified, raise an error
     if aws_region != aws_settings.AWS_DEFAULT_REGION:
         raise aws_exceptions.AWS_RegionNotImplemented
 
+    src_size = _get_src_size(src_data)
+    if dedup and src_size is not None:
+        etag, sha256 = _compute_checksums(src_data, multipart_threshold,
+                                          part_size)
+        s3_client = aws_client_utils.get_client('s3')
+        if _is_unchanged(s3_client, dest_bucket_name, dest_object_name,
+                         src_size, etag, sha256, limiter=limiter):
+            logging.info(f'{dest_object_name} is unchanged. Skipping upload')
+            return aws_s3_settings.S3_PUT_OBJECT_SKIPPED
+        metadata = dict(metadata or {})
+        metadata[aws_s3_settings.S3_CHECKSUM_METADATA_KEY] = sha256
+
+    # Hand over large objects to the multipart uploader
+    if (multipart_threshold is not None and src_size is not None and
+            src_size > multipart_threshold):
+        return put_object_multipart(dest_bucket_name, dest_object_name,
+                                    src_data, aws_region=aws_region,
+                                    part_size=part_size,
+                                    max_workers=max_workers,
+                                    max_retries=max_retries,
+                                    metadata=metadata, limiter=limiter)
 
     # Construct the object data to be put
     if isinstance(src_data, bytes):
@@ -55,10 +115,17 @@ def put_object(dest_bucket_name, dest_object_name, src_data,
         return aws_s3_settings.S3_PUT_OBJECT_FAIL
 
     # Put the object
-    s3_client = boto3.client('s3')
+    s3_client = aws_client_utils.get_client('s3')
+    extra_args = {'Metadata': metadata} if metadata else {}
+
+    def _put():
+        # A throttled PUT is sent again from the start of the file
+        if not isinstance(object_data, bytes):
+            object_data.seek(0)
+        s3_client.put_object(Bucket=dest_bucket_name, Key=dest_object_name,
+                             Body=object_data, **extra_args)
     try:
-        s3_client.put_object(Bucket=dest_bucket_name, Key=dest_object_name, 
-                             Body=object_data)
+        _call_with_retries(_put, 0, limiter=limiter)
     except ClientError as e:
         # AllAccessDisabled error == bucket not found
         # NoSuchKey or InvalidRequest error==(dest bucket/obj == src bucket/obj)
@@ -70,8 +137,444 @@ def put_object(dest_bucket_name, dest_object_name, src_data,
     return aws_s3_settings.S3_PUT_OBJECT_SUCCESS
 
 
+def put_object_multipart(dest_bucket_name, dest_object_name, src_data,
+                         aws_region=aws_settings.AWS_DEFAULT_REGION,
+                         part_size=aws_s3_settings.S3_MULTIPART_PART_SIZE,
+                         max_workers=aws_s3_settings.S3_TRANSFER_MAX_WORKERS,
+                         max_retries=aws_s3_settings.S3_TRANSFER_MAX_RETRIES,
+                         metadata=None, limiter=None):
+    '''Add an object to an Amazon S3 bucket using a multipart upload
+
+       The source is split into parts of part_size bytes which are uploaded
+       concurrently from a pool of max_workers threads. Each part is read
+       only when its upload starts, so at most max_workers parts are held
+       in memory at any time. A failed part is retried up to max_retries
+       times. If any part still fails, the multipart upload is aborted so
+       no orphaned parts are left (and billed) in the bucket.
+
+       Arguments:
+           - dest_bucket_name: obvious what it is
+           - dest_object_name: obvious what it is
+           - src_data: The src_data argument must be of type bytes or a 
+                       string that references a file specification.
+           - part_size: Size of each part in bytes. Raised if needed to
+                        satisfy the S3 min part size and max part count
+           - max_workers: Number of parts uploaded concurrently
+           - max_retries: Number of times a failed part is retried
+           - metadata: Optional dict of user metadata for the object
+           - limiter: See put_objects for limiter semantics
+
+       Returns: Success or Failure codes
+    '''
+    # If a region other than default region is specified, raise an error
+    if aws_region != aws_settings.AWS_DEFAULT_REGION:
+        raise aws_exceptions.AWS_RegionNotImplemented
+
+    src_size = _get_src_size(src_data)
+    if src_size is None:
+        logging.error('Type of {} for the argument \'src_data\' is '
+                      'not supported.'.format(str(type(src_data))))
+        return aws_s3_settings.S3_PUT_OBJECT_FAIL
+    part_ranges = _make_part_ranges(src_size, part_size)
+    limiter = _make_limiter(limiter, max_workers)
+
+    s3_client = aws_client_utils.get_client('s3')
+    extra_args = {'Metadata': metadata} if metadata else {}
+    try:
+        resp = s3_client.create_multipart_upload(Bucket=dest_bucket_name,
+                                                 Key=dest_object_name,
+                                                 **extra_args)
+    except ClientError as e:
+        logging.error(e)
+        return aws_s3_settings.S3_PUT_OBJECT_FAIL
+    upload_id = resp['UploadId']
+    logging.info(f'Uploading {dest_object_name} ({src_size} bytes) in '
+                 f'{len(part_ranges)} parts')
+
+    def _upload_part(part_number, offset, length):
+        body = _read_src_part(src_data, offset, length)
+        resp = _call_with_retries(s3_client.upload_part, max_retries,
+                                  limiter=limiter, Bucket=dest_bucket_name,
+                                  Key=dest_object_name, UploadId=upload_id,
+                                  PartNumber=part_number, Body=body)
+        return {'PartNumber': part_number, 'ETag': resp['ETag']}
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_upload_part, i + 1, offset, length)
+                       for i, (offset, length) in enumerate(part_ranges)]
+            try:
+                parts = [f.result() for f in futures]
+            except BaseException:
+                # Do not start uploading parts that are still queued
+                for f in futures:
+                    f.cancel()
+                raise
+        s3_client.complete_multipart_upload(
+                              Bucket=dest_bucket_name, Key=dest_object_name,
+                              UploadId=upload_id,
+                              MultipartUpload={'Parts': parts})
+    except (ClientError, BotoCoreError, OSError) as e:
+        logging.error(f'Multipart upload of {dest_object_name} failed. '
+                      f'Aborting upload')
+        logging.error(e)
+        _abort_multipart_upload(s3_client, dest_bucket_name,
+                                dest_object_name, upload_id)
+        return aws_s3_settings.S3_PUT_OBJECT_FAIL
+    except BaseException:
+        # Things like KeyboardInterrupt. Clean up and let it propagate
+        _abort_multipart_upload(s3_client, dest_bucket_name,
+                                dest_object_name, upload_id)
+        raise
+    return aws_s3_settings.S3_PUT_OBJECT_SUCCESS
+
+
+def put_objects(dest_bucket_name, objects, dedup=True,
+                multipart_threshold=aws_s3_settings.S3_MULTIPART_THRESHOLD,
+                part_size=aws_s3_settings.S3_MULTIPART_PART_SIZE,
+                max_workers=aws_s3_settings.S3_TRANSFER_MAX_WORKERS,
+                limiter=None, aws_region=aws_settings.AWS_DEFAULT_REGION):
+    '''Add many objects to an Amazon S3 bucket concurrently
+
+       With dedup (the default) objects whose content is already in S3 are
+       skipped. Local checksums are computed while streaming the source.
+       Keys are grouped by their top level "directory" (the part up to
+       the first '/'). For a group of S3_DEDUP_LISTING_MIN_KEYS or more
+       keys with a common prefix, the remote ETags come from a single
+       listing of that prefix rather than a HEAD per key. A HEAD is then
+       only made when the sizes match but the ETags do not, to check the
+       SHA256 stored in the object metadata. Other keys get a HEAD each,
+       so a batch spread over the bucket never lists the whole bucket.
+
+       Arguments:
+           - dest_bucket_name: obvious what it is
+           - objects: A list of (dest_object_name, src_data) tuples. See
+                      put_object for src_data
+           - dedup: Skip objects that are unchanged in S3
+           - multipart_threshold, part_size: See put_object
+           - max_workers: Number of objects checked/uploaded concurrently
+           - limiter: An optional AdaptiveConcurrencyLimiter. Pass one
+                      to share it with other bulk helpers. By default one
+                      is made that starts at (and is capped by)
+                      max_workers. Throttling (SlowDown, 503) lowers it
+           - aws_region: Note: Only AWS_DEFAULT_REGION is implemented
+
+       Returns:
+           - A dict of dest_object_name: Success, Failure or Skipped code
+    '''
+    # If a region other than default region is specified, raise an error
+    if aws_region != aws_settings.AWS_DEFAULT_REGION:
+        raise aws_exceptions.AWS_RegionNotImplemented
+
+    s3_client = aws_client_utils.get_client('s3')
+    limiter = _make_limiter(limiter, max_workers)
+    # Key -> its entry in a listing, or None if the listing did not have
+    # it. Keys not covered by a listing get a HEAD
+    listed_objs = {}
+    if dedup:
+        for keys in _group_by_top_level(name for name, _ in objects):
+            prefix = os.path.commonprefix(keys)
+            if (not prefix or
+                    len(keys) < aws_s3_settings.S3_DEDUP_LISTING_MIN_KEYS):
+                continue
+            listed_objs.update(dict.fromkeys(keys))
+            keys = set(keys)
+            for page in _iter_list_pages(s3_client, dest_bucket_name, prefix,
+                                         limiter=limiter):
+                listed_objs.update((obj['Key'], obj) for obj in
+                                   page.get('Contents', [])
+                                   if obj['Key'] in keys)
+
+    def _put(item):
+        object_name, src_data = item
+        if not dedup:
+            return put_object(dest_bucket_name, object_name, src_data,
+                              aws_region=aws_region,
+                              multipart_threshold=multipart_threshold,
+                              part_size=part_size, limiter=limiter)
+        src_size = _get_src_size(src_data)
+        if src_size is None:
+            # Let put_object log the error
+            return put_object(dest_bucket_name, object_name, src_data,
+                              aws_region=aws_region)
+        etag, sha256 = _compute_checksums(src_data, multipart_threshold,
+                                          part_size)
+        listed_obj = listed_objs.get(object_name, _NOT_LISTED)
+        if _is_unchanged(s3_client, dest_bucket_name, object_name,
+                         src_size, etag, sha256, listed_obj,
+                         limiter=limiter):
+            return aws_s3_settings.S3_PUT_OBJECT_SKIPPED
+        return put_object(dest_bucket_name, object_name, src_data,
+                          aws_region=aws_region,
+                          multipart_threshold=multipart_threshold,
+                          part_size=part_size, limiter=limiter,
+                          metadata={aws_s3_settings.S3_CHECKSUM_METADATA_KEY:
+                                    sha256})
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for (object_name, _), code in _map_bounded(executor, _put, objects,
+                                                   2 * max_workers):
+            results[object_name] = code
+    num_skipped = sum(1 for c in results.values()
+                      if c == aws_s3_settings.S3_PUT_OBJECT_SKIPPED)
+    logging.info(f'Put {len(results)} objects to {dest_bucket_name}. '
+                 f'{num_skipped} were unchanged')
+    return results
+
+
+def put_object_compressed(
+                dest_bucket_name, dest_object_name, src_data,
+                compression='gzip', compression_level=None,
+                part_size=aws_s3_settings.S3_MULTIPART_PART_SIZE,
+                max_workers=aws_s3_settings.S3_TRANSFER_MAX_WORKERS,
+                max_retries=aws_s3_settings.S3_TRANSFER_MAX_RETRIES,
+                metadata=None, aws_region=aws_settings.AWS_DEFAULT_REGION):
+    '''Compress an object while uploading it to an Amazon S3 bucket
+
+       The source is read and compressed in chunks. Compressed data is cut
+       into parts of part_size bytes that are uploaded as a multipart
+       upload as soon as each part is full, with at most max_workers parts
+       in flight. So neither the source nor the compressed payload is ever
+       held in memory as a whole. If the compressed data fits in a single
+       part it is sent with a plain PUT instead.
+       The object gets a Content-Encoding of gzip or zstd and its
+       uncompressed size in the metadata. get_object and get_object_bytes
+       decompress such objects transparently.
+
+       Arguments:
+           - dest_bucket_name: obvious what it is
+           - dest_object_name: obvious what it is
+           - src_data: The src_data argument must be of type bytes or a 
+                       string that references a file specification.
+           - compression: 'gzip' or 'zstd'. zstd needs the zstandard
+                          package
+           - compression_level: Defaults to S3_COMPRESSION_DEFAULT_LEVELS
+           - part_size, max_workers, max_retries: See put_object_multipart
+           - metadata: Optional dict of user metadata for the object
+
+       Returns: Success or Failure codes
+    '''
+    # If a region other than default region is specified, raise an error
+    if aws_region != aws_settings.AWS_DEFAULT_REGION:
+        raise aws_exceptions.AWS_RegionNotImplemented
+
+    src_size = _get_src_size(src_data)
+    if src_size is None:
+        logging.error('Type of {} for the argument \'src_data\' is '
+                      'not supported.'.format(str(type(src_data))))
+        return aws_s3_settings.S3_PUT_OBJECT_FAIL
+    compressor = _make_compressor(compression, compression_level)
+    metadata = dict(metadata or {})
+    metadata[aws_s3_settings.S3_UNCOMPRESSED_SIZE_METADATA_KEY] = str(src_size)
+    extra_args = {'ContentEncoding': compression, 'Metadata': metadata}
+    part_size = max(part_size, aws_s3_settings.S3_MULTIPART_MIN_PART_SIZE)
+    chunk_size = aws_s3_settings.S3_COMPRESSION_CHUNK_SIZE
+
+    s3_client = aws_client_utils.get_client('s3')
+    upload_id = None
+    parts = []
+    in_flight = set()
+
+    def _upload_part(part_number, body):
+        resp = _call_with_retries(s3_client.upload_part, max_retries,
+                                  Bucket=dest_bucket_name,
+                                  Key=dest_object_name, UploadId=upload_id,
+                                  PartNumber=part_number, Body=body)
+        return {'PartNumber': part_number, 'ETag': resp['ETag']}
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            def _submit_part(body):
+                # Wait for a free slot so only max_workers parts are held
+                if len(in_flight) >= max_workers:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for f in done:
+                        in_flight.remove(f)
+                        parts.append(f.result())
+                in_flight.add(executor.submit(_upload_part,
+                                              len(parts) + len(in_flight) + 1,
+                                              body))
+
+            def _submit_full_parts(buf):
+                nonlocal upload_id
+                while len(buf) > part_size:
+                    # Start the multipart upload with the first part
+                    if upload_id is None:
+                        upload_id = s3_client.create_multipart_upload(
+                                    Bucket=dest_bucket_name,
+                                    Key=dest_object_name,
+                                    **extra_args)['UploadId']
+                    _submit_part(bytes(buf[:part_size]))
+                    del buf[:part_size]
+
+            buf = bytearray()
+            with _open_src(src_data) as fh:
+                for chunk in iter(lambda: fh.read(chunk_size), b''):
+                    buf += compressor.compress(chunk)
+                    _submit_full_parts(buf)
+            buf += compressor.flush()
+            _submit_full_parts(buf)
+
+            if upload_id is None:
+                # Everything fit in one part. No need for multipart
+                s3_client.put_object(Bucket=dest_bucket_name,
+                                     Key=dest_object_name, Body=bytes(buf),
+                                     **extra_args)
+                logging.info(f'Uploaded {dest_object_name}: {src_size} '
+                             f'bytes compressed to {len(buf)}')
+                return aws_s3_settings.S3_PUT_OBJECT_SUCCESS
+            if buf:
+                _submit_part(bytes(buf))
+            for f in in_flight:
+                parts.append(f.result())
+        parts.sort(key=lambda x: x['PartNumber'])
+        s3_client.complete_multipart_upload(
+                              Bucket=dest_bucket_name, Key=dest_object_name,
+                              UploadId=upload_id,
+                              MultipartUpload={'Parts': parts})
+    except (ClientError, BotoCoreError, OSError) as e:
+        logging.error(f'Compressed upload of {dest_object_name} failed')
+        logging.error(e)
+        if upload_id is not None:
+            _abort_multipart_upload(s3_client, dest_bucket_name,
+                                    dest_object_name, upload_id)
+        return aws_s3_settings.S3_PUT_OBJECT_FAIL
+    except BaseException:
+        if upload_id is not None:
+            _abort_multipart_upload(s3_client, dest_bucket_name,
+                                    dest_object_name, upload_id)
+        raise
+    logging.info(f'Uploaded {dest_object_name} in {len(parts)} compressed '
+                 f'parts')
+    return aws_s3_settings.S3_PUT_OBJECT_SUCCESS
+
+
+def get_object(src_bucket_name, src_object_name, dest_file_name,
+               aws_region=aws_settings.AWS_DEFAULT_REGION,
+               part_size=aws_s3_settings.S3_DOWNLOAD_PART_SIZE,
+               max_workers=aws_s3_settings.S3_TRANSFER_MAX_WORKERS,
+               max_retries=aws_s3_settings.S3_TRANSFER_MAX_RETRIES,
+               decompress=True, limiter=None):
+    '''Download an object from an Amazon S3 bucket into a local file
+
+       The object is fetched as concurrent ranged GETs that are streamed
+       straight into a memory-mapped, pre-sized destination file. So the
+       object is never held in memory as a whole. All ranges are requested
+       with If-Match on the ETag so an object that is overwritten during
+       the download is detected rather than silently mixed.
+       The data is written to dest_file_name + '.part' and renamed only
+       once every range has been written.
+       Objects with a gzip or zstd Content-Encoding (e.g. uploaded with
+       put_object_compressed) are decompressed on the fly instead. That
+       is a single stream, as compressed data cannot be split in ranges.
+
+       Arguments:
+           - src_bucket_name: obvious what it is
+           - src_object_name: obvious what it is
+           - dest_file_name: Local file to write the object to
+           - part_size: Size in bytes of each ranged GET
+           - max_workers: Number of ranges fetched concurrently
+           - max_retries: Number of times a failed range is retried
+           - decompress: Decompress gzip/zstd encoded objects. If False
+                         the object is written as stored in S3
+           - limiter: See put_objects for limiter semantics
+
+       Returns: Success or Failure codes
+    '''
+    # If a region other than default region is specified, raise an error
+    if aws_region != aws_settings.AWS_DEFAULT_REGION:
+        raise aws_exceptions.AWS_RegionNotImplemented
+
+    s3_client = aws_client_utils.get_client('s3')
+    try:
+        resp = s3_client.head_object(Bucket=src_bucket_name,
+                                     Key=src_object_name)
+    except ClientError as e:
+        logging.error(e)
+        return aws_s3_settings.S3_GET_OBJECT_FAIL
+    obj_size = resp['ContentLength']
+    obj_etag = resp['ETag']
+
+    encoding = resp.get('ContentEncoding')
+    if decompress and encoding in _COMPRESSIONS:
+        tmp_file_name = dest_file_name + '.part'
+        try:
+            with open(tmp_file_name, 'wb') as fh:
+                _download_decompressed(
+                        s3_client, src_bucket_name, src_object_name,
+                        obj_etag, encoding, fh, max_retries,
+                        limiter=_make_limiter(limiter, max_workers))
+            os.replace(tmp_file_name, dest_file_name)
+        except (ClientError, BotoCoreError, OSError,
+                aws_exceptions.AWS_S3_IncompleteRead,
+                *_DECOMPRESS_ERRORS) as e:
+            logging.error(f'Download of {src_object_name} failed')
+            logging.error(e)
+            _remove_file(tmp_file_name)
+            return aws_s3_settings.S3_GET_OBJECT_FAIL
+        except BaseException:
+            _remove_file(tmp_file_name)
+            raise
+        return aws_s3_settings.S3_GET_OBJECT_SUCCESS
+
+    return _download_to_file(s3_client, src_bucket_name, src_object_name,
+                             obj_size, obj_etag, dest_file_name, part_size,
+                             max_workers, max_retries,
+                             limiter=_make_limiter(limiter, max_workers))
+
+
+def get_object_bytes(src_bucket_name, src_object_name,
+                     aws_region=aws_settings.AWS_DEFAULT_REGION,
+                     part_size=aws_s3_settings.S3_DOWNLOAD_PART_SIZE,
+                     max_workers=aws_s3_settings.S3_TRANSFER_MAX_WORKERS,
+                     max_retries=aws_s3_settings.S3_TRANSFER_MAX_RETRIES,
+                     decompress=True, limiter=None):
+    '''Download an object from an Amazon S3 bucket into memory
+
+       Meant for small objects. Ranges are fetched the same way as in
+       get_object, but into a single pre-sized buffer in memory. gzip and
+       zstd encoded objects are decompressed, as in get_object.
+
+       Arguments: Same as get_object (minus dest_file_name)
+
+       Returns:
+           - A read-only memoryview of the object data. None on failure
+    '''
+    # If a region other than default region is specified, raise an error
+    if aws_region != aws_settings.AWS_DEFAULT_REGION:
+        raise aws_exceptions.AWS_RegionNotImplemented
+
+    s3_client = aws_client_utils.get_client('s3')
+    try:
+        resp = s3_client.head_object(Bucket=src_bucket_name,
+                                     Key=src_object_name)
+        encoding = resp.get('ContentEncoding')
+        if decompress and encoding in _COMPRESSIONS:
+            out_fh = io.BytesIO()
+            _download_decompressed(
+                    s3_client, src_bucket_name, src_object_name,
+                    resp['ETag'], encoding, out_fh, max_retries,
+                    limiter=_make_limiter(limiter, max_workers))
+            return out_fh.getbuffer().toreadonly()
+        obj_data = bytearray(resp['ContentLength'])
+        _download_ranges(s3_client, src_bucket_name, src_object_name,
+                         resp['ETag'], memoryview(obj_data), part_size,
+                         max_workers, max_retries,
+                         limiter=_make_limiter(limiter, max_workers))
+    except (ClientError, BotoCoreError,
+            aws_exceptions.AWS_S3_IncompleteRead, *_DECOMPRESS_ERRORS) as e:
+        logging.error(f'Download of {src_object_name} failed')
+        logging.error(e)
+        return None
+    return memoryview(obj_data).toreadonly()
+
+
 def list_s3_objects(bucket_name, aws_region=aws_settings.AWS_DEFAULT_REGION):
-    ''' List all buckets in requested region
+    ''' List all objects in a bucket
+
+        Note: This builds full lists of all objects. For large buckets use
+              iter_s3_objects or iter_s3_objects_parallel instead
 
         Arguments:
             - bucket_name: List objects in bucket_name
@@ -80,26 +583,141 @@ def list_s3_objects(bucket_name, aws_region=aws_settings.AWS_DEFAULT_REGION):
         Returns:
             - A list of objects
     '''
+    obj_name_list = []
+    obj_full_list = []
+    for obj in iter_s3_objects(bucket_name, fetch_owner=True,
+                               aws_region=aws_region):
+        obj_name_list.append(obj['Key'])
+        obj_full_list.append(obj)
+    return obj_name_list, obj_full_list
+
+
+def iter_s3_objects(bucket_name, prefix='', delimiter=None, start_after=None,
+                    fields=None, fetch_owner=False,
+                    aws_region=aws_settings.AWS_DEFAULT_REGION):
+    ''' Lazily list objects in a bucket
+
+        Objects are yielded one page (of up to 1000 keys) at a time, so
+        memory use does not grow with the size of the bucket.
+
+        Arguments:
+            - bucket_name: List objects in bucket_name
+            - prefix: Only list keys that start with prefix
+            - delimiter: If set (usually '/'), keys that contain the delimiter
+                         after the prefix are rolled up and not listed.
+                         Use list_common_prefixes to get those instead
+            - start_after: Only list keys that sort after this key
+            - fields: An optional list of the object fields to return
+                      (e.g. ['Key', 'Size']). All fields if None
+            - fetch_owner: Include the object owner (as list_objects did)
+            - aws_region: List objects in this region
+                    Note: Currently only the AWS_DEFAULT_REGION is implemented
+        Yields:
+            - A dict per object
+    '''
     # If a region other than default region is specified, raise an error
     if aws_region != aws_settings.AWS_DEFAULT_REGION:
         raise aws_exceptions.AWS_RegionNotImplemented
 
-    obj_name_list = []
-    obj_full_list = []
-    s3_client = boto3.client('s3')
+    s3_client = aws_client_utils.get_client('s3')
+    for page in _iter_list_pages(s3_client, bucket_name, prefix, delimiter,
+                                 start_after, fetch_owner):
+        # Check needed in case there are no objects in bucket
+        for obj in page.get('Contents', []):
+            yield _select_fields(obj, fields)
 
-    # pagination is used in case there are > 1000 objects
-    paginator = s3_client.get_paginator('list_objects')
-    pages = paginator.paginate(Bucket=bucket_name)
 
-    for page in pages:
-        # Check needed in case there are no objects in bucket
-        if 'Contents' in page:
-            for obj in page['Contents']:
-                obj_name_list.append(obj['Key'])
-                obj_full_list.append(obj)
-    return obj_name_list, obj_full_list
-   
+def list_common_prefixes(bucket_name, prefix='', delimiter='/',
+                         aws_region=aws_settings.AWS_DEFAULT_REGION):
+    ''' List the "directories" directly under prefix
+
+        Arguments:
+            - bucket_name: List prefixes in bucket_name
+            - prefix: List the common prefixes under this prefix
+            - delimiter: The "directory" separator
+        Returns:
+            - A list of common prefixes (each ending in delimiter)
+    '''
+    # If a region other than default region is specified, raise an error
+    if aws_region != aws_settings.AWS_DEFAULT_REGION:
+        raise aws_exceptions.AWS_RegionNotImplemented
+
+    s3_client = aws_client_utils.get_client('s3')
+    common_prefixes = []
+    for page in _iter_list_pages(s3_client, bucket_name, prefix, delimiter):
+        common_prefixes.extend(x['Prefix']
+                               for x in page.get('CommonPrefixes', []))
+    return common_prefixes
+
+
+def iter_s3_objects_parallel(
+                    bucket_name, prefix='', split_keys=None, delimiter='/',
+                    fields=None, fetch_owner=False,
+                    max_workers=aws_s3_settings.S3_TRANSFER_MAX_WORKERS,
+                    limiter=None,
+                    aws_region=aws_settings.AWS_DEFAULT_REGION):
+    ''' Lazily list objects in a bucket using several concurrent listings
+
+        The key space under prefix is split into shards that are listed
+        concurrently from a pool of max_workers threads. Shards are either:
+            - The common prefixes directly under prefix (the default), or
+            - The ranges between the caller supplied split_keys. With
+              split_keys=['g', 'p'] the shards are keys <= 'g', keys in
+              ('g', 'p'] and keys > 'p'
+        Shards are listed concurrently, so objects are NOT yielded in key
+        order. Within a shard they are.
+
+        Arguments:
+            - bucket_name: List objects in bucket_name
+            - prefix: Only list keys that start with prefix
+            - split_keys: An optional sorted list of keys to split on
+            - delimiter: Used to find the common prefixes under prefix
+                         when split_keys is not given
+            - fields: An optional list of the object fields to return
+            - fetch_owner: Include the object owner
+            - max_workers: Number of shards listed concurrently
+            - limiter: See put_objects for limiter semantics
+            - aws_region: List objects in this region
+                    Note: Currently only the AWS_DEFAULT_REGION is implemented
+        Yields:
+            - A dict per object
+    '''
+    # If a region other than default region is specified, raise an error
+    if aws_region != aws_settings.AWS_DEFAULT_REGION:
+        raise aws_exceptions.AWS_RegionNotImplemented
+
+    s3_client = aws_client_utils.get_client('s3')
+    limiter = _make_limiter(limiter, max_workers)
+
+    def _list_shard(shard_prefix, shard_delimiter, start_after, stop_after):
+        for page in _iter_list_pages(s3_client, bucket_name, shard_prefix,
+                                     shard_delimiter, start_after,
+                                     fetch_owner, limiter=limiter):
+            objs = page.get('Contents', [])
+            if stop_after and objs and objs[-1]['Key'] > stop_after:
+                # Last page of this shard
+                yield [_select_fields(x, fields) for x in objs
+                       if x['Key'] <= stop_after]
+                return
+            yield [_select_fields(x, fields) for x in objs]
+
+    if split_keys:
+        bounds = [None] + sorted(split_keys) + [None]
+        shards = [(prefix, None, bounds[i], bounds[i + 1])
+                  for i in range(len(bounds) - 1)]
+    else:
+        # Objects directly under the prefix form one shard and every
+        # common prefix another
+        shards = [(prefix, delimiter, None, None)]
+        shards.extend((p, None, None, None) for p in
+                      list_common_prefixes(bucket_name, prefix, delimiter,
+                                           aws_region=aws_region))
+
+    for objs in aws_concurrency_utils.iter_parallel(
+                    [lambda shard=shard: _list_shard(*shard)
+                     for shard in shards], max_workers):
+        yield from objs
+
 
 def create_s3_bucket(bucket_name, ACL='', 
                      CreateBucketConfiguration=DEFAULT_BUCKET_REGION):
@@ -118,7 +736,7 @@ def create_s3_bucket(bucket_name, ACL='',
         return aws_s3_settings.S3_BUCKET_ALREADY_EXISTS
     else:
         logging.info(f'Creating bucket: {bucket_name}')
-        s3_client = boto3.client('s3')
+        s3_client = aws_client_utils.get_client('s3')
         try:
             # Try creating a bucket with given name
             response = s3_client.create_bucket(Bucket=bucket_name, CreateBucketConfiguration=CreateBucketConfiguration)
@@ -161,7 +779,7 @@ def list_s3_buckets(aws_region=aws_settings.AWS_DEFAULT_REGION):
     if aws_region != aws_settings.AWS_DEFAULT_REGION:
         raise aws_exceptions.AWS_RegionNotImplemented
 
-    s3_client = boto3.client('s3')
+    s3_client = aws_client_utils.get_client('s3')
     response = s3_client.list_buckets()
     # Check if call succeded
     status_bool, status_code = aws_common_utils.check_response_status(response)
@@ -189,7 +807,7 @@ def delete_s3_bucket(bucket_name, aws_region=aws_settings.AWS_DEFAULT_REGION):
     if aws_region != aws_settings.AWS_DEFAULT_REGION:
         raise aws_exceptions.AWS_RegionNotImplemented
 
-    s3_client = boto3.client('s3')
+    s3_client = aws_client_utils.get_client('s3')
     try:
         response = s3_client.delete_bucket(Bucket=bucket_name)
     except ClientError as e:
@@ -216,6 +834,1610 @@ def delete_s3_bucket(bucket_name, aws_region=aws_settings.AWS_DEFAULT_REGION):
         return aws_s3_settings.S3_BUCKET_DELETE_SUCCESS
 
 
+def delete_s3_objects(bucket_name, object_names,
+                      max_workers=aws_s3_settings.S3_TRANSFER_MAX_WORKERS,
+                      max_retries=aws_s3_settings.S3_TRANSFER_MAX_RETRIES,
+                      limiter=None,
+                      aws_region=aws_settings.AWS_DEFAULT_REGION):
+    ''' Delete many objects from a bucket
+
+        Keys are batched S3_DELETE_BATCH_SIZE (1000) at a time into
+        delete_objects calls that are issued concurrently. object_names is
+        consumed lazily, so it can be a generator (e.g. from
+        iter_s3_objects) over any number of keys. Keys that fail with a
+        transient error are retried up to max_retries times.
+
+        Arguments:
+            - bucket_name: Bucket to delete objects from
+            - object_names: An iterable of keys. Either strings or dicts
+                            with 'Key' and optionally 'VersionId'
+            - max_workers: Number of delete_objects calls in flight
+            - max_retries: Number of times failed keys are retried
+            - limiter: See put_objects for limiter semantics
+            - aws_region: Delete objects in this region
+                    Note: Currently only the AWS_DEFAULT_REGION is implemented
+        Returns:
+            - num_deleted: Number of keys deleted
+            - errors: A list of dicts (Key, VersionId, Code, Message) for
+                      the keys that could not be deleted
+    '''
+    # If a region other than default region is specified, raise an error
+    if aws_region != aws_settings.AWS_DEFAULT_REGION:
+        raise aws_exceptions.AWS_RegionNotImplemented
+
+    s3_client = aws_client_utils.get_client('s3')
+    limiter = _make_limiter(limiter, max_workers)
+
+    def _delete_batch(batch):
+        pending = batch
+        failed = []
+        for attempt in range(max_retries + 1):
+            try:
+                resp = _call_with_retries(s3_client.delete_objects,
+                                          max_retries, limiter=limiter,
+                                          Bucket=bucket_name,
+                                          Delete={'Objects': pending,
+                                                  'Quiet': True})
+            except (ClientError, BotoCoreError) as e:
+                logging.error(e)
+                return failed + _delete_call_errors(e, pending)
+            retry = _split_delete_errors(resp, failed)
+            if not retry or attempt == max_retries:
+                return failed + retry
+            # Retry only the keys that failed with a transient error.
+            # Per key SlowDown errors are throttling too
+            if any(e.get('Code') in limiter.throttling_error_codes
+                   for e in retry):
+                limiter.on_throttle()
+            pending = [_object_identifier(e) for e in retry]
+            delay = aws_s3_settings.S3_TRANSFER_RETRY_BASE_DELAY * 2**attempt
+            logging.warning(f'{len(pending)} keys failed to delete. '
+                            f'Retrying in {delay} seconds')
+            time.sleep(delay)
+
+    num_requested = 0
+    all_errors = []
+    batches = _iter_batches((_object_identifier(x) for x in object_names),
+                            aws_s3_settings.S3_DELETE_BATCH_SIZE)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for batch, errors in _map_bounded(executor, _delete_batch, batches,
+                                          2 * max_workers):
+            num_requested += len(batch)
+            all_errors.extend(errors)
+    num_deleted = num_requested - len(all_errors)
+    logging.info(f'Deleted {num_deleted} objects from {bucket_name}. '
+                 f'{len(all_errors)} failed')
+    return num_deleted, all_errors
+
+
+def iter_s3_object_versions(bucket_name, prefix='',
+                            aws_region=aws_settings.AWS_DEFAULT_REGION):
+    ''' Lazily list all object versions and delete markers in a bucket
+
+        Arguments:
+            - bucket_name: List versions in bucket_name
+            - prefix: Only list keys that start with prefix
+        Yields:
+            - A dict with 'Key' and 'VersionId' per version/delete marker
+    '''
+    # If a region other than default region is specified, raise an error
+    if aws_region != aws_settings.AWS_DEFAULT_REGION:
+        raise aws_exceptions.AWS_RegionNotImplemented
+
+    s3_client = aws_client_utils.get_client('s3')
+    paginator = s3_client.get_paginator('list_object_versions')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get('Versions', []) + page.get('DeleteMarkers', []):
+            yield {'Key': obj['Key'], 'VersionId': obj['VersionId']}
+
+
+def empty_s3_bucket(bucket_name, include_versions=True,
+                    max_workers=aws_s3_settings.S3_TRANSFER_MAX_WORKERS,
+                    max_retries=aws_s3_settings.S3_TRANSFER_MAX_RETRIES,
+                    aws_region=aws_settings.AWS_DEFAULT_REGION):
+    ''' Delete every object in a bucket
+
+        Arguments:
+            - bucket_name: Bucket to empty
+            - include_versions: Also delete all old versions and delete
+                                markers. Needed for versioned buckets to
+                                really be empty. Set to False to only
+                                delete the current objects
+            - max_workers, max_retries: See delete_s3_objects
+        Returns:
+            - num_deleted, errors: See delete_s3_objects
+    '''
+    if include_versions:
+        objects = iter_s3_object_versions(bucket_name, aws_region=aws_region)
+    else:
+        objects = iter_s3_objects(bucket_name, fields=['Key'],
+                                  aws_region=aws_region)
+    return delete_s3_objects(bucket_name, objects, max_workers=max_workers,
+                             max_retries=max_retries, aws_region=aws_region)
+
+
+def empty_and_delete_s3_bucket(
+                    bucket_name,
+                    max_workers=aws_s3_settings.S3_TRANSFER_MAX_WORKERS,
+                    max_retries=aws_s3_settings.S3_TRANSFER_MAX_RETRIES,
+                    aws_region=aws_settings.AWS_DEFAULT_REGION):
+    ''' Delete all objects (including versions and delete markers) in a
+        bucket and then the bucket itself
+
+        Arguments:
+            - bucket_name: name of bucket to delete
+            - max_workers, max_retries: See delete_s3_objects
+        Returns:
+            - Success or error code
+    '''
+    num_deleted, errors = empty_s3_bucket(bucket_name,
+                                          max_workers=max_workers,
+                                          max_retries=max_retries,
+                                          aws_region=aws_region)
+    if errors:
+        logging.error(f'Could not delete {len(errors)} objects from '
+                      f'{bucket_name}. Not deleting bucket')
+        return aws_s3_settings.S3_BUCKET_DELETE_FAILED
+    return delete_s3_bucket(bucket_name, aws_region=aws_region)
+
+
+################ File-like Reader ######################
+class S3File(io.RawIOBase):
+    ''' A read-only, seekable file object over an S3 object
+
+        Data is fetched with ranged GETs as it is read, so code that takes
+        a file object (TFRecord readers, numpy.load, zipfile etc.) can
+        read straight from S3 without downloading the whole object.
+        Reads go through a read-ahead buffer. The read-ahead doubles (up
+        to max_readahead) every time a read continues where the previous
+        fetch ended, and drops back to min_readahead after a seek
+        elsewhere. So sequential reads use few, large GETs while random
+        reads do not fetch much more than they need.
+
+        Usage:
+            with S3File('my-bucket', 'data/arrays.npz') as fh:
+                arrays = numpy.load(fh)
+    '''
+    def __init__(self, bucket_name, object_name,
+                 min_readahead=aws_s3_settings.S3_FILE_MIN_READAHEAD,
+                 max_readahead=aws_s3_settings.S3_FILE_MAX_READAHEAD,
+                 max_retries=aws_s3_settings.S3_TRANSFER_MAX_RETRIES,
+                 aws_region=aws_settings.AWS_DEFAULT_REGION):
+        ''' Arguments:
+                - bucket_name: obvious what it is
+                - object_name: obvious what it is
+                - min_readahead: Smallest read-ahead (bytes)
+                - max_readahead: Largest read-ahead (bytes)
+                - max_retries: Number of times a failed GET is retried
+                - aws_region: Note: Only AWS_DEFAULT_REGION is implemented
+        '''
+        super().__init__()
+        # If a region other than default region is specified, raise an error
+        if aws_region != aws_settings.AWS_DEFAULT_REGION:
+            raise aws_exceptions.AWS_RegionNotImplemented
+        self.bucket_name = bucket_name
+        self.object_name = object_name
+        self.min_readahead = min_readahead
+        self.max_readahead = max_readahead
+        self.max_retries = max_retries
+
+        self._s3_client = aws_client_utils.get_client('s3')
+        resp = self._s3_client.head_object(Bucket=bucket_name,
+                                           Key=object_name)
+        # Pin all reads to this version of the object
+        self.size = resp['ContentLength']
+        self.etag = resp['ETag']
+
+        self._pos = 0
+        self._buf = b''
+        self._buf_start = 0
+        self._readahead = min_readahead
+        self._last_fetch_end = 0
+
+    # Public methods
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        ''' Move to a new position. Same semantics as for local files '''
+        self._check_not_closed()
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError(f'Invalid whence ({whence})')
+        if pos < 0:
+            raise ValueError(f'Negative seek position {pos}')
+        self._pos = pos
+        return self._pos
+
+    def tell(self):
+        self._check_not_closed()
+        return self._pos
+
+    def readinto(self, b):
+        ''' Read up to len(b) bytes into b. Fewer bytes are only returned
+            at the end of the object '''
+        self._check_not_closed()
+        view = memoryview(b).cast('B')
+        want = max(0, min(len(view), self.size - self._pos))
+        filled = 0
+        while filled < want:
+            buf_offset = self._pos - self._buf_start
+            if 0 <= buf_offset < len(self._buf):
+                # Serve what we can from the read-ahead buffer
+                n = min(want - filled, len(self._buf) - buf_offset)
+                view[filled:filled + n] = \
+                        self._buf[buf_offset:buf_offset + n]
+            else:
+                n = self._fetch(view[filled:want])
+            filled += n
+            self._pos += n
+        return filled
+
+    def close(self):
+        self._buf = b''
+        super().close()
+
+    # Private methods
+    def _check_not_closed(self):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+
+    def _fetch(self, dest_view):
+        ''' Fetch data at the current position. Large reads go straight
+            into dest_view, small ones through the read-ahead buffer.
+            Returns the number of bytes written into dest_view '''
+        if self._pos == self._last_fetch_end:
+            self._readahead = min(2 * self._readahead, self.max_readahead)
+        else:
+            self._readahead = self.min_readahead
+
+        if len(dest_view) >= self._readahead:
+            _fetch_range(self._s3_client, self.bucket_name, self.object_name,
+                         self.etag, self._pos, dest_view, self.max_retries)
+            self._last_fetch_end = self._pos + len(dest_view)
+            return len(dest_view)
+
+        length = min(self._readahead, self.size - self._pos)
+        buf = bytearray(length)
+        _fetch_range(self._s3_client, self.bucket_name, self.object_name,
+                     self.etag, self._pos, memoryview(buf), self.max_retries)
+        self._buf = bytes(buf)
+        self._buf_start = self._pos
+        self._last_fetch_end = self._pos + length
+        n = len(dest_view)
+        dest_view[:] = self._buf[:n]
+        return n
+
+
+################ Sync ######################
+def sync_dir_to_s3(src_dir, dest_bucket_name, dest_prefix='', delete=False,
+                   manifest_file=None,
+                   multipart_threshold=aws_s3_settings.S3_MULTIPART_THRESHOLD,
+                   part_size=aws_s3_settings.S3_MULTIPART_PART_SIZE,
+                   max_workers=aws_s3_settings.S3_TRANSFER_MAX_WORKERS,
+                   limiter=None, aws_region=aws_settings.AWS_DEFAULT_REGION):
+    ''' Make dest_bucket_name/dest_prefix a copy of the local src_dir
+
+        Only the differences are transferred. A local file is uploaded if
+        there is no object for it, if the sizes differ or if its MD5 (or
+        multipart ETag) does not match the object's ETag. Files are
+        checked and uploaded concurrently.
+        A manifest with the size, mtime and ETag of every synced file is
+        kept locally. A file whose size and mtime match the manifest, and
+        whose object still has the recorded ETag, is skipped without
+        being read at all.
+
+        Note: Objects encrypted with SSE-KMS do not have MD5 ETags. Those
+              are always uploaded unless the manifest says they are current
+
+        Arguments:
+            - src_dir: Local directory to sync
+            - dest_bucket_name: Bucket to sync to
+            - dest_prefix: Prefix (i.e. "directory") to sync to
+            - delete: Delete objects under dest_prefix that have no local
+                      file
+            - manifest_file: Where to keep the manifest. By default a file
+                             under S3_SYNC_MANIFEST_DIR named after
+                             src_dir, bucket and prefix
+            - multipart_threshold, part_size: Used for uploads and to
+                             compute the multipart ETags of local files.
+                             See put_object
+            - max_workers: Number of files checked/uploaded concurrently
+            - limiter: See put_objects for limiter semantics
+            - aws_region: Note: Only AWS_DEFAULT_REGION is implemented
+        Returns:
+            - A dict with the lists of 'uploaded', 'skipped', 'deleted'
+              and 'failed' keys
+    '''
+    # If a region other than default region is specified, raise an error
+    if aws_region != aws_settings.AWS_DEFAULT_REGION:
+        raise aws_exceptions.AWS_RegionNotImplemented
+
+    src_dir = os.path.abspath(src_dir)
+    if dest_prefix and not dest_prefix.endswith('/'):
+        dest_prefix += '/'
+    if manifest_file is None:
+        name = hashlib.sha256(f'{src_dir}|{dest_bucket_name}|{dest_prefix}'
+                              .encode()).hexdigest()
+        manifest_file = os.path.join(aws_s3_settings.S3_SYNC_MANIFEST_DIR,
+                                     name + '.json')
+    manifest = _read_manifest(manifest_file)
+    limiter = _make_limiter(limiter, max_workers)
+
+    local_files = {}
+    for file_name in file_utils.dir2filelist(src_dir):
+        rel_path = os.path.relpath(file_name, src_dir).replace(os.sep, '/')
+        local_files[dest_prefix + rel_path] = file_name
+    remote_objs = {obj['Key']: obj for obj in
+                   iter_s3_objects(dest_bucket_name, prefix=dest_prefix,
+                                   fields=['Key', 'Size', 'ETag'],
+                                   aws_region=aws_region)}
+
+    def _sync_file(key):
+        file_name = local_files[key]
+        stat = os.stat(file_name)
+        remote = remote_objs.get(key)
+        entry = manifest.get(key)
+        if (remote is not None and entry is not None and
+                entry['size'] == stat.st_size == remote['Size'] and
+                entry['mtime'] == stat.st_mtime and
+                entry['etag'] == remote['ETag']):
+            return 'skipped', entry
+        etag = compute_etag(file_name, multipart_threshold, part_size)
+        entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'etag': etag}
+        if (remote is not None and remote['Size'] == stat.st_size and
+                remote['ETag'] == etag):
+            return 'skipped', entry
+        code = put_object(dest_bucket_name, key, file_name,
+                          aws_region=aws_region,
+                          multipart_threshold=multipart_threshold,
+                          part_size=part_size, limiter=limiter)
+        if code != aws_s3_settings.S3_PUT_OBJECT_SUCCESS:
+            return 'failed', None
+        return 'uploaded', entry
+
+    summary = {'uploaded': [], 'skipped': [], 'deleted': [], 'failed': []}
+    new_manifest = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for key, (status, entry) in _map_bounded(executor, _sync_file,
+                                                 local_files,
+                                                 2 * max_workers):
+            summary[status].append(key)
+            if entry is not None:
+                new_manifest[key] = entry
+
+    if delete:
+        stale_keys = [k for k in remote_objs if k not in local_files]
+        _, errors = delete_s3_objects(dest_bucket_name, stale_keys,
+                                      max_workers=max_workers,
+                                      limiter=limiter,
+                                      aws_region=aws_region)
+        failed_keys = {e['Key'] for e in errors}
+        summary['deleted'] = [k for k in stale_keys if k not in failed_keys]
+        summary['failed'].extend(failed_keys)
+
+    _write_manifest(manifest_file, new_manifest)
+    logging.info(f'Synced {src_dir} to s3://{dest_bucket_name}/{dest_prefix}'
+                 f': {len(summary["uploaded"])} uploaded, '
+                 f'{len(summary["skipped"])} unchanged, '
+                 f'{len(summary["deleted"])} deleted, '
+                 f'{len(summary["failed"])} failed')
+    return summary
+
+
+def compute_etag(file_name,
+                 multipart_threshold=aws_s3_settings.S3_MULTIPART_THRESHOLD,
+                 part_size=aws_s3_settings.S3_MULTIPART_PART_SIZE):
+    ''' Compute the ETag S3 gives a file uploaded by put_object
+
+        For a single PUT that is the MD5 of the data. For a multipart
+        upload it is the MD5 of the concatenated MD5s of all parts,
+        followed by '-' and the number of parts. So the same
+        multipart_threshold and part_size as for the upload are needed.
+
+        Arguments:
+            - file_name: Local file to hash (or the data as bytes)
+            - multipart_threshold, part_size: See put_object
+        Returns:
+            - The ETag (in double quotes, as S3 returns them)
+    '''
+    etag, _ = _compute_checksums(file_name, multipart_threshold, part_size,
+                                 with_sha256=False)
+    return etag
+
+
+################ Background Uploads ######################
+class S3BackgroundUploader():
+    ''' Upload local files to S3 in the background as they are produced
+
+        Meant for pipelines that write large files one after the other
+        (e.g. TFRecord shards). Each file is handed over with submit() as
+        soon as it is complete and is uploaded while the next one is being
+        written. submit() blocks once max_queued files are waiting, which
+        also caps the local disk used when delete_local is set.
+
+        An upload is verified by checking that the object's size matches
+        the local file, and its ETag or (as the ETag is not an MD5 under
+        SSE-KMS or SSE-C) the SHA256 uploaded in its metadata. Only
+        verified files are deleted locally.
+
+        Usage:
+            with S3BackgroundUploader('my-bucket', 'tfrecords/',
+                                      delete_local=True) as uploader:
+                for shard_file in write_shards():
+                    uploader.submit(shard_file)
+            print(uploader.summary)
+    '''
+    def __init__(self, dest_bucket_name, dest_prefix='', delete_local=False,
+                 verify=True,
+                 max_workers=aws_s3_settings.S3_BACKGROUND_UPLOAD_WORKERS,
+                 max_queued=aws_s3_settings.S3_BACKGROUND_UPLOAD_MAX_QUEUED,
+                 multipart_threshold=aws_s3_settings.S3_MULTIPART_THRESHOLD,
+                 part_size=aws_s3_settings.S3_MULTIPART_PART_SIZE,
+                 aws_region=aws_settings.AWS_DEFAULT_REGION):
+        ''' Arguments:
+                - dest_bucket_name: Bucket to upload to
+                - dest_prefix: Prefix (i.e. "directory") for the objects
+                - delete_local: Delete each local file once its upload is
+                                verified
+                - verify: Check size and checksums of each uploaded
+                          object. delete_local requires it
+                - max_workers: Number of files uploaded at a time
+                - max_queued: Number of files submitted but not yet
+                              uploaded, before submit() blocks
+                - multipart_threshold, part_size: See put_object
+                - aws_region: Note: Only AWS_DEFAULT_REGION is implemented
+        '''
+        # If a region other than default region is specified, raise an error
+        if aws_region != aws_settings.AWS_DEFAULT_REGION:
+            raise aws_exceptions.AWS_RegionNotImplemented
+        if delete_local and not verify:
+            raise ValueError('delete_local requires verify')
+        if dest_prefix and not dest_prefix.endswith('/'):
+            dest_prefix += '/'
+        self.dest_bucket_name = dest_bucket_name
+        self.dest_prefix = dest_prefix
+        self.delete_local = delete_local
+        self.verify = verify
+        self.multipart_threshold = multipart_threshold
+        self.part_size = part_size
+        self.aws_region = aws_region
+        self.summary = {'uploaded': [], 'failed': []}
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_queued)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, file_name, object_name=None):
+        ''' Queue file_name for upload. The object is named object_name,
+            or dest_prefix + the file's base name by default '''
+        if object_name is None:
+            object_name = self.dest_prefix + os.path.basename(file_name)
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._upload, file_name,
+                                           object_name)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+
+    def close(self):
+        ''' Wait for all queued uploads to finish and return the summary:
+            a dict with the lists of 'uploaded' and 'failed' keys '''
+        self._executor.shutdown(wait=True)
+        logging.info(f'Background uploads to s3://{self.dest_bucket_name}'
+                     f'/{self.dest_prefix}: '
+                     f'{len(self.summary["uploaded"])} uploaded, '
+                     f'{len(self.summary["failed"])} failed')
+        return self.summary
+
+    def _upload(self, file_name, object_name):
+        ''' Upload, verify and optionally delete one file '''
+        status = 'failed'
+        try:
+            metadata = checksums = None
+            if self.verify:
+                checksums = _compute_checksums(file_name,
+                                               self.multipart_threshold,
+                                               self.part_size)
+                metadata = {aws_s3_settings.S3_CHECKSUM_METADATA_KEY:
+                            checksums[1]}
+            code = put_object(self.dest_bucket_name, object_name, file_name,
+                              aws_region=self.aws_region,
+                              multipart_threshold=self.multipart_threshold,
+                              part_size=self.part_size, metadata=metadata)
+            if code == aws_s3_settings.S3_PUT_OBJECT_SUCCESS:
+                if not self.verify or self._verify(file_name, object_name,
+                                                   *checksums):
+                    status = 'uploaded'
+                    if self.delete_local:
+                        os.remove(file_name)
+        except (ClientError, BotoCoreError, OSError) as e:
+            logging.error(f'Background upload of {file_name} failed')
+            logging.error(e)
+        with self._lock:
+            self.summary[status].append(object_name)
+
+    def _verify(self, file_name, object_name, etag, sha256):
+        ''' Check that the object has the size of file_name and its ETag
+            or SHA256, like the dedup check of put_object '''
+        s3_client = aws_client_utils.get_client('s3')
+        if not _is_unchanged(s3_client, self.dest_bucket_name, object_name,
+                             os.path.getsize(file_name), etag, sha256):
+            logging.error(f'Uploaded {object_name} does not match '
+                          f'{file_name}')
+            return False
+        return True
+
+
+################ Object Cache ######################
+class S3ObjectCache():
+    ''' A local, on-disk, read-through cache of S3 objects
+
+        Objects are stored under cache_dir, one data file and one metadata
+        file (with the ETag and fetch time) per object. The cache is safe
+        to share between threads and processes on the same host:
+            - Each object is filled while holding an exclusive file lock,
+              so concurrent processes do not download the same object twice
+            - Data files are written to a temp file and renamed, so readers
+              never see a partial file
+        Once the total size goes over max_size_bytes, the least recently
+        used objects are evicted.
+
+        Usage:
+            cache = S3ObjectCache()
+            local_path = cache.get_file('my-bucket', 'labels/label_map.json')
+    '''
+    def __init__(self, cache_dir=aws_s3_settings.S3_CACHE_DIR,
+                 max_size_bytes=aws_s3_settings.S3_CACHE_MAX_SIZE,
+                 ttl=aws_s3_settings.S3_CACHE_TTL,
+                 aws_region=aws_settings.AWS_DEFAULT_REGION):
+        ''' Arguments:
+                - cache_dir: Directory to store the cached objects in
+                - max_size_bytes: Evict objects when the cache is larger
+                - ttl: Cached objects younger than this (in seconds) are
+                       used as is. Older ones are revalidated with S3.
+                       0 means always revalidate
+                - aws_region: Note: Only AWS_DEFAULT_REGION is implemented
+        '''
+        # If a region other than default region is specified, raise an error
+        if aws_region != aws_settings.AWS_DEFAULT_REGION:
+            raise aws_exceptions.AWS_RegionNotImplemented
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self.ttl = ttl
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    # Public methods
+    def get_file(self, bucket_name, object_name):
+        ''' Return the path of a local copy of the object, downloading it
+            first if it is not cached or has changed in S3
+
+            Arguments:
+                - bucket_name: obvious what it is
+                - object_name: obvious what it is
+            Returns:
+                - The local file path. None if the object could not be got
+        '''
+        data_file, meta_file, lock_file = self._entry_files(bucket_name,
+                                                            object_name)
+        # Fast path. No lock needed as the files are only ever replaced
+        meta = self._read_meta(meta_file)
+        if self._is_fresh(meta, data_file):
+            self._touch(meta_file)
+            return data_file
+
+        with open(lock_file, 'a') as lock_fh:
+            fcntl.flock(lock_fh, fcntl.LOCK_EX)
+            # Someone else may have filled it while we waited for the lock
+            meta = self._read_meta(meta_file)
+            if self._is_fresh(meta, data_file):
+                self._touch(meta_file)
+                return data_file
+            if not self._fill(bucket_name, object_name, meta, data_file,
+                              meta_file):
+                return None
+        self._evict(keep=meta_file)
+        return data_file
+
+    def invalidate(self, bucket_name, object_name):
+        ''' Remove an object from the cache '''
+        data_file, meta_file, lock_file = self._entry_files(bucket_name,
+                                                            object_name)
+        with open(lock_file, 'a') as lock_fh:
+            fcntl.flock(lock_fh, fcntl.LOCK_EX)
+            _remove_file(meta_file)
+            _remove_file(data_file)
+
+    def cache_size(self):
+        ''' Return the total size in bytes of all cached objects '''
+        return sum(size for _, _, size in self._list_entries())
+
+    # Private methods
+    def _entry_files(self, bucket_name, object_name):
+        ''' Return the data, metadata and lock file names of an object '''
+        name = hashlib.sha256(f'{bucket_name}/{object_name}'.encode()
+                              ).hexdigest()
+        base = os.path.join(self.cache_dir, name)
+        return base + '.data', base + '.meta', base + '.lock'
+
+    def _is_fresh(self, meta, data_file):
+        ''' Check if an entry can be used without asking S3 '''
+        return (meta is not None and os.path.exists(data_file) and
+                time.time() - meta['fetched_at'] < self.ttl)
+
+    def _fill(self, bucket_name, object_name, meta, data_file, meta_file):
+        ''' Revalidate or (re-)download an object. Must hold its lock.
+            Returns True if data_file is now up to date '''
+        s3_client = aws_client_utils.get_client('s3')
+        kwargs = {'Bucket': bucket_name, 'Key': object_name}
+        if meta is not None and os.path.exists(data_file):
+            kwargs['IfNoneMatch'] = meta['etag']
+        try:
+            resp = s3_client.head_object(**kwargs)
+        except ClientError as e:
+            # 304 == cached copy is still current
+            if e.response['Error']['Code'] == '304':
+                meta['fetched_at'] = time.time()
+                self._write_meta(meta_file, meta)
+                return True
+            logging.error(e)
+            return False
+
+        logging.info(f'Caching s3://{bucket_name}/{object_name}')
+        code = _download_to_file(s3_client, bucket_name, object_name,
+                                 resp['ContentLength'], resp['ETag'],
+                                 data_file,
+                                 aws_s3_settings.S3_DOWNLOAD_PART_SIZE,
+                                 aws_s3_settings.S3_TRANSFER_MAX_WORKERS,
+                                 aws_s3_settings.S3_TRANSFER_MAX_RETRIES)
+        if code != aws_s3_settings.S3_GET_OBJECT_SUCCESS:
+            return False
+        self._write_meta(meta_file, {'bucket': bucket_name,
+                                     'key': object_name,
+                                     'etag': resp['ETag'],
+                                     'size': resp['ContentLength'],
+                                     'fetched_at': time.time()})
+        return True
+
+    def _evict(self, keep=None):
+        ''' Remove least recently used objects until the cache fits in
+            max_size_bytes. Entries locked by someone else are skipped '''
+        entries = self._list_entries()
+        total_size = sum(size for _, _, size in entries)
+        # Metadata files are touched on every use, so oldest mtime == LRU
+        for meta_file, _, size in sorted(entries, key=lambda x: x[1]):
+            if total_size <= self.max_size_bytes:
+                break
+            if meta_file == keep:
+                continue
+            base = meta_file[:-len('.meta')]
+            with open(base + '.lock', 'a') as lock_fh:
+                try:
+                    fcntl.flock(lock_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                _remove_file(meta_file)
+                _remove_file(base + '.data')
+            total_size -= size
+
+    def _list_entries(self):
+        ''' Return a list of (meta_file, last_used, size) of all entries '''
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if not entry.name.endswith('.meta'):
+                    continue
+                base = entry.path[:-len('.meta')]
+                try:
+                    last_used = entry.stat().st_mtime
+                    size = os.path.getsize(base + '.data')
+                except FileNotFoundError:
+                    # Evicted or invalidated while we were looking
+                    continue
+                entries.append((entry.path, last_used, size))
+        return entries
+
+    @staticmethod
+    def _read_meta(meta_file):
+        ''' Read an entry's metadata. None if there is none '''
+        try:
+            with open(meta_file) as fh:
+                return json.load(fh)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    @staticmethod
+    def _write_meta(meta_file, meta):
+        ''' Atomically write an entry's metadata '''
+        tmp_file = f'{meta_file}.{os.getpid()}.{threading.get_ident()}'
+        with open(tmp_file, 'w') as fh:
+            json.dump(meta, fh)
+        os.replace(tmp_file, meta_file)
+
+    @staticmethod
+    def _touch(meta_file):
+        ''' Mark an entry as just used (for LRU eviction) '''
+        try:
+            os.utime(meta_file)
+        except FileNotFoundError:
+            pass
+
+
+################ Inventory Index ######################
+class S3InventoryIndex():
+    ''' A local SQLite index of the objects in a bucket
+
+        Bucket listings are stored locally so questions like "which keys
+        under this prefix changed after X" or "how many bytes are under
+        each prefix" are answered from the index in milliseconds instead
+        of by listing the bucket again.
+
+        There are two ways to refresh the index:
+            - refresh(prefix, full=True) lists everything under prefix
+              (concurrently, sharded on common prefixes), updates changed
+              objects and drops objects that are no longer there
+            - refresh(prefix) only lists keys that sort after the last key
+              seen under prefix (using StartAfter). That is cheap and
+              picks up new objects when keys grow monotonically (e.g. are
+              time stamped). Overwrites and deletes of older keys are only
+              seen by a full refresh
+
+        Usage:
+            index = S3InventoryIndex('my-bucket')
+            index.refresh('camera1/', full=True)
+            ...
+            index.refresh('camera1/')
+            new_objs = list(index.query('camera1/', modified_after=t))
+    '''
+    def __init__(self, bucket_name,
+                 db_file=aws_s3_settings.S3_INVENTORY_DB_FILE,
+                 aws_region=aws_settings.AWS_DEFAULT_REGION):
+        ''' Arguments:
+                - bucket_name: Bucket to index
+                - db_file: SQLite file for the index. Many buckets can
+                           share one file
+                - aws_region: Note: Only AWS_DEFAULT_REGION is implemented
+        '''
+        # If a region other than default region is specified, raise an error
+        if aws_region != aws_settings.AWS_DEFAULT_REGION:
+            raise aws_exceptions.AWS_RegionNotImplemented
+        self.bucket_name = bucket_name
+        self.aws_region = aws_region
+        if db_file != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(db_file)),
+                        exist_ok=True)
+        self._db = sqlite3.connect(db_file)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS objects (
+                bucket TEXT NOT NULL,
+                key TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                etag TEXT,
+                last_modified REAL,
+                storage_class TEXT,
+                scan_id INTEGER,
+                PRIMARY KEY (bucket, key)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS objects_last_modified
+                ON objects (bucket, last_modified);
+            CREATE TABLE IF NOT EXISTS scans (
+                bucket TEXT NOT NULL,
+                prefix TEXT NOT NULL,
+                last_key TEXT,
+                refreshed_at REAL,
+                PRIMARY KEY (bucket, prefix));
+        ''')
+
+    # Public methods
+    def refresh(self, prefix='', full=False,
+                max_workers=aws_s3_settings.S3_TRANSFER_MAX_WORKERS):
+        ''' Update the index from S3. See the class docstring
+
+            Arguments:
+                - prefix: Refresh objects under this prefix
+                - full: Re-list everything under prefix. If False only keys
+                        after the last key seen under prefix are listed.
+                        The first refresh of a prefix is always full
+                - max_workers: Number of concurrent listings (full only)
+            Returns:
+                - Number of objects listed from S3
+        '''
+        row = self._db.execute('SELECT last_key FROM scans WHERE bucket = ? '
+                               'AND prefix = ?', (self.bucket_name, prefix)
+                               ).fetchone()
+        full = full or row is None
+        scan_id = time.time_ns()
+        if full:
+            objs = iter_s3_objects_parallel(self.bucket_name, prefix=prefix,
+                                            max_workers=max_workers,
+                                            aws_region=self.aws_region)
+        else:
+            objs = iter_s3_objects(self.bucket_name, prefix=prefix,
+                                   start_after=row['last_key'],
+                                   aws_region=self.aws_region)
+
+        num_listed = 0
+        last_key = None if full else row['last_key']
+        batch_size = aws_s3_settings.S3_INVENTORY_BATCH_SIZE
+        for batch in _iter_batches(objs, batch_size):
+            with self._db:
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO objects '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    ((self.bucket_name, obj['Key'], obj['Size'],
+                      obj.get('ETag'), obj['LastModified'].timestamp(),
+                      obj.get('StorageClass'), scan_id) for obj in batch))
+            num_listed += len(batch)
+            batch_last_key = max(obj['Key'] for obj in batch)
+            if last_key is None or batch_last_key > last_key:
+                last_key = batch_last_key
+
+        with self._db:
+            if full:
+                # Anything under prefix not seen in this scan is gone
+                self._db.execute('DELETE FROM objects WHERE bucket = ? AND '
+                                 + _sql_prefix_clause(prefix) +
+                                 ' AND scan_id != ?',
+                                 (self.bucket_name,
+                                  *_sql_prefix_args(prefix), scan_id))
+            self._db.execute('INSERT OR REPLACE INTO scans VALUES '
+                             '(?, ?, ?, ?)', (self.bucket_name, prefix,
+                                             last_key, time.time()))
+        logging.info(f'Indexed {num_listed} objects under '
+                     f's3://{self.bucket_name}/{prefix}')
+        return num_listed
+
+    def query(self, prefix='', modified_after=None, modified_before=None,
+              min_size=None, max_size=None):
+        ''' Yield the indexed objects matching all given conditions
+
+            Arguments:
+                - prefix: Keys starting with prefix
+                - modified_after, modified_before: datetimes or epoch secs
+                - min_size, max_size: In bytes (inclusive)
+            Yields:
+                - A dict (Key, Size, ETag, LastModified, StorageClass) per
+                  object, in key order. LastModified is in epoch seconds
+        '''
+        sql = ('SELECT key, size, etag, last_modified, storage_class FROM '
+               'objects WHERE bucket = ? AND ' + _sql_prefix_clause(prefix))
+        args = [self.bucket_name, *_sql_prefix_args(prefix)]
+        for clause, value in ((' AND last_modified > ?', modified_after),
+                              (' AND last_modified < ?', modified_before),
+                              (' AND size >= ?', min_size),
+                              (' AND size <= ?', max_size)):
+            if value is not None:
+                sql += clause
+                args.append(_to_epoch(value))
+        for row in self._db.execute(sql + ' ORDER BY key', args):
+            yield {'Key': row['key'], 'Size': row['size'],
+                   'ETag': row['etag'], 'LastModified': row['last_modified'],
+                   'StorageClass': row['storage_class']}
+
+    def total_size(self, prefix=''):
+        ''' Return (number of objects, total bytes) under prefix '''
+        row = self._db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) '
+                               'FROM objects WHERE bucket = ? AND ' +
+                               _sql_prefix_clause(prefix),
+                               (self.bucket_name, *_sql_prefix_args(prefix))
+                               ).fetchone()
+        return row[0], row[1]
+
+    def size_by_prefix(self, prefix='', delimiter='/'):
+        ''' Return a dict of {sub prefix: (number of objects, total bytes)}
+            for the "directories" directly under prefix. Objects directly
+            under prefix are keyed by their own key '''
+        # The sub prefix is the key up to and including the first
+        # delimiter after prefix. Keys without one are their own group
+        start = len(prefix) + 1
+        rows = self._db.execute(
+                    'SELECT CASE WHEN instr(substr(key, ?), ?) > 0 '
+                    'THEN substr(key, 1, ? + instr(substr(key, ?), ?)) '
+                    'ELSE key END AS sub_prefix, COUNT(*), SUM(size) '
+                    'FROM objects WHERE bucket = ? AND ' +
+                    _sql_prefix_clause(prefix) + ' GROUP BY sub_prefix',
+                    (start, delimiter, len(prefix), start, delimiter,
+                     self.bucket_name, *_sql_prefix_args(prefix)))
+        return {row[0]: (row[1], row[2]) for row in rows}
+
+    def last_refreshed(self, prefix=''):
+        ''' Return when prefix was last refreshed (epoch secs) or None '''
+        row = self._db.execute('SELECT refreshed_at FROM scans WHERE '
+                               'bucket = ? AND prefix = ?',
+                               (self.bucket_name, prefix)).fetchone()
+        return row[0] if row else None
+
+    def close(self):
+        self._db.close()
+
+
+################ Shard Packing ######################
+def pack_dir_to_s3(src_dir, dest_bucket_name, dest_prefix='',
+                   shard_size=aws_s3_settings.S3_PACK_SHARD_SIZE,
+                   max_workers=aws_s3_settings.S3_PACK_MAX_SHARDS_IN_FLIGHT,
+                   aws_region=aws_settings.AWS_DEFAULT_REGION):
+    ''' Pack the (small) files under src_dir into large shard objects
+
+        Storing millions of small files as individual objects makes bulk
+        reads slow and costly: one request per file and very long
+        listings. Instead the files are concatenated into shards of about
+        shard_size bytes, each with an index object that maps the
+        members to their offset and size in the shard:
+            <dest_prefix>shard-00000.pack
+            <dest_prefix>shard-00000.index.json
+            ...
+        S3PackReader reads any member back with a single ranged GET.
+        Files bigger than shard_size get a shard of their own.
+
+        Arguments:
+            - src_dir: Local directory to pack. Members are named by their
+                       path relative to src_dir, with '/' separators
+            - dest_bucket_name: Bucket to upload the shards to
+            - dest_prefix: Prefix (i.e. "directory") for the shards
+            - shard_size: Target size in bytes of a shard
+            - max_workers: Number of shards built and uploaded at a time.
+                           Each shard is built in memory
+            - aws_region: Note: Only AWS_DEFAULT_REGION is implemented
+        Returns:
+            - A dict with the 'shards' uploaded, the number of members
+              'packed' and the 'failed' members
+    '''
+    # If a region other than default region is specified, raise an error
+    if aws_region != aws_settings.AWS_DEFAULT_REGION:
+        raise aws_exceptions.AWS_RegionNotImplemented
+
+    src_dir = os.path.abspath(src_dir)
+    if dest_prefix and not dest_prefix.endswith('/'):
+        dest_prefix += '/'
+
+    # Sort so that a directory's files end up next to each other
+    shards = []
+    members, members_size = [], 0
+    for file_name in sorted(file_utils.dir2filelist(src_dir)):
+        size = os.path.getsize(file_name)
+        if members and members_size + size > shard_size:
+            shards.append(members)
+            members, members_size = [], 0
+        members.append(file_name)
+        members_size += size
+    if members:
+        shards.append(members)
+
+    def _pack_shard(shard_number):
+        shard_key = (f'{dest_prefix}shard-{shard_number:05d}'
+                     f'{aws_s3_settings.S3_PACK_SHARD_SUFFIX}')
+        members = []
+        index = {}
+        offset = 0
+        for file_name in shards[shard_number]:
+            name = os.path.relpath(file_name, src_dir).replace(os.sep, '/')
+            with open(file_name, 'rb') as fh:
+                data = fh.read()
+            index[name] = [offset, len(data)]
+            offset += len(data)
+            members.append(data)
+        # Built once as bytes, and the member copies are dropped before
+        # the upload, so a shard is held in memory only once
+        shard_data = b''.join(members)
+        del members
+        code = put_object(dest_bucket_name, shard_key, shard_data,
+                          aws_region=aws_region)
+        if code != aws_s3_settings.S3_PUT_OBJECT_SUCCESS:
+            return None
+        # The index goes up last, so readers never see a missing shard
+        index_data = json.dumps({'shard': shard_key.rsplit('/', 1)[-1],
+                                 'members': index}).encode()
+        code = put_object(dest_bucket_name,
+                          _pack_index_key(shard_key), index_data,
+                          aws_region=aws_region)
+        if code != aws_s3_settings.S3_PUT_OBJECT_SUCCESS:
+            return None
+        return shard_key
+
+    summary = {'shards': [], 'packed': 0, 'failed': []}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for shard_number, shard_key in _map_bounded(executor, _pack_shard,
+                                                    range(len(shards)),
+                                                    max_workers):
+            if shard_key is None:
+                summary['failed'].extend(shards[shard_number])
+            else:
+                summary['shards'].append(shard_key)
+                summary['packed'] += len(shards[shard_number])
+    summary['shards'].sort()
+    logging.info(f'Packed {summary["packed"]} files from {src_dir} into '
+                 f'{len(summary["shards"])} shards in '
+                 f's3://{dest_bucket_name}/{dest_prefix}, '
+                 f'{len(summary["failed"])} failed')
+    return summary
+
+
+class S3PackReader():
+    ''' Read members of shards written by pack_dir_to_s3
+
+        The shard indexes under prefix are loaded (concurrently) when the
+        reader is created. After that every member is a single ranged
+        GET away, and no listing is needed.
+
+        Usage:
+            reader = S3PackReader('my-bucket', 'camera1/packed/')
+            data = reader.read('2020/01/01/img0001.jpg')
+            for name, data in reader.read_many(reader.names()):
+                ...
+    '''
+    def __init__(self, bucket_name, prefix='',
+                 max_workers=aws_s3_settings.S3_TRANSFER_MAX_WORKERS,
+                 max_retries=aws_s3_settings.S3_TRANSFER_MAX_RETRIES,
+                 aws_region=aws_settings.AWS_DEFAULT_REGION):
+        ''' Arguments:
+                - bucket_name, prefix: Where pack_dir_to_s3 put the shards
+                - max_workers: Number of concurrent GETs
+                - max_retries: Number of times a failed GET is retried
+                - aws_region: Note: Only AWS_DEFAULT_REGION is implemented
+        '''
+        # If a region other than default region is specified, raise an error
+        if aws_region != aws_settings.AWS_DEFAULT_REGION:
+            raise aws_exceptions.AWS_RegionNotImplemented
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self._s3_client = aws_client_utils.get_client('s3')
+        # Member name -> (shard key, offset, size)
+        self._members = {}
+        self._load_indexes()
+
+    def __len__(self):
+        return len(self._members)
+
+    def __contains__(self, name):
+        return name in self._members
+
+    def names(self):
+        ''' Return the names of all members '''
+        return list(self._members)
+
+    def read(self, name):
+        ''' Return the contents of member name as bytes. Raises KeyError
+            for an unknown member and the botocore error if the GET
+            fails '''
+        shard_key, offset, size = self._members[name]
+        data = bytearray(size)
+        if size:
+            _fetch_range(self._s3_client, self.bucket_name, shard_key, None,
+                         offset, memoryview(data), self.max_retries)
+        return bytes(data)
+
+    def read_many(self, names):
+        ''' Read many members concurrently. Yields (name, data) tuples in
+            completion order. Reads are issued in shard and offset order
+            to keep them sequential within each shard '''
+        names = sorted(names, key=lambda n: self._members[n][:2])
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            yield from _map_bounded(executor, self.read, names,
+                                    2 * self.max_workers)
+
+    def _load_indexes(self):
+        ''' Fetch and merge all shard indexes under prefix '''
+        index_keys = [obj['Key'] for obj in
+                      iter_s3_objects(self.bucket_name, prefix=self.prefix,
+                                      fields=['Key'])
+                      if obj['Key'].endswith(
+                                    aws_s3_settings.S3_PACK_INDEX_SUFFIX)]
+
+        def _get_index(index_key):
+            resp = _call_with_retries(self._s3_client.get_object,
+                                      self.max_retries,
+                                      Bucket=self.bucket_name, Key=index_key)
+            return json.loads(resp['Body'].read())
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for index_key, index in _map_bounded(executor, _get_index,
+                                                 index_keys,
+                                                 2 * self.max_workers):
+                # The index names its shard relative to its own "directory"
+                shard_dir = index_key[:index_key.rfind('/') + 1]
+                shard_key = shard_dir + index['shard']
+                for name, (offset, size) in index['members'].items():
+                    self._members[name] = (shard_key, offset, size)
+        logging.info(f'Loaded {len(index_keys)} shard indexes with '
+                     f'{len(self._members)} members from '
+                     f's3://{self.bucket_name}/{self.prefix}')
+
+
+################ Transfer Helpers ######################
+def _get_src_size(src_data):
+    ''' Return the size in bytes of src_data (bytes or a file name).
+        None is returned if the size cannot be determined '''
+    if isinstance(src_data, bytes):
+        return len(src_data)
+    elif isinstance(src_data, str):
+        try:
+            return os.path.getsize(src_data)
+        except OSError:
+            # Let the caller hit (and log) the error when opening the file
+            return None
+    return None
+
+
+def _make_part_ranges(total_size, part_size):
+    ''' Split total_size bytes into a list of (offset, length) tuples.
+        part_size is bumped up as needed so that the S3 limits on
+        minimum part size and maximum number of parts are honoured '''
+    part_size = max(part_size, aws_s3_settings.S3_MULTIPART_MIN_PART_SIZE)
+    max_parts = aws_s3_settings.S3_MULTIPART_MAX_PARTS
+    if math.ceil(total_size / part_size) > max_parts:
+        part_size = math.ceil(total_size / max_parts)
+    if total_size == 0:
+        return [(0, 0)]
+    return _split_range(total_size, part_size)
+
+
+def _split_range(total_size, part_size):
+    ''' Split total_size bytes into (offset, length) tuples of part_size '''
+    return [(offset, min(part_size, total_size - offset))
+            for offset in range(0, total_size, part_size)]
+
+
+def _read_src_part(src_data, offset, length):
+    ''' Read length bytes starting at offset from src_data '''
+    if isinstance(src_data, bytes):
+        return src_data[offset:offset + length]
+    with open(src_data, 'rb') as fh:
+        fh.seek(offset)
+        return fh.read(length)
+
+
+def _call_with_retries(func, max_retries, limiter=None, **kwargs):
+    ''' Call func(**kwargs), retrying up to max_retries times with
+        exponential backoff if it raises a retryable botocore error.
+        With a limiter (an AdaptiveConcurrencyLimiter) the call waits for
+        a slot in it, and throttling errors lower its limit and are
+        retried by it '''
+    for attempt in range(max_retries + 1):
+        try:
+            if limiter is not None:
+                return limiter.call(func, **kwargs)
+            return func(**kwargs)
+        except (ClientError, BotoCoreError,
+                aws_exceptions.AWS_S3_IncompleteRead) as e:
+            if attempt == max_retries or not _is_retryable(e):
+                raise
+            # The limiter has already run out of throttling retries
+            if (limiter is not None and isinstance(e, ClientError) and
+                    limiter.is_throttling_error(e)):
+                raise
+            delay = aws_s3_settings.S3_TRANSFER_RETRY_BASE_DELAY * 2**attempt
+            logging.warning(f'{e}. Retrying in {delay} seconds')
+            time.sleep(delay)
+
+
+def _is_retryable(e):
+    ''' Errors like NoSuchKey or AccessDenied will not go away by retrying.
+        Everything else (5xx, throttling, timeouts, dropped connections)
+        is worth another try '''
+    if isinstance(e, ClientError):
+        status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        code = e.response.get('Error', {}).get('Code')
+        if (status and 400 <= status < 500 and
+                code not in aws_s3_settings.S3_RETRYABLE_CLIENT_ERRORS):
+            return False
+    return True
+
+
+def _download_ranges(s3_client, bucket_name, object_name, etag, dest_view,
+                     part_size, max_workers, max_retries, limiter=None):
+    ''' Fill dest_view (a writable memoryview the size of the object)
+        with concurrent ranged GETs of the object. Raises on failure '''
+    def _download_range(offset, length):
+        _fetch_range(s3_client, bucket_name, object_name, etag, offset,
+                     dest_view[offset:offset + length], max_retries,
+                     limiter=limiter)
+
+    # Nothing to fetch for an empty object
+    if len(dest_view) == 0:
+        return
+    part_ranges = _split_range(len(dest_view), part_size)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_download_range, offset, length)
+                   for offset, length in part_ranges]
+        try:
+            for f in futures:
+                f.result()
+        except BaseException:
+            for f in futures:
+                f.cancel()
+            raise
+
+
+def _fetch_range(s3_client, bucket_name, object_name, etag, offset,
+                 dest_view, max_retries, limiter=None):
+    ''' Fetch len(dest_view) bytes of the object starting at offset into
+        dest_view with a single ranged GET. Raises on failure '''
+    length = len(dest_view)
+
+    # Without an etag there is no check that the object did not change
+    if_match = {'IfMatch': etag} if etag else {}
+
+    def _fetch():
+        resp = s3_client.get_object(
+                      Bucket=bucket_name, Key=object_name,
+                      Range=f'bytes={offset}-{offset + length - 1}',
+                      **if_match)
+        pos = 0
+        chunk_size = aws_s3_settings.S3_DOWNLOAD_CHUNK_SIZE
+        for chunk in resp['Body'].iter_chunks(chunk_size):
+            dest_view[pos:pos + len(chunk)] = chunk
+            pos += len(chunk)
+        if pos != length:
+            raise aws_exceptions.AWS_S3_IncompleteRead(
+                    f'{object_name}: got {pos} of {length} bytes '
+                    f'for range starting at {offset}')
+    # Retrying re-fetches the whole range, including any bytes that
+    # were already written before a read error
+    _call_with_retries(_fetch, max_retries, limiter=limiter)
+
+
+def _download_to_file(s3_client, bucket_name, object_name, obj_size,
+                      obj_etag, dest_file_name, part_size, max_workers,
+                      max_retries, limiter=None):
+    ''' Download an object of known size and ETag into dest_file_name
+        (via dest_file_name + '.part'). See get_object '''
+    tmp_file_name = dest_file_name + '.part'
+    try:
+        with open(tmp_file_name, 'w+b') as fh:
+            # mmap cannot map an empty file. Nothing to fetch in that case
+            if obj_size > 0:
+                fh.truncate(obj_size)
+                with mmap.mmap(fh.fileno(), obj_size) as mm:
+                    _download_ranges(s3_client, bucket_name,
+                                     object_name, obj_etag,
+                                     memoryview(mm), part_size,
+                                     max_workers, max_retries,
+                                     limiter=limiter)
+                    mm.flush()
+        os.replace(tmp_file_name, dest_file_name)
+    except (ClientError, BotoCoreError, OSError,
+            aws_exceptions.AWS_S3_IncompleteRead) as e:
+        logging.error(f'Download of {object_name} failed')
+        logging.error(e)
+        _remove_file(tmp_file_name)
+        return aws_s3_settings.S3_GET_OBJECT_FAIL
+    except BaseException:
+        _remove_file(tmp_file_name)
+        raise
+    return aws_s3_settings.S3_GET_OBJECT_SUCCESS
+
+
+def _remove_file(file_name):
+    ''' Remove file_name if it exists '''
+    try:
+        os.remove(file_name)
+    except FileNotFoundError:
+        pass
+
+
+def _abort_multipart_upload(s3_client, bucket_name, object_name, upload_id):
+    ''' Abort a multipart upload, logging (but otherwise ignoring) errors
+        since this is only ever called while handling another failure '''
+    try:
+        s3_client.abort_multipart_upload(Bucket=bucket_name, Key=object_name,
+                                         UploadId=upload_id)
+    except (ClientError, BotoCoreError) as e:
+        logging.error(f'Failed to abort multipart upload {upload_id}')
+        logging.error(e)
+
+
+def _iter_list_pages(s3_client, bucket_name, prefix='', delimiter=None,
+                     start_after=None, fetch_owner=False, limiter=None):
+    ''' Yield the pages of a list_objects_v2 listing. With a limiter every
+        page is requested through it '''
+    kwargs = {'Bucket': bucket_name, 'Prefix': prefix,
+              'FetchOwner': fetch_owner}
+    if delimiter:
+        kwargs['Delimiter'] = delimiter
+    if start_after:
+        kwargs['StartAfter'] = start_after
+    if limiter is None:
+        # pagination is used in case there are > 1000 objects
+        paginator = s3_client.get_paginator('list_objects_v2')
+        yield from paginator.paginate(**kwargs)
+        return
+    while True:
+        page = limiter.call(s3_client.list_objects_v2, **kwargs)
+        yield page
+        if not page.get('NextContinuationToken'):
+            return
+        kwargs['ContinuationToken'] = page['NextContinuationToken']
+
+
+def _select_fields(obj, fields):
+    ''' Return only the requested fields of obj (all if fields is None) '''
+    if fields is None:
+        return obj
+    return {k: obj[k] for k in fields if k in obj}
+
+
+def _object_identifier(obj):
+    ''' Make a delete_objects identifier from a key or an object dict '''
+    if isinstance(obj, str):
+        return {'Key': obj}
+    ident = {'Key': obj['Key']}
+    if obj.get('VersionId'):
+        ident['VersionId'] = obj['VersionId']
+    return ident
+
+
+def _is_retryable_key_error(code):
+    ''' Check if a per key error code from delete_objects is transient '''
+    return (code in aws_s3_settings.S3_RETRYABLE_SERVER_ERRORS or
+            code in aws_s3_settings.S3_RETRYABLE_CLIENT_ERRORS)
+
+
+def _split_delete_errors(resp, failed):
+    ''' Add the permanent per key errors of a (Quiet) delete_objects
+        response to failed. Returns the errors worth retrying.
+        Shared with s3_async_utils, so both retry the same keys '''
+    # With Quiet set only the keys that failed are returned
+    errors = resp.get('Errors', [])
+    failed.extend(e for e in errors
+                  if not _is_retryable_key_error(e.get('Code')))
+    return [e for e in errors if _is_retryable_key_error(e.get('Code'))]
+
+
+def _delete_call_errors(e, pending):
+    ''' Make the per key errors for a delete_objects call that failed as
+        a whole with e '''
+    code = (e.response['Error'].get('Code', '')
+            if isinstance(e, ClientError) else type(e).__name__)
+    return [dict(x, Code=code, Message=str(e)) for x in pending]
+
+
+def _group_by_top_level(keys):
+    ''' Group keys by their part up to the first '/'. Returns a list of
+        lists of keys '''
+    groups = {}
+    for key in keys:
+        groups.setdefault(key.partition('/')[0], []).append(key)
+    return list(groups.values())
+
+
+def _make_limiter(limiter, max_workers):
+    ''' Return limiter, or a new AdaptiveConcurrencyLimiter for a pool of
+        max_workers threads if it is None '''
+    if limiter is not None:
+        return limiter
+    return aws_concurrency_utils.AdaptiveConcurrencyLimiter(
+                        initial_limit=max_workers, max_limit=max_workers)
+
+
+def _iter_batches(iterable, batch_size):
+    ''' Yield lists of up to batch_size items from iterable '''
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _map_bounded(executor, func, iterable, max_in_flight):
+    ''' Like executor.map, but consumes iterable lazily so that at most
+        max_in_flight calls are queued at any time. Yields (item, result)
+        tuples in completion order '''
+    in_flight = {}
+    try:
+        for item in iterable:
+            if len(in_flight) >= max_in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for f in done:
+                    yield in_flight.pop(f), f.result()
+            in_flight[executor.submit(func, item)] = item
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for f in done:
+                yield in_flight.pop(f), f.result()
+    finally:
+        for f in in_flight:
+            f.cancel()
+
+
+def _pack_index_key(shard_key):
+    ''' Return the key of the index object of a pack shard '''
+    shard_suffix = aws_s3_settings.S3_PACK_SHARD_SUFFIX
+    return (shard_key[:-len(shard_suffix)] +
+            aws_s3_settings.S3_PACK_INDEX_SUFFIX)
+
+
+def _read_manifest(manifest_file):
+    ''' Read a sync manifest. An empty one if there is none '''
+    try:
+        with open(manifest_file) as fh:
+            return json.load(fh)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _write_manifest(manifest_file, manifest):
+    ''' Atomically write a sync manifest '''
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_file)),
+                exist_ok=True)
+    tmp_file = f'{manifest_file}.{os.getpid()}'
+    with open(tmp_file, 'w') as fh:
+        json.dump(manifest, fh)
+    os.replace(tmp_file, manifest_file)
+
+
+# Marks an object that was not looked up in a listing. See _is_unchanged
+_NOT_LISTED = object()
+
+
+def _compute_checksums(src_data, multipart_threshold, part_size,
+                       with_sha256=True):
+    ''' Compute the ETag put_object would give src_data (bytes or a file
+        name), and the SHA256 of the data, in a single streaming pass.
+        Returns (etag, sha256), with sha256 None if not with_sha256 '''
+    size = _get_src_size(src_data)
+    multipart = multipart_threshold is not None and size > multipart_threshold
+    if multipart:
+        part_ranges = _make_part_ranges(size, part_size)
+    else:
+        part_ranges = [(0, size)]
+    sha256 = hashlib.sha256() if with_sha256 else None
+    chunk_size = aws_s3_settings.S3_HASH_CHUNK_SIZE
+
+    part_digests = []
+    with _open_src(src_data) as fh:
+        for _, length in part_ranges:
+            md5 = hashlib.md5()
+            while length > 0:
+                chunk = fh.read(min(chunk_size, length))
+                if not chunk:
+                    # The file was truncated while we were reading it
+                    break
+                md5.update(chunk)
+                if sha256 is not None:
+                    sha256.update(chunk)
+                length -= len(chunk)
+            part_digests.append(md5.digest())
+
+    if multipart:
+        etag = hashlib.md5(b''.join(part_digests)).hexdigest()
+        etag = f'"{etag}-{len(part_ranges)}"'
+    else:
+        etag = f'"{part_digests[0].hex()}"'
+    return etag, sha256.hexdigest() if sha256 is not None else None
+
+
+def _is_unchanged(s3_client, bucket_name, object_name, size, etag, sha256,
+                  listed_obj=_NOT_LISTED, limiter=None):
+    ''' Check if the object in S3 has the content with the given size,
+        ETag and SHA256. listed_obj is the object's entry from a listing
+        (None if the listing did not have it). If it is not given the
+        object is looked up with a HEAD '''
+    if listed_obj is None:
+        return False
+    if listed_obj is not _NOT_LISTED:
+        if listed_obj['Size'] != size:
+            return False
+        if listed_obj['ETag'] == etag:
+            return True
+        # The ETag can differ for the same data (SSE-KMS, other part
+        # sizes). The stored checksum in the metadata settles it
+    try:
+        resp = _call_with_retries(s3_client.head_object, 0, limiter=limiter,
+                                  Bucket=bucket_name, Key=object_name)
+    except ClientError:
+        # Most likely 404. Either way, upload it
+        return False
+    metadata = resp.get('Metadata', {})
+    return (resp['ContentLength'] == size and
+            (resp['ETag'] == etag or
+             metadata.get(aws_s3_settings.S3_CHECKSUM_METADATA_KEY) == sha256))
+
+
+def _sql_prefix_clause(prefix):
+    ''' A WHERE clause matching keys starting with prefix. A key range
+        rather than LIKE, so that the primary key index is used '''
+    if not prefix:
+        return '1'
+    return 'key >= ? AND key < ?'
+
+
+def _sql_prefix_args(prefix):
+    ''' The arguments for _sql_prefix_clause '''
+    if not prefix:
+        return ()
+    # The smallest string greater than all strings starting with prefix
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _to_epoch(value):
+    ''' Convert a datetime to epoch seconds. Numbers are returned as is '''
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    return value
+
+
+# Content-Encodings that put_object_compressed writes and the get
+# functions decompress
+_COMPRESSIONS = ('gzip', 'zstd')
+# Raised by the decompressors on corrupt data
+_DECOMPRESS_ERRORS = ((zlib.error,) if zstandard is None else
+                      (zlib.error, zstandard.ZstdError))
+
+
+def _make_compressor(compression, level=None):
+    ''' Return a streaming compressor (with compress() and flush()) '''
+    if compression not in _COMPRESSIONS:
+        raise aws_exceptions.AWS_NotImplementedError(
+                    f'Compression {compression} is not supported')
+    if level is None:
+        level = aws_s3_settings.S3_COMPRESSION_DEFAULT_LEVELS[compression]
+    if compression == 'gzip':
+        # wbits of 16 + MAX_WBITS == gzip header and trailer
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if zstandard is None:
+        raise aws_exceptions.AWS_NotImplementedError(
+                    'zstd compression needs the zstandard package')
+    return zstandard.ZstdCompressor(level=level).compressobj()
+
+
+def _make_decompressor(compression):
+    ''' Return a streaming decompressor (with decompress() and eof) '''
+    if compression == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if zstandard is None:
+        raise aws_exceptions.AWS_NotImplementedError(
+                    'zstd decompression needs the zstandard package')
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def _download_decompressed(s3_client, bucket_name, object_name, etag,
+                           compression, out_fh, max_retries, limiter=None):
+    ''' Stream a compressed object through a decompressor into out_fh.
+        Raises on failure '''
+    def _fetch():
+        # Start over on a retry
+        out_fh.seek(0)
+        out_fh.truncate()
+        decompressor = _make_decompressor(compression)
+        resp = s3_client.get_object(Bucket=bucket_name, Key=object_name,
+                                    IfMatch=etag)
+        chunk_size = aws_s3_settings.S3_DOWNLOAD_CHUNK_SIZE
+        for chunk in resp['Body'].iter_chunks(chunk_size):
+            out_fh.write(decompressor.decompress(chunk))
+        if not getattr(decompressor, 'eof', True):
+            raise aws_exceptions.AWS_S3_IncompleteRead(
+                    f'{object_name}: compressed stream ended early')
+    _call_with_retries(_fetch, max_retries, limiter=limiter)
+
+
+def _open_src(src_data):
+    ''' Open src_data (bytes or a file name) as a binary file object '''
+    if isinstance(src_data, bytes):
+        return io.BytesIO(src_data)
+    return open(src_data, 'rb')
+
+
 # For some local testing and development
 if __name__ == '__main__':
     '''
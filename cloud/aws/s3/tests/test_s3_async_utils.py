@@ -0,0 +1,129 @@
+''' Run various tests on s3_async_utils
+
+    These tests do not talk to AWS. The aiobotocore client is stubbed
+'''
+
+import asyncio
+import pytest
+
+from aiobotocore.stub import AioStubber
+
+from pylibs.cloud.aws.s3 import s3_async_utils
+from pylibs.cloud.aws.config import aws_s3_settings
+
+# Constants
+TEST_BUCKET = 'pytest-bucket'
+
+
+def _run_stubbed(func, add_responses):
+    ''' Run the coroutine function func(s3) against a stubbed client '''
+    async def _run():
+        async with s3_async_utils.S3AsyncClient(max_concurrency=2) as s3:
+            with AioStubber(s3._client) as stubber:
+                add_responses(stubber)
+                result = await func(s3)
+                stubber.assert_no_pending_responses()
+                return result
+    return asyncio.run(_run())
+
+
+def test_put_objects():
+    ''' Test that results come back in order, failures included '''
+    def _add_responses(stubber):
+        stubber.add_response('put_object', {},
+                             {'Bucket': TEST_BUCKET, 'Key': 'a', 'Body': b'1'})
+        stubber.add_client_error('put_object',
+                                 service_error_code='NoSuchBucket',
+                                 http_status_code=404)
+
+    codes = _run_stubbed(lambda s3: s3.put_objects(TEST_BUCKET,
+                                                   [('a', b'1'), ('b', b'2')]),
+                         _add_responses)
+    assert codes == [aws_s3_settings.S3_PUT_OBJECT_SUCCESS,
+                     aws_s3_settings.S3_PUT_OBJECT_FAIL]
+
+
+def test_put_objects_is_bounded():
+    ''' Test that objects are consumed lazily, with a bounded number of
+        puts in flight '''
+    async def _run():
+        async with s3_async_utils.S3AsyncClient(max_concurrency=2) as s3:
+            in_flight = peak = 0
+
+            async def _put(bucket_name, name, data):
+                nonlocal in_flight, peak
+                in_flight += 1
+                peak = max(peak, in_flight)
+                await asyncio.sleep(0)
+                in_flight -= 1
+                return name
+
+            s3.put_object = _put
+            codes = await s3.put_objects(TEST_BUCKET, ((str(i), b'')
+                                                       for i in range(50)))
+            return codes, peak
+
+    codes, peak = asyncio.run(_run())
+    assert codes == [str(i) for i in range(50)]
+    assert peak <= 4
+
+
+def test_delete_objects_retries(monkeypatch):
+    ''' Test that keys failing with transient errors are retried and that
+        error codes are reported '''
+    monkeypatch.setattr(aws_s3_settings, 'S3_TRANSFER_RETRY_BASE_DELAY', 0)
+
+    def _add_responses(stubber):
+        stubber.add_response('delete_objects',
+                             {'Errors': [{'Key': 'a', 'Code': 'SlowDown'},
+                                         {'Key': 'b',
+                                          'Code': 'AccessDenied'}]},
+                             {'Bucket': TEST_BUCKET, 'Delete': {
+                                 'Objects': [{'Key': k} for k in 'abc'],
+                                 'Quiet': True}})
+        stubber.add_response('delete_objects', {},
+                             {'Bucket': TEST_BUCKET, 'Delete': {
+                                 'Objects': [{'Key': 'a'}], 'Quiet': True}})
+        stubber.add_client_error('delete_objects',
+                                 service_error_code='AccessDenied',
+                                 http_status_code=403)
+        # A 500 for the whole call is retried, like in s3_utils
+        stubber.add_client_error('delete_objects',
+                                 service_error_code='InternalError',
+                                 http_status_code=500)
+        stubber.add_response('delete_objects', {},
+                             {'Bucket': TEST_BUCKET, 'Delete': {
+                                 'Objects': [{'Key': 'e'}], 'Quiet': True}})
+
+    async def _delete(s3):
+        first = await s3.delete_objects(TEST_BUCKET, iter('abc'))
+        second = await s3.delete_objects(TEST_BUCKET, ['d'])
+        third = await s3.delete_objects(TEST_BUCKET, ['e'])
+        return first, second, third
+
+    (num_deleted, errors), (_, call_errors), third = _run_stubbed(
+                                                _delete, _add_responses)
+    assert third == (1, [])
+    assert num_deleted == 2
+    assert [(e['Key'], e['Code']) for e in errors] == [('b', 'AccessDenied')]
+    assert [(e['Key'], e['Code']) for e in call_errors] == \
+        [('d', 'AccessDenied')]
+
+
+def test_iter_objects():
+    ''' Test that the async listing pages through the bucket '''
+    def _add_responses(stubber):
+        stubber.add_response('list_objects_v2',
+                             {'Contents': [{'Key': 'a', 'Size': 1}],
+                              'IsTruncated': True,
+                              'NextContinuationToken': 'next'})
+        stubber.add_response('list_objects_v2',
+                             {'Contents': [{'Key': 'b', 'Size': 2}],
+                              'IsTruncated': False})
+
+    async def _list(s3):
+        return [obj async for obj in s3.iter_objects(TEST_BUCKET,
+                                                     fields=['Key'])]
+
+    assert _run_stubbed(_list, _add_responses) == [{'Key': 'a'},
+                                                   {'Key': 'b'}]
@@ -0,0 +1,583 @@
+''' Run various tests on s3_utils
+
+    These tests do not talk to AWS. The S3 client is replaced with one
+    that is stubbed using botocore's Stubber
+'''
+
+import io
+import json
+import gzip
+import hashlib
+import datetime
+import pytest
+import boto3
+
+from botocore.stub import Stubber, ANY
+from botocore.response import StreamingBody
+
+from pylibs.cloud.aws.s3 import s3_utils
+from pylibs.cloud.aws.common import aws_concurrency_utils
+from pylibs.cloud.aws.config import aws_s3_settings
+
+# Constants
+TEST_BUCKET = 'pytest-bucket'
+TEST_KEY = 'pytest/object.bin'
+TEST_UPLOAD_ID = 'pytest-upload-id'
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def s3_stub(monkeypatch):
+    ''' Make s3_utils use a stubbed S3 client and return the stubber '''
+    s3_client = boto3.client('s3', region_name='us-west-2',
+                             aws_access_key_id='pytest',
+                             aws_secret_access_key='pytest')
+    monkeypatch.setattr(s3_utils.aws_client_utils, 'get_client',
+                        lambda *args, **kwargs: s3_client)
+    monkeypatch.setattr(aws_s3_settings, 'S3_TRANSFER_RETRY_BASE_DELAY', 0)
+    with Stubber(s3_client) as stubber:
+        yield stubber
+        stubber.assert_no_pending_responses()
+
+
+def test_make_part_ranges():
+    ''' Test that parts cover the source exactly and honour S3 limits '''
+    ranges = s3_utils._make_part_ranges(12 * MB, 5 * MB)
+    assert ranges == [(0, 5 * MB), (5 * MB, 5 * MB), (10 * MB, 2 * MB)]
+
+    # Part size too small gets bumped to the S3 minimum
+    ranges = s3_utils._make_part_ranges(12 * MB, 1)
+    assert ranges[0] == (0, aws_s3_settings.S3_MULTIPART_MIN_PART_SIZE)
+
+    # Never more than the maximum number of parts
+    total = aws_s3_settings.S3_MULTIPART_MAX_PARTS * 6 * MB
+    ranges = s3_utils._make_part_ranges(total, 5 * MB)
+    assert len(ranges) <= aws_s3_settings.S3_MULTIPART_MAX_PARTS
+    assert sum(length for _, length in ranges) == total
+
+
+def test_put_object_multipart(s3_stub):
+    ''' Test that parts are uploaded and the upload completed '''
+    data = b'a' * (6 * MB)
+    s3_stub.add_response('create_multipart_upload',
+                         {'UploadId': TEST_UPLOAD_ID},
+                         {'Bucket': TEST_BUCKET, 'Key': TEST_KEY})
+    # A single worker keeps the order of the stubbed calls deterministic
+    for part_number in (1, 2):
+        s3_stub.add_response('upload_part', {'ETag': f'"etag{part_number}"'},
+                             {'Bucket': TEST_BUCKET, 'Key': TEST_KEY,
+                              'UploadId': TEST_UPLOAD_ID,
+                              'PartNumber': part_number, 'Body': ANY})
+    s3_stub.add_response('complete_multipart_upload', {},
+                         {'Bucket': TEST_BUCKET, 'Key': TEST_KEY,
+                          'UploadId': TEST_UPLOAD_ID,
+                          'MultipartUpload': {'Parts': [
+                              {'PartNumber': 1, 'ETag': '"etag1"'},
+                              {'PartNumber': 2, 'ETag': '"etag2"'}]}})
+
+    resp = s3_utils.put_object(TEST_BUCKET, TEST_KEY, data,
+                               multipart_threshold=5 * MB,
+                               part_size=5 * MB, max_workers=1)
+    assert resp == aws_s3_settings.S3_PUT_OBJECT_SUCCESS
+
+
+def test_put_object_multipart_aborts_on_failure(s3_stub):
+    ''' Test that a part that keeps failing aborts the upload '''
+    data = b'a' * (5 * MB)
+    s3_stub.add_response('create_multipart_upload',
+                         {'UploadId': TEST_UPLOAD_ID})
+    # First attempt plus one retry by the limiter. Throttling errors are
+    # not retried again on top of that
+    for _ in range(2):
+        s3_stub.add_client_error('upload_part', service_error_code='SlowDown',
+                                 http_status_code=503)
+    s3_stub.add_response('abort_multipart_upload', {},
+                         {'Bucket': TEST_BUCKET, 'Key': TEST_KEY,
+                          'UploadId': TEST_UPLOAD_ID})
+
+    limiter = aws_concurrency_utils.AdaptiveConcurrencyLimiter(
+                        max_retries=1, base_delay=0)
+    resp = s3_utils.put_object_multipart(TEST_BUCKET, TEST_KEY, data,
+                                         max_workers=1, max_retries=1,
+                                         limiter=limiter)
+    assert resp == aws_s3_settings.S3_PUT_OBJECT_FAIL
+    assert limiter.stats()['throttles'] == 2
+
+
+def test_put_object_multipart_throttled(s3_stub):
+    ''' Test that a throttled part lowers the concurrency and is retried '''
+    data = b'a' * (5 * MB)
+    s3_stub.add_response('create_multipart_upload',
+                         {'UploadId': TEST_UPLOAD_ID})
+    s3_stub.add_client_error('upload_part', service_error_code='SlowDown',
+                             http_status_code=503)
+    s3_stub.add_response('upload_part', {'ETag': '"etag1"'})
+    s3_stub.add_response('complete_multipart_upload', {})
+
+    limiter = aws_concurrency_utils.AdaptiveConcurrencyLimiter(
+                        initial_limit=4, base_delay=0)
+    resp = s3_utils.put_object_multipart(TEST_BUCKET, TEST_KEY, data,
+                                         max_workers=1, limiter=limiter)
+    assert resp == aws_s3_settings.S3_PUT_OBJECT_SUCCESS
+    stats = limiter.stats()
+    assert stats['throttles'] == 1
+    assert stats['successes'] == 1
+    assert stats['limit'] < 4
+
+
+def _add_ranged_get_responses(s3_stub, data, part_size, etag='"etag"'):
+    ''' Stub a head_object followed by one ranged get per part '''
+    s3_stub.add_response('head_object', {'ContentLength': len(data),
+                                         'ETag': etag},
+                         {'Bucket': TEST_BUCKET, 'Key': TEST_KEY})
+    for offset in range(0, len(data), part_size):
+        part = data[offset:offset + part_size]
+        s3_stub.add_response('get_object',
+                   {'Body': StreamingBody(io.BytesIO(part), len(part))},
+                   {'Bucket': TEST_BUCKET, 'Key': TEST_KEY, 'IfMatch': etag,
+                    'Range': f'bytes={offset}-{offset + len(part) - 1}'})
+
+
+def test_get_object(s3_stub, tmp_path):
+    ''' Test that ranges are written to the right place in the file '''
+    data = bytes(range(256)) * 10
+    _add_ranged_get_responses(s3_stub, data, 1000)
+    dest_file = str(tmp_path / 'object.bin')
+
+    resp = s3_utils.get_object(TEST_BUCKET, TEST_KEY, dest_file,
+                               part_size=1000, max_workers=1)
+    assert resp == aws_s3_settings.S3_GET_OBJECT_SUCCESS
+    with open(dest_file, 'rb') as fh:
+        assert fh.read() == data
+
+
+def test_get_object_bytes(s3_stub):
+    ''' Test that the in-memory variant returns a read-only view '''
+    data = b'0123456789'
+    _add_ranged_get_responses(s3_stub, data, 4)
+
+    view = s3_utils.get_object_bytes(TEST_BUCKET, TEST_KEY, part_size=4,
+                                     max_workers=1)
+    assert view.readonly
+    assert view.tobytes() == data
+
+
+def test_put_object_compressed_round_trip(s3_stub, tmp_path):
+    ''' Test that a gzip upload comes back decompressed on download '''
+    data = b'compress me ' * 1000
+    uploaded = {}
+
+    def _capture(params, **kwargs):
+        uploaded['body'] = params['Body']
+    s3_stub.client.meta.events.register('provide-client-params.s3.PutObject',
+                                        _capture)
+
+    s3_stub.add_response('put_object', {'ETag': '"etag"'},
+                         {'Bucket': TEST_BUCKET, 'Key': TEST_KEY, 'Body': ANY,
+                          'ContentEncoding': 'gzip',
+                          'Metadata': {'uncompressed-size': str(len(data))}})
+    resp = s3_utils.put_object_compressed(TEST_BUCKET, TEST_KEY, data)
+    assert resp == aws_s3_settings.S3_PUT_OBJECT_SUCCESS
+    body = uploaded['body']
+    assert len(body) < len(data)
+    assert gzip.decompress(body) == data
+
+    compressed = gzip.compress(data)
+    s3_stub.add_response('head_object', {'ContentLength': len(compressed),
+                                         'ETag': '"etag"',
+                                         'ContentEncoding': 'gzip'},
+                         {'Bucket': TEST_BUCKET, 'Key': TEST_KEY})
+    s3_stub.add_response('get_object',
+               {'Body': StreamingBody(io.BytesIO(compressed),
+                                      len(compressed))},
+               {'Bucket': TEST_BUCKET, 'Key': TEST_KEY, 'IfMatch': '"etag"'})
+    dest_file = str(tmp_path / 'object.bin')
+    resp = s3_utils.get_object(TEST_BUCKET, TEST_KEY, dest_file)
+    assert resp == aws_s3_settings.S3_GET_OBJECT_SUCCESS
+    with open(dest_file, 'rb') as fh:
+        assert fh.read() == data
+
+
+def test_get_object_bytes_compressed_limiter_and_corrupt(s3_stub):
+    ''' Test that the compressed path goes through the limiter and that a
+        corrupt stream is a failure, not an exception '''
+    for body in (gzip.compress(b'data'), b'not gzip at all'):
+        s3_stub.add_response('head_object', {'ContentLength': len(body),
+                                             'ETag': '"etag"',
+                                             'ContentEncoding': 'gzip'},
+                             {'Bucket': TEST_BUCKET, 'Key': TEST_KEY})
+        s3_stub.add_response('get_object',
+                   {'Body': StreamingBody(io.BytesIO(body), len(body))},
+                   {'Bucket': TEST_BUCKET, 'Key': TEST_KEY,
+                    'IfMatch': '"etag"'})
+    limiter = aws_concurrency_utils.AdaptiveConcurrencyLimiter()
+    view = s3_utils.get_object_bytes(TEST_BUCKET, TEST_KEY, limiter=limiter)
+    assert view.tobytes() == b'data'
+    assert limiter.stats()['successes'] == 1
+    assert s3_utils.get_object_bytes(TEST_BUCKET, TEST_KEY) is None
+
+
+def _list_page(keys, **extra):
+    ''' Make a list_objects_v2 response page for keys '''
+    page = {'Contents': [{'Key': k, 'Size': 1, 'ETag': '"e"'} for k in keys],
+            'KeyCount': len(keys), 'IsTruncated': False}
+    page.update(extra)
+    return page
+
+
+def test_iter_s3_objects_fields(s3_stub):
+    ''' Test that only the requested fields are returned '''
+    s3_stub.add_response('list_objects_v2', _list_page(['a', 'b']),
+                         {'Bucket': TEST_BUCKET, 'Prefix': 'pre/',
+                          'FetchOwner': False, 'StartAfter': 'pre/0'})
+    objs = list(s3_utils.iter_s3_objects(TEST_BUCKET, prefix='pre/',
+                                         start_after='pre/0',
+                                         fields=['Key']))
+    assert objs == [{'Key': 'a'}, {'Key': 'b'}]
+
+
+def test_iter_s3_objects_parallel_split_keys(s3_stub):
+    ''' Test that split keys partition the key space without overlap '''
+    # Shard 1: keys <= 'b'. The listing overshoots and must be trimmed
+    s3_stub.add_response('list_objects_v2', _list_page(['a', 'b', 'c']),
+                         {'Bucket': TEST_BUCKET, 'Prefix': '',
+                          'FetchOwner': False})
+    # Shard 2: keys > 'b'
+    s3_stub.add_response('list_objects_v2', _list_page(['c', 'd']),
+                         {'Bucket': TEST_BUCKET, 'Prefix': '',
+                          'FetchOwner': False, 'StartAfter': 'b'})
+    objs = s3_utils.iter_s3_objects_parallel(TEST_BUCKET, split_keys=['b'],
+                                             fields=['Key'], max_workers=1)
+    assert sorted(x['Key'] for x in objs) == ['a', 'b', 'c', 'd']
+
+
+def test_iter_s3_objects_parallel_prefixes(s3_stub):
+    ''' Test fan out over the common prefixes '''
+    s3_stub.add_response('list_objects_v2', _list_page([], CommonPrefixes=[
+                                        {'Prefix': 'x/'}, {'Prefix': 'y/'}]))
+    s3_stub.add_response('list_objects_v2', _list_page(['top']))
+    s3_stub.add_response('list_objects_v2', _list_page(['x/1', 'x/2']))
+    s3_stub.add_response('list_objects_v2', _list_page(['y/1']))
+    objs = s3_utils.iter_s3_objects_parallel(TEST_BUCKET, fields=['Key'],
+                                             max_workers=1)
+    assert sorted(x['Key'] for x in objs) == ['top', 'x/1', 'x/2', 'y/1']
+
+
+def test_delete_s3_objects(s3_stub):
+    ''' Test batching and retry of keys that failed with transient errors '''
+    keys = [f'key{i:04d}' for i in range(1500)]
+    s3_stub.add_response('delete_objects',
+                         {'Errors': [{'Key': 'key0007', 'Code': 'SlowDown'},
+                                     {'Key': 'key0008',
+                                      'Code': 'AccessDenied'}]},
+                         {'Bucket': TEST_BUCKET, 'Delete': {
+                             'Objects': [{'Key': k} for k in keys[:1000]],
+                             'Quiet': True}})
+    s3_stub.add_response('delete_objects', {},
+                         {'Bucket': TEST_BUCKET, 'Delete': {
+                             'Objects': [{'Key': 'key0007'}],
+                             'Quiet': True}})
+    s3_stub.add_response('delete_objects', {},
+                         {'Bucket': TEST_BUCKET, 'Delete': {
+                             'Objects': [{'Key': k} for k in keys[1000:]],
+                             'Quiet': True}})
+
+    num_deleted, errors = s3_utils.delete_s3_objects(TEST_BUCKET, iter(keys),
+                                                     max_workers=1)
+    assert num_deleted == 1499
+    assert [e['Key'] for e in errors] == ['key0008']
+
+
+def test_empty_and_delete_s3_bucket(s3_stub):
+    ''' Test that versions and delete markers are deleted with the bucket '''
+    s3_stub.add_response('list_object_versions',
+                         {'Versions': [{'Key': 'a', 'VersionId': 'v1'}],
+                          'DeleteMarkers': [{'Key': 'a', 'VersionId': 'v2'}]},
+                         {'Bucket': TEST_BUCKET, 'Prefix': ''})
+    s3_stub.add_response('delete_objects', {},
+                         {'Bucket': TEST_BUCKET, 'Delete': {
+                             'Objects': [{'Key': 'a', 'VersionId': 'v1'},
+                                         {'Key': 'a', 'VersionId': 'v2'}],
+                             'Quiet': True}})
+    s3_stub.add_response('delete_bucket',
+                         {'ResponseMetadata': {'HTTPStatusCode': 204}},
+                         {'Bucket': TEST_BUCKET})
+
+    resp = s3_utils.empty_and_delete_s3_bucket(TEST_BUCKET, max_workers=1)
+    assert resp == aws_s3_settings.S3_BUCKET_DELETE_SUCCESS
+
+
+def test_s3_object_cache(s3_stub, tmp_path):
+    ''' Test that a cached object is revalidated rather than downloaded
+        again, and that least recently used objects are evicted '''
+    data = b'label map'
+    cache = s3_utils.S3ObjectCache(cache_dir=str(tmp_path), ttl=0,
+                                   max_size_bytes=len(data))
+    _add_ranged_get_responses(s3_stub, data, len(data))
+    path = cache.get_file(TEST_BUCKET, TEST_KEY)
+    with open(path, 'rb') as fh:
+        assert fh.read() == data
+
+    # Unchanged in S3. Only a conditional HEAD is made
+    s3_stub.add_client_error('head_object', service_error_code='304',
+                             http_status_code=304,
+                             expected_params={'Bucket': TEST_BUCKET,
+                                              'Key': TEST_KEY,
+                                              'IfNoneMatch': '"etag"'})
+    assert cache.get_file(TEST_BUCKET, TEST_KEY) == path
+
+    # Caching another object pushes the first one out
+    s3_stub.add_response('head_object', {'ContentLength': 5, 'ETag': '"e2"'})
+    s3_stub.add_response('get_object',
+                         {'Body': StreamingBody(io.BytesIO(b'other'), 5)})
+    cache.get_file(TEST_BUCKET, 'other')
+    assert cache.cache_size() == 5
+
+
+def test_compute_etag(tmp_path):
+    ''' Test single part and multipart ETags '''
+    file_name = tmp_path / 'data.bin'
+    file_name.write_bytes(b'a' * (6 * MB))
+    assert s3_utils.compute_etag(str(file_name), multipart_threshold=None) \
+        == '"%s"' % hashlib.md5(b'a' * (6 * MB)).hexdigest()
+    part_md5s = (hashlib.md5(b'a' * (5 * MB)).digest() +
+                 hashlib.md5(b'a' * MB).digest())
+    assert s3_utils.compute_etag(str(file_name), multipart_threshold=MB,
+                                 part_size=5 * MB) \
+        == '"%s-2"' % hashlib.md5(part_md5s).hexdigest()
+
+
+def test_sync_dir_to_s3(s3_stub, tmp_path):
+    ''' Test that only changed files are uploaded and stale keys deleted '''
+    src_dir = tmp_path / 'src'
+    src_dir.mkdir()
+    (src_dir / 'same.txt').write_bytes(b'same')
+    (src_dir / 'new.txt').write_bytes(b'new')
+    manifest_file = str(tmp_path / 'manifest.json')
+    same_etag = '"%s"' % hashlib.md5(b'same').hexdigest()
+
+    s3_stub.add_response('list_objects_v2', {'Contents': [
+                            {'Key': 'pre/same.txt', 'Size': 4,
+                             'ETag': same_etag},
+                            {'Key': 'pre/stale.txt', 'Size': 1,
+                             'ETag': '"x"'}]})
+    s3_stub.add_response('put_object', {},
+                         {'Bucket': TEST_BUCKET, 'Key': 'pre/new.txt',
+                          'Body': ANY})
+    s3_stub.add_response('delete_objects', {},
+                         {'Bucket': TEST_BUCKET, 'Delete': {
+                             'Objects': [{'Key': 'pre/stale.txt'}],
+                             'Quiet': True}})
+
+    summary = s3_utils.sync_dir_to_s3(str(src_dir), TEST_BUCKET, 'pre',
+                                      delete=True,
+                                      manifest_file=manifest_file,
+                                      max_workers=1)
+    assert summary['uploaded'] == ['pre/new.txt']
+    assert summary['skipped'] == ['pre/same.txt']
+    assert summary['deleted'] == ['pre/stale.txt']
+    assert summary['failed'] == []
+
+
+def test_s3_file_readahead(s3_stub):
+    ''' Test that read-ahead grows for sequential reads and is reset by
+        a seek '''
+    data = bytes(range(40))
+
+    def _expect_get(start, end):
+        part = data[start:end]
+        s3_stub.add_response('get_object',
+                   {'Body': StreamingBody(io.BytesIO(part), len(part))},
+                   {'Bucket': TEST_BUCKET, 'Key': TEST_KEY, 'IfMatch': '"e"',
+                    'Range': f'bytes={start}-{end - 1}'})
+
+    s3_stub.add_response('head_object', {'ContentLength': 40, 'ETag': '"e"'})
+    _expect_get(0, 8)      # Read-ahead doubled from 4 to 8
+    _expect_get(8, 24)     # Sequential. Doubled again to 16
+    _expect_get(30, 34)    # After a seek. Back to 4
+    _expect_get(34, 40)    # Sequential again. Short read at the end
+
+    with s3_utils.S3File(TEST_BUCKET, TEST_KEY, min_readahead=4,
+                         max_readahead=16) as fh:
+        assert fh.read(2) == data[0:2]
+        assert fh.read(2) == data[2:4]
+        assert fh.read(10) == data[4:14]
+        assert fh.seek(-10, io.SEEK_END) == 30
+        assert fh.read(4) == data[30:34]
+        assert fh.read() == data[34:40]
+        assert fh.read(1) == b''
+
+
+def test_put_object_dedup(s3_stub):
+    ''' Test that an unchanged object is not uploaded again '''
+    data = b'unchanged'
+    s3_stub.add_response('head_object',
+                         {'ContentLength': len(data),
+                          'ETag': '"%s"' % hashlib.md5(data).hexdigest()},
+                         {'Bucket': TEST_BUCKET, 'Key': TEST_KEY})
+    resp = s3_utils.put_object(TEST_BUCKET, TEST_KEY, data, dedup=True)
+    assert resp == aws_s3_settings.S3_PUT_OBJECT_SKIPPED
+
+
+def test_put_objects_dedup(s3_stub):
+    ''' Test that the stored checksum is used when the ETag differs, and
+        that uploads carry the checksum '''
+    same, changed = b'same', b'changed'
+    s3_stub.add_response('head_object',
+                         {'ContentLength': len(same), 'ETag': '"kms"',
+                          'Metadata': {'sha256':
+                                       hashlib.sha256(same).hexdigest()}},
+                         {'Bucket': TEST_BUCKET, 'Key': 'same'})
+    s3_stub.add_client_error('head_object', service_error_code='404',
+                             http_status_code=404,
+                             expected_params={'Bucket': TEST_BUCKET,
+                                              'Key': 'changed'})
+    s3_stub.add_response('put_object', {},
+                         {'Bucket': TEST_BUCKET, 'Key': 'changed',
+                          'Body': changed, 'Metadata': {
+                              'sha256': hashlib.sha256(changed).hexdigest()}})
+
+    results = s3_utils.put_objects(TEST_BUCKET, [('same', same),
+                                                 ('changed', changed)],
+                                   max_workers=1)
+    assert results == {'same': aws_s3_settings.S3_PUT_OBJECT_SKIPPED,
+                       'changed': aws_s3_settings.S3_PUT_OBJECT_SUCCESS}
+
+
+def test_put_objects_dedup_listing(s3_stub, monkeypatch):
+    ''' Test that the ETags are listed per top level prefix, and that
+        keys without a usable common prefix get a HEAD '''
+    monkeypatch.setattr(aws_s3_settings, 'S3_DEDUP_LISTING_MIN_KEYS', 2)
+    data = b'data'
+    etag = f'"{hashlib.md5(data).hexdigest()}"'
+    s3_stub.add_response('list_objects_v2',
+                         {'Contents': [{'Key': 'a/1', 'Size': len(data),
+                                        'ETag': etag}]},
+                         {'Bucket': TEST_BUCKET, 'Prefix': 'a/',
+                          'FetchOwner': False})
+    # Not in the listing of a/, so uploaded without a HEAD
+    s3_stub.add_response('put_object', {},
+                         {'Bucket': TEST_BUCKET, 'Key': 'a/2',
+                          'Body': data, 'Metadata': ANY})
+    # Top level keys share no prefix. They are not listed
+    s3_stub.add_response('head_object',
+                         {'ContentLength': len(data), 'ETag': etag},
+                         {'Bucket': TEST_BUCKET, 'Key': 'x'})
+    s3_stub.add_response('head_object',
+                         {'ContentLength': len(data), 'ETag': etag},
+                         {'Bucket': TEST_BUCKET, 'Key': 'y'})
+
+    results = s3_utils.put_objects(TEST_BUCKET,
+                                   [(key, data) for key in
+                                    ('a/1', 'a/2', 'x', 'y')],
+                                   max_workers=1)
+    skipped = aws_s3_settings.S3_PUT_OBJECT_SKIPPED
+    assert results == {'a/1': skipped,
+                       'a/2': aws_s3_settings.S3_PUT_OBJECT_SUCCESS,
+                       'x': skipped, 'y': skipped}
+
+
+def test_s3_inventory_index(s3_stub):
+    ''' Test full and incremental refreshes and local queries '''
+    def _obj(key, size, day):
+        return {'Key': key, 'Size': size, 'ETag': '"e"',
+                'LastModified': datetime.datetime(2020, 1, day,
+                                                  tzinfo=datetime.timezone.utc)}
+
+    index = s3_utils.S3InventoryIndex(TEST_BUCKET, db_file=':memory:')
+    # Full refresh: the common prefixes (none here to keep the stubbed
+    # calls in order), then the objects under the prefix
+    s3_stub.add_response('list_objects_v2', {})
+    s3_stub.add_response('list_objects_v2', {'Contents': [
+                                _obj('cam/a/1', 10, 1), _obj('cam/b/1', 5, 2),
+                                _obj('cam/c', 1, 3)]})
+    assert index.refresh('cam/', max_workers=1) == 3
+    assert index.total_size('cam/') == (3, 16)
+
+    # Incremental refresh only lists keys after the last one seen
+    s3_stub.add_response('list_objects_v2',
+                         {'Contents': [_obj('cam/d/1', 100, 4)]},
+                         {'Bucket': TEST_BUCKET, 'Prefix': 'cam/',
+                          'FetchOwner': False, 'StartAfter': 'cam/c'})
+    assert index.refresh('cam/') == 1
+
+    assert index.size_by_prefix('cam/') == {'cam/a/': (1, 10),
+                                            'cam/b/': (1, 5),
+                                            'cam/c': (1, 1),
+                                            'cam/d/': (1, 100)}
+    newer = datetime.datetime(2020, 1, 2, 12, tzinfo=datetime.timezone.utc)
+    assert [x['Key'] for x in index.query('cam/', modified_after=newer)] \
+        == ['cam/c', 'cam/d/1']
+    assert [x['Key'] for x in index.query('cam/b', min_size=1)] == ['cam/b/1']
+
+
+def test_pack_dir_to_s3_and_read(s3_stub, tmp_path):
+    ''' Test that packed members are read back with a single ranged GET '''
+    (tmp_path / 'sub').mkdir()
+    (tmp_path / 'a.bin').write_bytes(b'aaaa')
+    (tmp_path / 'sub' / 'b.bin').write_bytes(b'bbbbbb')
+    (tmp_path / 'c.bin').write_bytes(b'cc')
+    uploaded = {}
+
+    def _capture(params, **kwargs):
+        uploaded[params['Key']] = params['Body']
+    s3_stub.client.meta.events.register('provide-client-params.s3.PutObject',
+                                        _capture)
+    # a.bin and c.bin fit in the first shard, sub/b.bin goes in the second
+    for _ in range(4):
+        s3_stub.add_response('put_object', {'ETag': '"etag"'})
+    summary = s3_utils.pack_dir_to_s3(str(tmp_path), TEST_BUCKET, 'packed',
+                                      shard_size=10, max_workers=1)
+    assert summary == {'shards': ['packed/shard-00000.pack',
+                                  'packed/shard-00001.pack'],
+                       'packed': 3, 'failed': []}
+    assert uploaded['packed/shard-00000.pack'] == b'aaaacc'
+    index = json.loads(uploaded['packed/shard-00000.index.json'])
+    assert index == {'shard': 'shard-00000.pack',
+                     'members': {'a.bin': [0, 4], 'c.bin': [4, 2]}}
+
+    index_keys = ['packed/shard-00000.index.json',
+                  'packed/shard-00001.index.json']
+    s3_stub.add_response('list_objects_v2',
+                         _list_page(['packed/shard-00000.pack'] + index_keys))
+    for key in index_keys:
+        body = uploaded[key]
+        s3_stub.add_response('get_object',
+                   {'Body': StreamingBody(io.BytesIO(body), len(body))},
+                   {'Bucket': TEST_BUCKET, 'Key': key})
+    reader = s3_utils.S3PackReader(TEST_BUCKET, 'packed', max_workers=1)
+    assert sorted(reader.names()) == ['a.bin', 'c.bin', 'sub/b.bin']
+
+    s3_stub.add_response('get_object',
+               {'Body': StreamingBody(io.BytesIO(b'cc'), 2)},
+               {'Bucket': TEST_BUCKET, 'Key': 'packed/shard-00000.pack',
+                'Range': 'bytes=4-5'})
+    assert reader.read('c.bin') == b'cc'
+
+
+def test_background_uploader(s3_stub, tmp_path):
+    ''' Test that a verified upload deletes the local file '''
+    shard_file = tmp_path / 'train-00000-of-00001'
+    etag = '"%s"' % hashlib.md5(b'tfrecord data').hexdigest()
+    sha256 = hashlib.sha256(b'tfrecord data').hexdigest()
+    metadata = {aws_s3_settings.S3_CHECKSUM_METADATA_KEY: sha256}
+    # The second object has an SSE-KMS ETag. Its SHA256 settles it
+    for head_etag in (etag, '"not-an-md5"'):
+        s3_stub.add_response('put_object', {'ETag': head_etag},
+                             {'Bucket': TEST_BUCKET, 'Body': ANY,
+                              'Key': 'shards/train-00000-of-00001',
+                              'Metadata': metadata})
+        s3_stub.add_response('head_object',
+                             {'ContentLength': 13, 'ETag': head_etag,
+                              'Metadata': metadata},
+                             {'Bucket': TEST_BUCKET,
+                              'Key': 'shards/train-00000-of-00001'})
+
+    for _ in range(2):
+        shard_file.write_bytes(b'tfrecord data')
+        with s3_utils.S3BackgroundUploader(TEST_BUCKET, 'shards',
+                                           delete_local=True) as uploader:
+            uploader.submit(str(shard_file))
+        assert uploader.summary == {
+                    'uploaded': ['shards/train-00000-of-00001'], 'failed': []}
+        assert not shard_file.exists()
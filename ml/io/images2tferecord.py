@@ -65,6 +65,7 @@ from pathlib import Path
 
 # Local imports
 from pylibs.ml.preprocessing.train_val_utils import split_train_val
+from pylibs.cloud.aws.s3 import s3_utils
 
 # this down here is not good. But trying to move fwd fast . . .
 import tensorflow.compat.v1 as tf
@@ -201,7 +202,8 @@ def _process_image(filename, coder):
 
 
 def _process_image_files_batch(coder, thread_index, ranges, name, filenames,
-                               texts, labels, num_shards, output_directory):
+                               texts, labels, num_shards, output_directory,
+                               s3_sink=None):
     """Processes and saves list of images as TFRecord in 1 thread.
 
     Args:
@@ -216,6 +218,8 @@ def _process_image_files_batch(coder, thread_index, ranges, name, filenames,
         labels: list of integer; each integer identifies the ground truth
         num_shards: integer number of shards for this data set.
         output_directory: Directory where TFE records are stored
+        s3_sink: Optional s3_utils.S3BackgroundUploader. Each shard is
+                 handed to it as soon as its writer is closed
     """
     # Each thread produces N shards where N = int(num_shards / num_threads).
     # For instance, if num_shards = 128, and the num_threads = 2, then the first
@@ -268,6 +272,9 @@ def _process_image_files_batch(coder, thread_index, ranges, name, filenames,
         print('%s [thread %d]: Wrote %d images to %s' %
               (datetime.now(), thread_index, shard_counter, output_file))
         sys.stdout.flush()
+        if s3_sink is not None:
+            # Upload this shard while the next one is being written
+            s3_sink.submit(output_file)
         shard_counter = 0
     print('%s [thread %d]: Wrote %d images to %d shards.' %
           (datetime.now(), thread_index, counter, num_files_in_thread))
@@ -275,7 +282,8 @@ def _process_image_files_batch(coder, thread_index, ranges, name, filenames,
 
 
 def process_image_files(name, filenames, texts, labels, num_shards,
-                        num_threads, output_directory):
+                        num_threads, output_directory, s3_bucket=None,
+                        s3_prefix='', delete_local=False):
     """Process and save list of images as TFRecord of Example protos.
 
     Args:
@@ -284,6 +292,13 @@ def process_image_files(name, filenames, texts, labels, num_shards,
         texts: list of strings; each string is human readable, e.g. 'dog'
         labels: list of integer; each integer identifies the ground truth
         num_shards: integer number of shards for this data set.
+        s3_bucket: If given, each shard is uploaded to s3_bucket/s3_prefix
+                   in the background as soon as it is written
+        s3_prefix: Prefix (i.e. "directory") for the uploaded shards
+        delete_local: Delete each local shard once its upload is verified
+    Returns:
+        None, or the upload summary (see S3BackgroundUploader.close) if
+        s3_bucket was given
     """
     assert len(filenames) == len(texts)
     assert len(filenames) == len(labels)
@@ -305,10 +320,15 @@ def process_image_files(name, filenames, texts, labels, num_shards,
     # Create a generic TensorFlow-based utility for converting all image codings.
     coder = ImageCoder()
 
+    s3_sink = None
+    if s3_bucket is not None:
+        s3_sink = s3_utils.S3BackgroundUploader(s3_bucket, s3_prefix,
+                                                delete_local=delete_local)
+
     threads = []
     for thread_index in range(len(ranges)):
         args = (coder, thread_index, ranges, name, filenames,
-                texts, labels, num_shards, output_directory)
+                texts, labels, num_shards, output_directory, s3_sink)
         t = threading.Thread(target=_process_image_files_batch, args=args)
         t.start()
         threads.append(t)
@@ -318,6 +338,13 @@ def process_image_files(name, filenames, texts, labels, num_shards,
     print('%s: Finished writing all %d images in data set.' %
           (datetime.now(), len(filenames)))
     sys.stdout.flush()
+    if s3_sink is not None:
+        summary = s3_sink.close()
+        print('%s: Uploaded %d shards, %d failed.' %
+              (datetime.now(), len(summary['uploaded']),
+               len(summary['failed'])))
+        sys.stdout.flush()
+        return summary
 
 
 def local_tests():